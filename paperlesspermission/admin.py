@@ -25,6 +25,9 @@ from .models import Section
 from .models import FieldTrip
 from .models import PermissionSlip
 from .models import PermissionSlipLink
+from .models import ImportFileState
+from .models import ExportFileStat
+from .models import ImportRun
 
 admin.site.register(Guardian)
 admin.site.register(Student)
@@ -34,3 +37,14 @@ admin.site.register(Section)
 admin.site.register(FieldTrip)
 admin.site.register(PermissionSlip)
 admin.site.register(PermissionSlipLink)
+admin.site.register(ImportFileState)
+admin.site.register(ExportFileStat)
+
+
+@admin.register(ImportRun)
+class ImportRunAdmin(admin.ModelAdmin):
+    list_display = ('started', 'finished', 'status', 'delta', 'peak_memory')
+    list_filter = ('status', 'delta')
+    readonly_fields = ('started', 'finished', 'status', 'error', 'phases',
+                       'problems', 'peak_memory', 'checkpoint',
+                       'resumed_from', 'delta', 'watermark')
@@ -23,38 +23,671 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from base64 import decodebytes
-from io import BytesIO
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+from hashlib import sha256
 import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+
+from paperlesspermission.djo_diff import ImportDiff, skip_writes
+from paperlesspermission.djo_rows import (PHONE_REGION, ROW_FORMATS,
+                                          normalize_phone, read_rows,
+                                          read_rows_parallel)
+from paperlesspermission.djo_sources import (EXPORT_FILES, DOWNLOAD_WORKERS,
+                                             DirectorySource, SFTPSource)
+from paperlesspermission.djo_snapshot import RosterSnapshot
+from paperlesspermission.djo_staging import StagingImport
+from paperlesspermission.models import (Guardian, Student, Faculty, Course,
+                                        Section, ImportFileState, ImportRun)
+from paperlesspermission.utils import (QueryCounter, chunked, file_digest,
+                                       peak_memory, record_fingerprint,
+                                       reset_peak_memory)
 
-import paramiko
+LOGGER = logging.getLogger(__name__)
 
-from paperlesspermission.models import Guardian, Student, Faculty, Course, Section
-from paperlesspermission.utils import bytes_io_to_tsv_dict_reader
+# Maximum number of rows written by a single INSERT or UPDATE statement.
+BULK_BATCH_SIZE = 500
+
+# Maximum number of rows written per transaction by an import phase.
+TRANSACTION_BATCH_SIZE = 5000
+
+# What `DJOImport.validate` does about references between the files that do
+# not resolve: import anyway and resolve against the database, skip the
+# rows or references concerned, or abort before anything is written.
+PROCEED = 'proceed'
+SKIP = 'skip'
+ABORT = 'abort'
+VALIDATION_POLICIES = (PROCEED, SKIP, ABORT)
+
+# Number of times a failed import is resumed before it is given up on.
+RESUME_ATTEMPTS = 3
+
+# Seconds after its start an import is no longer resumed. Its files are
+# outdated by then and a fresh export is fetched instead.
+RESUME_MAX_AGE = 6 * 60 * 60
+
+# Number of import phases run at the same time. With a single worker the
+# phases run one after another in the calling thread.
+PHASE_WORKERS = 1
+
+# Number of processes parsing large files. With a single worker the files
+# are parsed in the calling process.
+PARSE_WORKERS = 1
+
+UpsertResult = namedtuple('UpsertResult', ['created', 'updated', 'unchanged'])
+
+TransactionBatch = namedtuple('TransactionBatch',
+                              ['phase', 'rows', 'seconds', 'committed'])
 
-LOGGER = logging.getLogger(__name__)
+
+def resumable_run(retrying=False, max_attempts=RESUME_ATTEMPTS,
+                  max_age=RESUME_MAX_AGE):
+    """Returns the last import run if it failed and can be resumed.
+
+    A run can be resumed as long as the files in its checkpoint exist. Call
+    this while holding the `ImportLock`: a run still marked as running is
+    then known to have been interrupted, e.g. by a worker that died, and is
+    resumed. A run that failed is only resumed by the retry of a transient
+    error. Any other import starts over with a fresh export, as the error
+    may as well be in the files.
+
+    An import is given up on once it was resumed `max_attempts` times or
+    started more than `max_age` seconds ago, so the next import fetches a
+    fresh export instead. The checkpoint of a run given up on is deleted.
+
+    Parameters:
+        retrying (bool): Whether the caller retries an import that failed
+            with a transient error
+        max_attempts (int): Number of times an import is resumed
+        max_age (int): Seconds after its start an import is resumed
+
+    Returns:
+        ImportRun: The run to resume, or `None`
+    """
+    # Delta imports keep no checkpoint, the next delta picks up their changes.
+    import_run = ImportRun.objects.filter(delta=False).order_by(
+        '-started', '-id').first()
+    if import_run is None or import_run.status == ImportRun.SUCCEEDED:
+        return None
+    if not import_run.checkpoint or not os.path.isdir(import_run.checkpoint):
+        return None
+
+    attempts, resumed = 0, import_run
+    while resumed.resumed_from_id is not None:
+        attempts += 1
+        resumed = resumed.resumed_from
+    if attempts >= max_attempts:
+        LOGGER.warning("Import %d was resumed %d times, giving up on it.",
+                       import_run.id, attempts)
+    elif timezone.now() - import_run.started > timedelta(seconds=max_age):
+        LOGGER.info("Import %d is too old to resume, starting over.",
+                    import_run.id)
+    elif import_run.status == ImportRun.FAILED and not retrying:
+        LOGGER.info("Import %d failed and is not retried, starting over.",
+                    import_run.id)
+    else:
+        return import_run
+    shutil.rmtree(import_run.checkpoint, ignore_errors=True)
+    import_run.checkpoint = ''
+    import_run.save(update_fields=['checkpoint'])
+    return None
+
+
+def run_phase_graph(phases, run, workers):
+    """Runs phases concurrently, each once the phases it depends on are done.
+
+    Every phase is started in a thread pool as soon as all of its
+    dependencies completed. If a phase raises, no further phases are
+    started; the phases already running are waited for and the exception is
+    raised again.
+
+    Parameters:
+        phases (iterable): `(name, depends)` pairs, where `depends` lists the
+            names of the phases that have to complete first
+        run (callable): Runs the phase it is called with
+        workers (int): Maximum number of phases run at the same time
+
+    Raises:
+        ValueError: The phases depend on each other in a cycle or on a phase
+            that does not exist
+    """
+    pending = {name: set(depends) for name, depends in phases}
+    completed = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            ready = [name for name, depends in pending.items()
+                     if depends <= completed]
+            for name in ready:
+                del pending[name]
+                running[executor.submit(run, name)] = name
+            if not running:
+                raise ValueError('Import phases with unresolvable '
+                                 'dependencies: {0}'.format(sorted(pending)))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    pending.clear()
+                    wait(running)
+                    raise future.exception()
+                completed.add(name)
+
+
+def single_transaction(items, write):
+    """Runs `write(items)` in one transaction, unless `items` is empty.
+
+    This is the default `batches` argument of the bulk helpers below, see
+    `TransactionBatches.run` for the chunked version.
+
+    Returns:
+        list: The return value of `write`, if it was called
+    """
+    items = list(items)
+    if not items:
+        return []
+    with transaction.atomic():
+        return [write(items)]
+
+
+def bulk_upsert(model, key_field, records, fields, defaults=None, skip=None,
+                batch_size=BULK_BATCH_SIZE, batches=single_transaction,
+                diff=None, load_all=True, snapshot=None):
+    """Creates or updates `model` rows from `records` with bulk queries.
+
+    Every existing row is loaded in a single query and keyed on `key_field`.
+    The incoming records are then split into rows that need to be created and
+    rows that need to be updated. Rows whose `fields` already hold the incoming
+    values are skipped entirely.
+
+    Parameters:
+        model (django.db.models.Model): Model class to write to
+        key_field (String): Unique field identifying a record upstream
+        records (dict): Maps each key to a dict of `fields` values
+        fields (list): Field names compared and written for existing rows
+        defaults (dict): Extra values only used when creating a new row
+        skip (set): Keys known to be unchanged since the last import. Existing
+            rows for these keys are neither loaded nor compared, only rows
+            missing from the database are created.
+        batch_size (int): Maximum number of rows per INSERT/UPDATE statement
+        batches (callable): Called as `batches(items, write)` to write the new
+            and the changed rows in transactions
+        diff (ImportDiff): If given, the created and updated rows are
+            recorded in it
+        load_all (bool): Load every existing row in one query. Otherwise
+            only the rows of the incoming keys are loaded, `batch_size` keys
+            per query, which is cheaper for a handful of records, e.g. of a
+            delta import.
+        snapshot (RosterTable): If given, existing rows are compared with
+            the snapshot instead of being loaded from the database. The
+            snapshot is kept up to date with the rows written.
+
+    Returns:
+        UpsertResult: Number of rows created, updated and left unchanged
+    """
+    defaults = defaults or {}
+    if snapshot is not None and snapshot.covers(fields):
+        return _upsert_from_snapshot(model, key_field, records, fields,
+                                     defaults, skip, batch_size, batches,
+                                     diff, snapshot)
+    if skip:
+        # Only a narrow key column is needed to find out which of the skipped
+        # rows still exist. Full rows are loaded for the remaining keys only.
+        keys = set(model.objects.values_list(key_field, flat=True))
+        pending = [key for key in records if key not in skip or key not in keys]
+        existing = {}
+        for chunk in chunked([key for key in pending if key in keys],
+                             batch_size):
+            existing.update(
+                (getattr(obj, key_field), obj) for obj in model.objects.filter(
+                    **{key_field + '__in': chunk}).only(key_field, *fields))
+    elif not load_all:
+        pending = records
+        existing = {}
+        for chunk in chunked(list(records), batch_size):
+            existing.update(
+                (getattr(obj, key_field), obj) for obj in model.objects.filter(
+                    **{key_field + '__in': chunk}).only(key_field, *fields))
+    else:
+        pending = records
+        existing = {getattr(obj, key_field): obj
+                    for obj in model.objects.only(key_field, *fields)}
+
+    to_create = []
+    to_update = []
+    updated_fields = []
+    for key in pending:
+        values = records[key]
+        obj = existing.get(key)
+        if obj is None:
+            to_create.append(model(**{key_field: key}, **defaults, **values))
+            continue
+
+        changed = []
+        for field in fields:
+            if getattr(obj, field) != values[field]:
+                setattr(obj, field, values[field])
+                changed.append(field)
+        if changed:
+            to_update.append(obj)
+            updated_fields.append([key, changed])
+
+    if diff is not None:
+        table = model._meta.model_name
+        diff.record(table, 'created',
+                    (getattr(obj, key_field) for obj in to_create))
+        diff.record(table, 'updated', updated_fields)
+
+    batches(to_create, lambda chunk: model.objects.bulk_create(
+        chunk, batch_size=batch_size))
+    batches(to_update, lambda chunk: model.objects.bulk_update(
+        chunk, fields, batch_size=batch_size))
+
+    return UpsertResult(len(to_create), len(to_update),
+                        len(records) - len(to_create) - len(to_update))
+
+
+def _upsert_from_snapshot(model, key_field, records, fields, defaults, skip,
+                          batch_size, batches, diff, snapshot):
+    """Runs `bulk_upsert` against a `RosterTable` instead of the database.
+
+    Changed rows are written from the incoming values and their primary key,
+    so no model instance is ever loaded. The snapshot is only updated once
+    a chunk was written, a dry run leaves it as it is.
+    """
+    to_create = []
+    to_update = []
+    updated_fields = []
+    for key, values in records.items():
+        row = snapshot.get(key)
+        if row is None:
+            to_create.append(model(**{key_field: key}, **defaults, **values))
+            continue
+        if skip and key in skip:
+            continue
+
+        pk, record = row
+        changed = [field for field in fields
+                   if getattr(record, field) != values[field]]
+        if changed:
+            to_update.append(model(pk=pk, **{key_field: key}, **{
+                field: values[field] for field in fields}))
+            updated_fields.append([key, changed])
+
+    if diff is not None:
+        table = model._meta.model_name
+        diff.record(table, 'created',
+                    (getattr(obj, key_field) for obj in to_create))
+        diff.record(table, 'updated', updated_fields)
+
+    def create(chunk):
+        model.objects.bulk_create(chunk, batch_size=batch_size)
+        # Not every database returns the primary keys of new rows.
+        snapshot.load_keys(model, [getattr(obj, key_field) for obj in chunk],
+                           batch_size)
+
+    def update(chunk):
+        model.objects.bulk_update(chunk, fields, batch_size=batch_size)
+        for obj in chunk:
+            key = getattr(obj, key_field)
+            snapshot.update(key, {field: records[key][field]
+                                  for field in fields})
+
+    batches(to_create, create)
+    batches(to_update, update)
+
+    return UpsertResult(len(to_create), len(to_update),
+                        len(records) - len(to_create) - len(to_update))
+
+
+def sweep_hidden(model, key_field, seen_keys, chunk_size=BULK_BATCH_SIZE,
+                 batches=single_transaction, diff=None, snapshot=None):
+    """Sets the `hidden` flag on every row that was not seen by an import.
+
+    Rows whose key is in `seen_keys` are unhidden and all other rows are
+    hidden. The keys and flags of every row are loaded in a single query, so
+    only the rows whose flag actually changes are updated, with one UPDATE
+    statement per `chunk_size` keys instead of one query per row.
+
+    Parameters:
+        model (django.db.models.Model): Model class with a `hidden` field
+        key_field (String): Unique field identifying a record upstream
+        seen_keys (iterable): Keys present in the current upstream data
+        chunk_size (int): Maximum number of keys per IN (...) list
+        batches (callable): Called as `batches(items, write)` to run the
+            UPDATE statements in transactions
+        diff (ImportDiff): If given, the hidden and unhidden keys are
+            recorded in it
+        snapshot (RosterTable): If given, the flags are taken from the
+            snapshot instead of the database, and updated in it
+
+    Returns:
+        tuple: Number of rows hidden and number of rows unhidden
+    """
+    seen_keys = set(seen_keys)
+    key_in = key_field + '__in'
+
+    # A NOT IN (...) list cannot be split across several statements or
+    # transactions, so the changed keys are worked out up front instead.
+    if snapshot is not None:
+        flags = ((key, record.hidden) for key, record in snapshot.items())
+    else:
+        flags = model.objects.values_list(key_field, 'hidden')
+    unhide = []
+    stale = []
+    for key, hidden in flags:
+        if hidden and key in seen_keys:
+            unhide.append(key)
+        elif not hidden and key not in seen_keys:
+            stale.append(key)
+
+    def set_hidden(keys, hidden):
+        for chunk in chunked(keys, chunk_size):
+            model.objects.filter(**{key_in: chunk}).update(hidden=hidden)
+        if snapshot is not None:
+            for key in keys:
+                snapshot.update(key, {'hidden': hidden})
+
+    batches(unhide, lambda keys: set_hidden(keys, False))
+    batches(stale, lambda keys: set_hidden(keys, True))
+
+    if diff is not None:
+        diff.record(model._meta.model_name, 'unhidden', unhide)
+        diff.record(model._meta.model_name, 'hidden', stale)
+
+    return len(stale), len(unhide)
+
+
+def reconcile_links(through, source_field, target_field, links,
+                    sources=None, batch_size=BULK_BATCH_SIZE,
+                    batches=single_transaction, diff=None):
+    """Makes a many-to-many through table hold exactly the given links.
+
+    The current links are loaded in one query and compared with `links` as
+    sets. Only the missing links are inserted and only the stale links are
+    deleted. The missing links are inserted first, so readers never see a
+    half-empty relation.
+
+    Parameters:
+        through (django.db.models.Model): Through model of the relation
+        source_field (String): Column holding the owning side's primary key
+        target_field (String): Column holding the related side's primary key
+        links (set): (source pk, target pk) pairs that should exist
+        sources (set): If given, only links owned by these source primary keys
+            are added or removed. Links of other sources are left alone.
+        batch_size (int): Maximum number of rows per INSERT/DELETE statement
+        batches (callable): Called as `batches(items, write)` to write the
+            added and the removed links in transactions
+        diff (ImportDiff): If given, the added and removed (source pk,
+            target pk) pairs are recorded in it
+
+    Returns:
+        tuple: Number of links added and number of links removed
+    """
+    current = {}
+    for link_id, source, target in through.objects.values_list(
+            'id', source_field, target_field):
+        if sources is None or source in sources:
+            current[(source, target)] = link_id
+
+    added = [pair for pair in links if pair not in current]
+    removed = [pair for pair in current if pair not in links]
+
+    if diff is not None:
+        diff.record(through._meta.model_name, 'added', added)
+        diff.record(through._meta.model_name, 'removed', removed)
+
+    additions = [through(**{source_field: source, target_field: target})
+                 for source, target in added]
+    removals = [current[pair] for pair in removed]
+
+    batches(additions, lambda chunk: through.objects.bulk_create(
+        chunk, batch_size=batch_size))
+    batches(removals, lambda chunk: [
+        through.objects.filter(id__in=ids).delete()
+        for ids in chunked(chunk, batch_size)])
+
+    return len(additions), len(removals)
+
+
+class TransactionBatches():
+    """Runs the writes of an import in chunked transactions.
+
+    Every chunk of at most `size` rows is written inside its own
+    `transaction.atomic` block and recorded with its timing, so an import
+    commits once per chunk rather than once per statement. Inside an outer
+    atomic block, e.g. with `DJOImport(atomic=True)`, the chunks become
+    savepoints and nothing is committed until the outer block completes.
+
+    Attributes:
+        size (int): Maximum number of rows per transaction, or `None` to write
+            every step of a phase in a single transaction
+        batches (list): A `TransactionBatch` for every transaction run
+    """
+
+    def __init__(self, size=TRANSACTION_BATCH_SIZE):
+        self.size = size
+        self.batches = []
+
+    @contextmanager
+    def atomic(self, phase, rows=0):
+        """Runs the enclosed block in a transaction and records it.
+
+        Parameters:
+            phase (String): Name of the phase the transaction belongs to
+            rows (int): Number of rows written in the transaction
+        """
+        committed = not transaction.get_connection().in_atomic_block
+        start = time.monotonic()
+        with transaction.atomic():
+            yield
+        batch = TransactionBatch(phase, rows, time.monotonic() - start,
+                                 committed)
+        self.batches.append(batch)
+        LOGGER.debug("%s: %s %d rows in %.3fs.", phase,
+                     'committed' if committed else 'released savepoint for',
+                     rows, batch.seconds)
+
+    def run(self, phase, items, write):
+        """Calls `write` with chunks of `items`, each in its own transaction.
+
+        Parameters:
+            phase (String): Name of the phase the rows belong to
+            items (iterable): Rows to be written
+            write (callable): Writes the list of rows it is called with
+
+        Returns:
+            list: The return value of `write` for each chunk
+        """
+        items = list(items)
+        results = []
+        for chunk in chunked(items, self.size or len(items) or 1):
+            with self.atomic(phase, len(chunk)):
+                results.append(write(chunk))
+        return results
+
+    def for_phase(self, phase):
+        """Returns `run` bound to `phase`, for the `batches` arguments."""
+        return partial(self.run, phase)
+
+    def summary(self):
+        """Returns the transactions, rows and time spent per phase.
+
+        Returns:
+            dict: Maps each phase to a dict of `transactions`, `commits`,
+                `rows` and `seconds`
+        """
+        summary = {}
+        for batch in self.batches:
+            totals = summary.setdefault(batch.phase, {
+                'transactions': 0, 'commits': 0, 'rows': 0, 'seconds': 0.0})
+            totals['transactions'] += 1
+            totals['commits'] += batch.committed
+            totals['rows'] += batch.rows
+            totals['seconds'] += batch.seconds
+        return summary
+
+
+class InvalidExportError(ValueError):
+    """The export files reference records that are not in the export."""
+
+
+class ImportReport():
+    """Collects problems found in the upstream data during an import.
+
+    Problems are grouped by category (for example `unknown_teacher`) and hold
+    the ID of the offending record along with the value that could not be
+    resolved. They are logged as they are found and can be reviewed once the
+    import has finished instead of aborting it halfway through.
+
+    Attributes:
+        problems (dict): Maps each category to a list of (record ID, value)
+    """
+
+    def __init__(self):
+        self.problems = defaultdict(list)
+
+    def add(self, category, record_id, value):
+        """Records a problem with an upstream record.
+
+        Parameters:
+            category (String): Kind of problem, e.g. `unknown_teacher`
+            record_id (String): ID of the record the problem was found on
+            value (String): Value that caused the problem
+        """
+        self.problems[category].append((record_id, value))
+        LOGGER.warning('%s: %s on record %s', category, value, record_id)
+
+    def as_dict(self):
+        """Returns the problems as a plain, JSON serializable dict."""
+        return {category: [list(problem) for problem in problems]
+                for category, problems in self.problems.items()}
+
+    def __bool__(self):
+        return any(self.problems.values())
 
 
 class DJOImport():
     """Imports data from SQLRunner/Powerschool into Paperless Permission.
 
+    Each file is a binary file object, e.g. an `io.BytesIO` or the
+    file objects returned by an `ImportSource` from `djo_sources`. Files
+    are read as a stream every time they are parsed.
+
     Attributes:
         fs_classes (io.BytesIO): TSV file containing class data
         fs_faculty (io.BytesIO): TSV file containing faculty data
         fs_student (io.BytesIO): TSV file containing student data
         fs_parent (io.BytesIO): TSV file containing parent data
         fs_enrollment (io.BytesIO): TSV file containing enrollment data
+        report (ImportReport): Problems found in the upstream data
+        skip_unchanged (bool): Skip files and rows that have not changed since
+            the last import. See `run_phase`.
+        atomic (bool): Run all of `import_all` in a single transaction, so a
+            failure leaves the roster exactly as it was
+        transactions (TransactionBatches): Transactions run by the phases
+        dry_run (bool): Only work out the changes, without writing anything.
+            Change detection is disabled in dry runs.
+        diff (ImportDiff): Changes found by a dry run, otherwise `None`
+        stats (list): Measurements of every phase run by the last
+            `import_all`, see `ImportRun.phases`
+        import_run (ImportRun): Record of the last `import_all` or
+            `import_staged`. Dry runs are not recorded.
+        phase_workers (int): Number of phases `import_all` runs at the same
+            time, see `run_phase_graph`
+        parse_workers (int): Number of processes parsing the files, see
+            `rows`
+        checkpoint_dir (String): Directory each run copies its files to, so
+            a failed run can be resumed with `Resume`. `None` disables it.
+        resume_from (ImportRun): Failed run this import resumes. Its
+            completed phases are not run again.
+        validation (String): What to do about references between the files
+            that do not resolve, one of `VALIDATION_POLICIES`. See
+            `validate`.
+        validation_report (ImportReport): References between the files that
+            do not resolve, found by `validate`
+        phone_region (String): Region of the phone numbers that lack a
+            country code, see `normalize_phone`
+        snapshot_path (String): File the roster snapshot is saved to after
+            every successful import, so the next import does not have to
+            read it from the database. `None` disables it.
+        snapshot (RosterSnapshot): Roster the running `import_all` compares
+            the export with, see `load_snapshot`
     """
 
-    def __init__(self, fs_classes, fs_faculty, fs_student, fs_parent, fs_enrollment):
+    # The import phases in the order `import_all` runs them. Each phase is
+    # named after its `import_<name>` method and lists the attribute holding
+    # its file and the phases whose data it references. With several
+    # `phase_workers` a phase starts as soon as those phases completed.
+    PHASES = (
+        ('faculty', 'fs_faculty', ()),
+        ('classes', 'fs_classes', ('faculty',)),
+        ('students', 'fs_student', ()),
+        ('guardians', 'fs_parent', ('students',)),
+        ('enrollment', 'fs_enrollment', ('classes', 'students')),
+    )
+
+    def __init__(self, fs_classes, fs_faculty, fs_student, fs_parent, fs_enrollment,
+                 skip_unchanged=False, atomic=False,
+                 transaction_batch_size=TRANSACTION_BATCH_SIZE, dry_run=False,
+                 phase_workers=PHASE_WORKERS, checkpoint_dir=None,
+                 resume_from=None, validation=PROCEED,
+                 phone_region=PHONE_REGION, snapshot_path=None,
+                 parse_workers=PARSE_WORKERS):
         self.fs_classes = fs_classes
         self.fs_faculty = fs_faculty
         self.fs_student = fs_student
         self.fs_parent = fs_parent
         self.fs_enrollment = fs_enrollment
+        self.report = ImportReport()
+        self.skip_unchanged = skip_unchanged and not dry_run
+        self.atomic = atomic
+        self.transactions = TransactionBatches(transaction_batch_size)
+        self.dry_run = dry_run
+        self.diff = ImportDiff() if dry_run else None
+        self.stats = []
+        self.import_run = None
+        self.phase_workers = phase_workers
+        self.parse_workers = parse_workers
+        self.checkpoint_dir = checkpoint_dir
+        self.resume_from = resume_from
+        if validation not in VALIDATION_POLICIES:
+            raise ValueError('Unknown validation policy: {0}'.format(
+                validation))
+        self.validation = validation
+        self.validation_report = ImportReport()
+        self.phone_region = phone_region
+        self.snapshot_path = snapshot_path
+        self.snapshot = None
+        self._exported_keys = None
+        self._invalid_phones = set()
+        self._resumed_phases = set()
+        if resume_from is not None:
+            self._resumed_phases = set(resume_from.completed_phases())
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._parse_pool = None
+        self._parse_pool_lock = threading.Lock()
+        self._file_states = {}
+        self._phase_digests = {}
+        self._row_fingerprints = {}
+        self._run_peak_memory = 0
+        self._phases_overlap = False
 
     @classmethod
-    def GetFromSFTP(cls, hostname, username, password, ssh_fingerprint):
+    def GetFromSFTP(cls, hostname, username, password, ssh_fingerprint,
+                    download_workers=DOWNLOAD_WORKERS, pool=None, **kwargs):
         """Constructor for `DJOImport` class that pull from remote SFTP server.
 
         This constructor takes SFTP connection information and pulls the TSV
@@ -81,6 +714,9 @@ class DJOImport():
         The long string after `ssh-rsa` is the string that you want to pass to
         `ssh_fingerprint`.
 
+        The files are downloaded concurrently, each over its own SFTP channel
+        on the one SSH connection, see `SFTPSource`.
+
         Parameters:
             hostname (String): Host to connect to SFTP Dropsite
             username (String): Username used to connect to SFTP Dropsite
@@ -89,45 +725,402 @@ class DJOImport():
                 the value starting with `AAAA` after `ssh-rsa`. This value is
                 used to authenticate the remote server and to prevent
                 man-in-the-middle attacks.
+            download_workers (int): Number of files downloaded at once
+            pool (paperlesspermission.djo_sources.SSHSessionPool): Pool to
+                borrow the SSH connection from instead of opening one
+            **kwargs: Passed on to the `DJOImport` constructor
         """
+        return cls.FromSource(
+            SFTPSource(hostname, username, password, ssh_fingerprint,
+                       download_workers=download_workers, pool=pool),
+            **kwargs)
 
-        # Take the given ssh_fingerprint and decode the RSA Key from it.
-        key_fingerprint_data = ssh_fingerprint.encode()
-        key = paramiko.RSAKey(data=decodebytes(key_fingerprint_data))
+    @classmethod
+    def FromSource(cls, source, **kwargs):
+        """Constructor for `DJOImport` class that reads from an import source.
+
+        Parameters:
+            source (paperlesspermission.djo_sources.ImportSource): Source the
+                export files are fetched from, e.g. from `source_from_url`
+            **kwargs: Passed on to the `DJOImport` constructor
+        """
+        return cls(**source.fetch(), **kwargs)
 
-        ssh_client = paramiko.client.SSHClient()
+    @classmethod
+    def Resume(cls, import_run, **kwargs):
+        """Constructor for `DJOImport` class that resumes a failed import.
 
-        hostkeys = ssh_client.get_host_keys()
-        hostkeys.add(hostname, 'ssh-rsa', key)
+        The files are read from the checkpoint of `import_run` instead of
+        being fetched again, and the phases it completed are skipped. A
+        phase that failed halfway runs again; the bulk helpers only write
+        rows that differ from the database, so the batches it committed
+        before failing are not written again.
 
-        fs_classes = BytesIO()
-        fs_faculty = BytesIO()
-        fs_student = BytesIO()
-        fs_parent = BytesIO()
-        fs_enrollment = BytesIO()
+        A run still marked as running was interrupted, e.g. by a worker
+        that died, and is marked as failed first.
 
+        Parameters:
+            import_run (ImportRun): Failed run with a `checkpoint`
+            **kwargs: Passed on to the `DJOImport` constructor
+        """
+        if import_run.status == ImportRun.RUNNING:
+            import_run.status = ImportRun.FAILED
+            import_run.error = 'Interrupted'
+            import_run.finished = timezone.now()
+            import_run.save()
+        return cls.FromSource(DirectorySource(import_run.checkpoint),
+                              resume_from=import_run, **kwargs)
+
+    @property
+    def _phase_stats(self):
+        """Row counts of the phase running in the current thread."""
+        if not hasattr(self._local, 'phase_stats'):
+            self._local.phase_stats = Counter()
+        return self._local.phase_stats
+
+    @_phase_stats.setter
+    def _phase_stats(self, value):
+        self._local.phase_stats = value
+
+    def _file_state(self, name):
+        """Returns the stored `ImportFileState` of phase `name`."""
+        if name not in self._file_states:
+            self._file_states[name], _ = ImportFileState.objects.get_or_create(
+                name=name)
+        return self._file_states[name]
+
+    def phase_digest(self, name):
+        """Returns a digest of phase `name`'s file and its dependencies.
+
+        A phase has to run again when its own file changed, but also when any
+        file it references did, since e.g. a section may now resolve to a
+        teacher that was missing before.
+        """
+        for phase, attribute, depends in self.PHASES:
+            if phase == name:
+                digests = [file_digest(getattr(self, attribute))]
+                digests.extend(self.phase_digest(dep) for dep in depends)
+                return sha256(':'.join(digests).encode()).hexdigest()
+        raise ValueError('Unknown import phase: {0}'.format(name))
+
+    def phase_digests(self):
+        """Works out the digest of every phase, see `phase_digest`.
+
+        The files are shared by all phases and `file_digest` rewinds them,
+        so phases running at the same time must not read them for their
+        digests. `import_all` works out every digest up front instead,
+        reading each file once, and `run_phase` uses the stored digests.
+
+        Returns:
+            dict: Maps the name of every phase to its digest
+        """
+        files = {attribute: file_digest(getattr(self, attribute))
+                 for _, attribute, _ in self.PHASES}
+        digests = {}
+        # The phases a phase depends on come before it in PHASES.
+        for name, attribute, depends in self.PHASES:
+            parts = [files[attribute]] + [digests[dep] for dep in depends]
+            digests[name] = sha256(':'.join(parts).encode()).hexdigest()
+        self._phase_digests = digests
+        return digests
+
+    def _writes(self, name):
+        """Returns the `batches` and `diff` arguments of the bulk helpers.
+
+        Parameters:
+            name (String): Name of the phase the writes belong to
+        """
+        if self.dry_run:
+            return {'batches': skip_writes, 'diff': self.diff}
+        return {'batches': self.transactions.for_phase(name), 'diff': None}
+
+    def load_snapshot(self):
+        """Returns the `RosterSnapshot` `import_all` compares the export with.
+
+        The snapshot saved at `snapshot_path` is used if no import ran since
+        it was saved. Otherwise it is read from the database.
+        """
+        if self.snapshot_path:
+            snapshot = RosterSnapshot.load(self.snapshot_path)
+            if snapshot is not None and snapshot.is_current():
+                LOGGER.info("Using the roster snapshot of import run %d.",
+                            snapshot.run_id)
+                return snapshot
+        return RosterSnapshot.from_database()
+
+    def _save_snapshot(self):
+        """Saves the snapshot of a successful import to `snapshot_path`.
+
+        Failing to save it only costs the next import a few queries, so it
+        does not fail the import.
+        """
+        if (not self.snapshot_path or self.snapshot is None
+                or self.import_run is None):
+            return
+        self.snapshot.run_id = self.import_run.id
         try:
-            LOGGER.info("Connecting to sftp server...")
-            ssh_client.connect(hostname, username=username,
-                               password=password, look_for_keys=False,
-                               allow_agent=False)
-            sftp_client = ssh_client.open_sftp()
-            LOGGER.info("Connection to sftp server successful.")
-
-            LOGGER.info("Downloading data files.")
-            sftp_client.chdir('ps_data_export')
-            sftp_client.getfo('fs_classes.txt', fs_classes)
-            sftp_client.getfo('fs_faculty.txt', fs_faculty)
-            sftp_client.getfo('fs_student.txt', fs_student)
-            sftp_client.getfo('fs_parent.txt', fs_parent)
-            sftp_client.getfo('fs_enrollment.txt', fs_enrollment)
-            LOGGER.info("Datafiles downloaded successfully.")
-
-            return cls(fs_classes, fs_faculty, fs_student, fs_parent,
-                       fs_enrollment)
-        finally:
-            ssh_client.close()
-            LOGGER.info("SSH Connection Closed")
+            self.snapshot.save(self.snapshot_path)
+        except OSError as error:
+            LOGGER.warning("Could not save the roster snapshot: %r", error)
+
+    def discard_snapshot(self):
+        """Deletes the snapshot saved at `snapshot_path`, if any."""
+        if self.snapshot_path:
+            try:
+                os.remove(self.snapshot_path)
+            except FileNotFoundError:
+                pass
+
+    def forget_file_states(self):
+        """Makes the next import with `skip_unchanged` compare every record.
+
+        Imports that write without `run_phase`, like staged imports, do not
+        keep the file digests and row fingerprints up to date. Left in
+        place, the next import with `skip_unchanged` would skip files and
+        rows based on what the database held before.
+        """
+        ImportFileState.objects.filter(
+            name__in=[name for name, _, _ in self.PHASES]).update(
+                digest='', row_fingerprints='')
+        self._file_states = {}
+
+    def _snapshot_table(self, model):
+        """Returns the `RosterTable` of `model`, or `None` without one."""
+        if self.snapshot is None:
+            return None
+        return self.snapshot.table(model)
+
+    def _id_map(self, model, key_field):
+        """Returns a map of `key_field` values to primary keys of `model`.
+
+        In a dry run the rows that would have been created are missing from
+        the database. They are mapped to a `('new', key)` placeholder instead,
+        so later phases can still reference them.
+        """
+        table = self._snapshot_table(model)
+        if table is not None:
+            ids = table.id_map()
+        else:
+            ids = dict(model.objects.values_list(key_field, 'id'))
+        if self.dry_run:
+            for key in self.diff.created(model._meta.model_name):
+                ids.setdefault(key, ('new', key))
+        return ids
+
+    def _label_links(self, through, sources, targets):
+        """Shows the links of a dry run with the upstream keys in `diff`."""
+        if self.dry_run:
+            self.diff.label_links(
+                through._meta.model_name,
+                {pk: key for key, pk in sources.items()},
+                {pk: key for key, pk in targets.items()})
+
+    def rows(self, attribute):
+        """Returns an iterator over the typed rows of the file held in
+        `attribute`, see `djo_rows`.
+
+        With several `parse_workers`, files of more than one chunk are
+        parsed and turned into rows by a pool of processes, while the
+        calling thread goes on writing the rows of the chunks parsed so far,
+        see `read_rows_parallel`. The pool is shut down once `import_all`
+        completed, or with `shutdown_parse_pool`.
+        """
+        fileobj = getattr(self, attribute)
+        if self.parse_workers <= 1:
+            return read_rows(attribute, fileobj)
+        with self._parse_pool_lock:
+            if self._parse_pool is None:
+                # Forking a process running threads, e.g. phase workers or
+                # SSH transports, can deadlock the child. Spawned workers
+                # start from a clean interpreter.
+                self._parse_pool = ProcessPoolExecutor(
+                    self.parse_workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+        return read_rows_parallel(attribute, fileobj, self._parse_pool,
+                                  self.parse_workers)
+
+    def shutdown_parse_pool(self):
+        """Stops the worker processes started by `rows`, if any."""
+        with self._parse_pool_lock:
+            if self._parse_pool is not None:
+                self._parse_pool.shutdown()
+                self._parse_pool = None
+
+    def _read(self, attribute):
+        """Yields the typed rows of the file held in `attribute`, counting
+        them as read. See `rows`."""
+        for row in self.rows(attribute):
+            self._phase_stats['rows_read'] += 1
+            yield row
+
+    def check_headers(self):
+        """Checks the header of every file before anything is imported.
+
+        Raises:
+            paperlesspermission.djo_rows.HeaderError: A file lacks some of
+                the columns the importer reads
+        """
+        for attribute, row_format in ROW_FORMATS.items():
+            row_format.check_header(getattr(self, attribute))
+
+    def validate(self):
+        """Checks every reference between the files before importing them.
+
+        Teachers and coteachers of sections have to be in fs_faculty, the
+        students of guardians and enrollments in fs_student and the sections
+        of enrollments in fs_classes. The check runs in memory on the keys of
+        the files, without querying the database. Every reference that does
+        not resolve is added to `validation_report` as a
+        `dangling_<reference>` problem.
+        What happens next depends on `validation`:
+
+            proceed: Import everything. References are resolved against the
+                database like always, which may still hold the record.
+            skip: Leave out the enrollments and guardian links with a
+                dangling reference. Sections are imported without their
+                dangling teacher or coteacher.
+            abort: Raise `InvalidExportError` if any reference dangles.
+
+        Returns:
+            int: Number of dangling references
+
+        Raises:
+            InvalidExportError: References dangle and `validation` is abort
+        """
+        self.validation_report = ImportReport()
+        faculty = {row.record_id for row in self.rows('fs_faculty')}
+        students = {row.record_id for row in self.rows('fs_student')}
+        sections = set()
+        dangling = Counter()
+
+        def check(category, record_id, key, keys):
+            if key and key not in keys:
+                dangling[category] += 1
+                self.validation_report.add(category, record_id, key)
+
+        for row in self.rows('fs_classes'):
+            sections.add(row.record_id)
+            check('dangling_teacher', row.record_id, row.teacher, faculty)
+            check('dangling_coteacher', row.record_id, row.coteacher, faculty)
+        for row in self.rows('fs_parent'):
+            for contact in row.contacts:
+                if contact is not None:
+                    check('dangling_guardian_student', contact.person_id,
+                          row.student_number, students)
+        for row in self.rows('fs_enrollment'):
+            check('dangling_enrolled_student', row.section_id,
+                  row.student_number, students)
+            check('dangling_section', row.student_number, row.section_id,
+                  sections)
+
+        self._exported_keys = {'fs_faculty': faculty, 'fs_student': students,
+                               'fs_classes': sections}
+        total = sum(dangling.values())
+        if total:
+            LOGGER.warning("Validation found %d dangling references (%s), "
+                           "policy: %s.", total, ', '.join(
+                               '{0} {1}'.format(count, category) for
+                               category, count in sorted(dangling.items())),
+                           self.validation)
+        if total and self.validation == ABORT:
+            raise InvalidExportError(
+                'The export has {0} dangling references, see the validation '
+                'report.'.format(total))
+        return total
+
+    @property
+    def skips_dangling(self):
+        """Whether `validate` ran and dangling references are left out."""
+        return self.validation == SKIP and self._exported_keys is not None
+
+    def exported(self, attribute, key):
+        """Returns whether a reference to `key` may be imported.
+
+        With the skip policy only keys found in the file held in `attribute`
+        may be referenced. Otherwise every reference is resolved against the
+        database.
+        """
+        if not self.skips_dangling:
+            return True
+        return key in self._exported_keys[attribute]
+
+    def cell_number(self, contact):
+        """Returns the cell number of a guardian's contact block in E.164 form.
+
+        Numbers that cannot be parsed are reported, once per guardian and
+        number, and dropped so the guardian is not texted.
+
+        Parameters:
+            contact (ContactRow): Contact block of the guardian
+
+        Returns:
+            String: The E.164 number, or an empty string if there is none
+        """
+        number = normalize_phone(contact.cell_phone, self.phone_region)
+        if number is None:
+            problem = (contact.person_id, contact.cell_phone)
+            if problem not in self._invalid_phones:
+                self._invalid_phones.add(problem)
+                self.report.add('invalid_phone', *problem)
+            return ''
+        return number
+
+    def _upsert(self, name, model, key_field, records, fields, defaults=None):
+        """Runs `bulk_upsert` and skips rows whose fingerprint is unchanged.
+
+        When `skip_unchanged` is set, the fingerprint of every record is
+        compared with the one stored by the last import of phase `name`.
+        The new fingerprints are stored once the phase completes.
+        """
+        skip = None
+        if self.skip_unchanged:
+            fingerprints = {key: record_fingerprint(values)
+                            for key, values in records.items()}
+            previous = self._file_state(name).get_row_fingerprints()
+            skip = {key for key, fingerprint in fingerprints.items()
+                    if previous.get(key) == fingerprint}
+            self._row_fingerprints[name] = fingerprints
+        result = bulk_upsert(model, key_field, records, fields,
+                             defaults=defaults, skip=skip,
+                             snapshot=self._snapshot_table(model),
+                             **self._writes(name))
+        self._phase_stats['rows_skipped'] += result.unchanged
+        return result
+
+    def run_phase(self, name):
+        """Runs the `import_<name>` method for a single import phase.
+
+        With `skip_unchanged` set the phase is skipped entirely if neither its
+        file nor the files it depends on changed since the last successful
+        import. The digest is only stored once the phase completed.
+
+        Parameters:
+            name (String): Name of the phase, e.g. `faculty`
+
+        Returns:
+            bool: Whether the phase actually ran
+        """
+        if not self.skip_unchanged:
+            getattr(self, 'import_' + name)()
+            return True
+
+        if name in self._phase_digests:
+            digest = self._phase_digests[name]
+        else:
+            digest = self.phase_digest(name)
+        state = self._file_state(name)
+        if state.digest == digest:
+            LOGGER.info("%s unchanged since the last import, skipping.",
+                        name.capitalize())
+            return False
+
+        getattr(self, 'import_' + name)()
+
+        state.digest = digest
+        if name in self._row_fingerprints:
+            state.set_row_fingerprints(self._row_fingerprints.pop(name))
+        state.save()
+        return True
 
     def import_faculty(self):
         """Parses the fs_faculty file and imports to the database.
@@ -136,47 +1129,35 @@ class DJOImport():
         """
 
         LOGGER.info("Importing Faculty.")
-        faculty_reader = bytes_io_to_tsv_dict_reader(self.fs_faculty)
+        faculty_reader = self._read('fs_faculty')
 
         # Keep track of all written Faculty objects so we can later hide old
         # records that have been removed from the upstream data source.
-        written_ids = []
-
+        records = {}
         for row in faculty_reader:
-            try:
-                # Throws DoesNotExist exception if this Faculty is not in
-                # database
-                faculty_obj = Faculty.objects.get(person_id=row['RECORDID'])
-
-                faculty_obj.first_name = row['FIRST_NAME']
-                faculty_obj.last_name = row['LAST_NAME']
-                faculty_obj.email = row['EMAIL_ADDR']
-                faculty_obj.preferred_name = row['PREFERREDNAME']
-                faculty_obj.hidden = False
-
-                faculty_obj.save()
-            except Faculty.DoesNotExist:
-                faculty_obj = Faculty(
-                    person_id=row['RECORDID'],
-                    first_name=row['FIRST_NAME'],
-                    last_name=row['LAST_NAME'],
-                    email=row['EMAIL_ADDR'],
-                    notify_cell=False,
-                    preferred_name=row['PREFERREDNAME']
-                )
-                faculty_obj.save()
-            finally:
-                written_ids.append(row['RECORDID'])
+            records[row.record_id] = {
+                'first_name': row.first_name,
+                'last_name': row.last_name,
+                'email': row.email,
+                'preferred_name': row.preferred_name,
+            }
+        written_ids = set(records)
+
+        result = self._upsert('faculty', Faculty, 'person_id', records,
+                              ['first_name', 'last_name', 'email',
+                               'preferred_name'],
+                              defaults={'notify_cell': False})
+        LOGGER.info("Faculty: %d created, %d updated, %d unchanged.",
+                    *result)
 
         LOGGER.info("Faculty imported, setting hidden flags.")
 
         # If we didn't see any given Faculty IDs when running this import, set
-        # their `hidden` value to `False`. This will hide their information
+        # their `hidden` value to `True`. This will hide their information
         # from certain sections of the UI while retaining historical records.
-        for record in Faculty.objects.all():
-            if record.person_id not in written_ids:
-                record.hidden = True
-                record.save()
+        sweep_hidden(Faculty, 'person_id', written_ids,
+                     snapshot=self._snapshot_table(Faculty),
+                     **self._writes('faculty'))
 
         LOGGER.info("All faculty imported.")
 
@@ -197,6 +1178,10 @@ class DJOImport():
             not, add it.
           - Once the `Course` is taken care of we can then add the Section.
 
+        Teachers are resolved from an in-memory map of the existing `Faculty`.
+        Sections referencing an unknown teacher or coteacher are imported
+        without one and the reference is added to `self.report`.
+
         Just like every other import, we'll need to keep track of each Course
         and Section ID that we find. Once finished importing the data we need
         to run through all the existing Courses and Sections to set the hidden
@@ -205,79 +1190,71 @@ class DJOImport():
         """
 
         LOGGER.info("Importing classes.")
-        classes_reader = bytes_io_to_tsv_dict_reader(self.fs_classes)
+        classes_reader = self._read('fs_classes')
 
-        # Keep track of all written Courses and Section objects.
-        written_courses = []
-        written_sections = []
+        faculty = self._id_map(Faculty, 'person_id')
 
+        def resolve_teacher(row, field):
+            """Returns the Faculty primary key referenced by `row.<field>`."""
+            person_id = getattr(row, field)
+            if not person_id or not self.exported('fs_faculty', person_id):
+                return None
+            if person_id not in faculty:
+                self.report.add('unknown_' + field, row.record_id, person_id)
+                return None
+            return faculty[person_id]
+
+        # Courses are duplicated on every Section row, the first row wins.
+        course_records = {}
+        section_rows = {}
         for row in classes_reader:
-            # Handle the Course, but skip this step if we've already seen this
-            # course.
-            if row['COURSE_NUMBER'] not in written_courses:
-                try:
-                    course = Course.objects.get(
-                        course_number=row['COURSE_NUMBER'])
-                    course.course_name = row['COURSE_NAME']
-                    course.hidden = False
-                    course.save()
-                except Course.DoesNotExist:
-                    course = Course(
-                        course_number=row['COURSE_NUMBER'],
-                        course_name=row['COURSE_NAME'],
-                        hidden=False
-                    )
-                    course.save()
-                finally:
-                    written_courses.append(row['COURSE_NUMBER'])
-
-            # Handle the Section
-            try:
-                section = Section.objects.get(section_id=row['RECORDID'])
-                section.course = course
-                section.section_number = row['SECTION_NUMBER']
-                section.teacher = Faculty.objects.get(person_id=row['TEACHER'])
-                section.coteacher = Faculty.objects.get(
-                    person_id=row['COTEACHER']) if row['COTEACHER'] else None
-                section.school_year = row['SCHOOLYEAR']
-                section.room = row['ROOM']
-                section.period = row['EXPRESSION']
-                section.hidden = False
-                section.save()
-            except Section.DoesNotExist:
-                section = Section(
-                    section_id=row['RECORDID'],
-                    course=course,
-                    section_number=row['SECTION_NUMBER'],
-                    teacher=Faculty.objects.get(person_id=row['TEACHER']),
-                    coteacher=Faculty.objects.get(
-                        person_id=row['COTEACHER']) if row['COTEACHER'] else None,
-                    school_year=row['SCHOOLYEAR'],
-                    room=row['ROOM'],
-                    period=row['EXPRESSION'],
-                    hidden=False
-                )
-                section.save()
-            finally:
-                written_sections.append(row['RECORDID'])
+            if row.course_number not in course_records:
+                course_records[row.course_number] = {
+                    'course_name': row.course_name,
+                }
+            section_rows[row.record_id] = row
+        written_courses = set(course_records)
+        written_sections = set(section_rows)
+
+        writes = self._writes('classes')
+        result = bulk_upsert(Course, 'course_number', course_records,
+                             ['course_name'], **writes)
+        self._phase_stats['rows_skipped'] += result.unchanged
+        LOGGER.info("Courses: %d created, %d updated, %d unchanged.",
+                    *result)
+
+        courses = self._id_map(Course, 'course_number')
+        section_records = {}
+        for section_id, row in section_rows.items():
+            section_records[section_id] = {
+                'course_id': courses[row.course_number],
+                'section_number': row.section_number,
+                'teacher_id': resolve_teacher(row, 'teacher'),
+                'coteacher_id': resolve_teacher(row, 'coteacher'),
+                'school_year': row.school_year,
+                'room': row.room,
+                'period': row.expression,
+            }
+
+        result = self._upsert('classes', Section, 'section_id',
+                              section_records,
+                              ['course_id', 'section_number', 'teacher_id',
+                               'coteacher_id', 'school_year', 'room',
+                               'period'])
+        LOGGER.info("Sections: %d created, %d updated, %d unchanged.",
+                    *result)
 
         LOGGER.info("Classes updated.")
 
         # If we didn't see any given Course ID when running the import, set
-        # their hidden value to `False`. This will hide their information from
+        # their hidden value to `True`. This will hide their information from
         # certain sections of the UI while retaining historical records.
         LOGGER.info("Setting hidden flags on courses.")
-        for course in Course.objects.all():
-            if course.course_number not in written_courses:
-                course.hidden = True
-                course.save()
+        sweep_hidden(Course, 'course_number', written_courses, **writes)
 
         LOGGER.info("Setting hidden flags on sections.")
         # Same thing, only for the Section objects.
-        for section in Section.objects.all():
-            if section.section_id not in written_sections:
-                section.hidden = True
-                section.save()
+        sweep_hidden(Section, 'section_id', written_sections, **writes)
 
         LOGGER.info("Class importer complete.")
 
@@ -286,45 +1263,35 @@ class DJOImport():
 
         LOGGER.info("Importing students.")
 
-        student_reader = bytes_io_to_tsv_dict_reader(self.fs_student)
+        student_reader = self._read('fs_student')
 
         # Keep track of all written Students objects
-        written_students = []
-
+        records = {}
         for row in student_reader:
-            try:
-                student = Student.objects.get(person_id=row['RECORDID'])
-                student.grade_level = row['GRADE_LEVEL']
-                student.first_name = row['FIRST_NAME']
-                student.last_name = row['LAST_NAME']
-                student.email = row['EMAIL']
-                student.notify_cell = False
-                student.hidden = False
-                student.save()
-            except Student.DoesNotExist:
-                student = Student(
-                    person_id=row['RECORDID'],
-                    first_name=row['FIRST_NAME'],
-                    last_name=row['LAST_NAME'],
-                    email=row['EMAIL'],
-                    notify_cell=False,
-                    hidden=False,
-                    grade_level=row['GRADE_LEVEL']
-                )
-                student.save()
-            finally:
-                written_students.append(row['RECORDID'])
+            records[row.record_id] = {
+                'grade_level': row.grade_level,
+                'first_name': row.first_name,
+                'last_name': row.last_name,
+                'email': row.email,
+                'notify_cell': False,
+            }
+        written_students = set(records)
+
+        result = self._upsert('students', Student, 'person_id', records,
+                              ['grade_level', 'first_name', 'last_name',
+                               'email', 'notify_cell'])
+        LOGGER.info("Students: %d created, %d updated, %d unchanged.",
+                    *result)
 
         LOGGER.info("Students updated.")
 
         # If we didn't see any given Student IDs when running this import, set
-        # their `hidden` value to `False`. This will hide their information from
+        # their `hidden` value to `True`. This will hide their information from
         # certain sections of the UI while retaining historical records.
         LOGGER.info("Updating hidden flag on students.")
-        for student in Student.objects.all():
-            if student.person_id not in written_students:
-                student.hidden = True
-                student.save()
+        sweep_hidden(Student, 'person_id', written_students,
+                     snapshot=self._snapshot_table(Student),
+                     **self._writes('students'))
 
     def import_guardians(self):
         """Parses all parents and guardians.
@@ -355,78 +1322,74 @@ class DJOImport():
 
         Each `CNT{number}` block is potentially a new guardian. That said, they
         are also duplicated for each student that shares parents/guardians.
+        The blocks arrive split into `GuardianRow.contacts`.
         """
 
         LOGGER.info("Importing guardians.")
 
-        guardian_reader = bytes_io_to_tsv_dict_reader(self.fs_parent)
-
-        written_guardians = []
-
-        def handle_guardian(row, i):
-            """Utility function to handle CNT{i}.
-
-            Parameters:
-                row (dict): csv.DictReader row for a student
-                i (int): Which CNT number to handle
-            """
-            cnt_n = 'CNT{0}'.format(i)
-
-            # This section is skipped if the guardian ID has been seen before.
-            # This prevents the students from being cleared from the guardians
-            # after the initial import.
-            if row[cnt_n + '_ID'] and (row[cnt_n + '_ID'] not in written_guardians):
-                try:
-                    guardian = Guardian.objects.get(
-                        person_id=row[cnt_n + '_ID'])
-                    guardian.first_name = row[cnt_n + '_FNAME']
-                    guardian.last_name = row[cnt_n + '_LNAME']
-                    guardian.email = row[cnt_n + '_EMAIL']
-                    guardian.cell_number = row[cnt_n + '_CPHONE']
-                    guardian.notify_cell = bool(row[cnt_n + '_CPHONE'])
-                    guardian.hidden = False
-                    guardian.relationship = row[cnt_n + '_REL']
-                    guardian.students.clear()  # Clear students, these will be added back later
-                    guardian.save()
-                    return guardian
-                except Guardian.DoesNotExist:
-                    guardian = Guardian(
-                        person_id=row[cnt_n + '_ID'],
-                        first_name=row[cnt_n + '_FNAME'],
-                        last_name=row[cnt_n + '_LNAME'],
-                        email=row[cnt_n + '_EMAIL'],
-                        cell_number=row[cnt_n + '_CPHONE'],
-                        notify_cell=bool(row[cnt_n + '_CPHONE']),
-                        hidden=False,
-                        relationship=row[cnt_n + '_REL']
-                    )
-                    guardian.save()
-                    return guardian
-                finally:
-                    written_guardians.append(row[cnt_n + '_ID'])
-            elif row[cnt_n + '_ID']:
-                return Guardian.objects.get(person_id=row[cnt_n + '_ID'])
-            else:
-                return None
+        guardian_reader = self._read('fs_parent')
 
+        # The guardian details are taken from the first row a guardian
+        # appears on. Every row adds a (guardian, student) link.
+        records = {}
+        links = set()
         for row in guardian_reader:
-            for i in range(1, 4):  # [1, 2, 3]
-                guardian = handle_guardian(row, i)
-                if not guardian:
+            for contact in row.contacts:
+                if contact is None:
                     continue
-                guardian.students.add(Student.objects.get(
-                    person_id=row['STUDENT_NUMBER']))
-                guardian.save()
+
+                guardian_id = contact.person_id
+                if guardian_id not in records:
+                    cell_number = self.cell_number(contact)
+                    records[guardian_id] = {
+                        'first_name': contact.first_name,
+                        'last_name': contact.last_name,
+                        'email': contact.email,
+                        'cell_number': cell_number,
+                        'notify_cell': bool(cell_number),
+                        'relationship': contact.relationship,
+                    }
+                if self.exported('fs_student', row.student_number):
+                    links.add((guardian_id, row.student_number))
+        written_guardians = set(records)
+
+        result = self._upsert('guardians', Guardian, 'person_id', records,
+                              ['first_name', 'last_name', 'email',
+                               'cell_number', 'notify_cell', 'relationship'])
+        LOGGER.info("Guardians: %d created, %d updated, %d unchanged.",
+                    *result)
+
+        guardians = self._id_map(Guardian, 'person_id')
+        students = self._id_map(Student, 'person_id')
+
+        student_links = set()
+        students_not_found = []
+        for guardian_id, student_id in links:
+            if student_id in students:
+                student_links.add((guardians[guardian_id], students[student_id]))
+            elif student_id not in students_not_found:
+                students_not_found.append(student_id)
+                self.report.add('unknown_guardian_student', guardian_id,
+                                student_id)
+
+        # Only the links of guardians in this file are reconciled. Guardians
+        # that disappeared upstream keep their students for historical records.
+        writes = self._writes('guardians')
+        added, removed = reconcile_links(
+            Guardian.students.through, 'guardian_id', 'student_id',
+            student_links,
+            sources={guardians[guardian_id] for guardian_id in written_guardians},
+            **writes)
+        self._label_links(Guardian.students.through, guardians, students)
+        LOGGER.info("Guardian links: %d added, %d removed.", added, removed)
 
         LOGGER.info("Guardians updated.")
         LOGGER.info("Setting hidden flags on Guardians.")
-
-        for guardian in Guardian.objects.all():
-            if guardian.person_id not in written_guardians:
-                guardian.hidden = True
-                guardian.save()
+        sweep_hidden(Guardian, 'person_id', written_guardians,
+                     snapshot=self._snapshot_table(Guardian), **writes)
 
         LOGGER.info("Guardians imported.")
+        return students_not_found
 
     def import_enrollment(self):
         """Parses all student enrollment data.
@@ -435,42 +1398,311 @@ class DJOImport():
         """
 
         LOGGER.info("Importing enrollment data.")
-        enrollment_reader = bytes_io_to_tsv_dict_reader(self.fs_enrollment)
+        enrollment_reader = self._read('fs_enrollment')
 
-        LOGGER.info("Clearing existing enrollment.")
-        # Start by clearing all existing enrollment
-        for section in Section.objects.all():
-            section.students.clear()
-            section.save()
-        LOGGER.info("Existing enrollment cleared.")
+        students = self._id_map(Student, 'person_id')
+        sections = self._id_map(Section, 'section_id')
 
         LOGGER.info("Updating enrollment.")
+        links = set()
         students_not_found = []
+        sections_not_found = set()
         for row in enrollment_reader:
-            try:
-                student = Student.objects.get(person_id=row['STUDENT_NUMBER'])
-                student.section_set.add(Section.objects.get(
-                    section_id=row['SECTIONID']))
-            except Student.DoesNotExist:
-                if row['STUDENT_NUMBER'] not in students_not_found:
-                    students_not_found.append(row['STUDENT_NUMBER'])
-                    LOGGER.warning('Student: {0} does not exist!'.format(
-                        row['STUDENT_NUMBER']))
+            if not (self.exported('fs_student', row.student_number)
+                    and self.exported('fs_classes', row.section_id)):
+                continue
+            student = students.get(row.student_number)
+            section = sections.get(row.section_id)
+            if student is None:
+                if row.student_number not in students_not_found:
+                    students_not_found.append(row.student_number)
+                    self.report.add('unknown_enrolled_student',
+                                    row.section_id, row.student_number)
+            elif section is None:
+                if row.section_id not in sections_not_found:
+                    sections_not_found.add(row.section_id)
+                    self.report.add('unknown_section', row.student_number,
+                                    row.section_id)
+            else:
+                links.add((section, student))
+
+        # Only touch the enrollment rows that actually changed. This keeps
+        # rosters intact while the import runs.
+        added, removed = reconcile_links(
+            Section.students.through, 'section_id', 'student_id', links,
+            **self._writes('enrollment'))
+        self._label_links(Section.students.through, sections, students)
+        LOGGER.info("Enrollment: %d added, %d removed.", added, removed)
         LOGGER.info("Enrollment updated.")
         return students_not_found
 
+    def measure_phase(self, name):
+        """Runs a phase with `run_phase` and adds its measurements to `stats`.
+
+        Rows read are the rows parsed from the files, rows written the rows
+        written by the phase's transactions and rows skipped the records that
+        were compared and left unchanged. Peak memory is the peak resident
+        memory of the phase in KiB, see `_start_peak_memory`. Phases running
+        at the same time can not be told apart and record the peak of the
+        run so far.
+
+        Parameters:
+            name (String): Name of the phase, e.g. `faculty`
+        """
+        counter = QueryCounter()
+        batches = len(self.transactions.batches)
+        self._phase_stats = Counter()
+        if not self._phases_overlap:
+            self._start_peak_memory()
+        stats = {'name': name, 'outcome': 'failed'}
+        start = time.monotonic()
+        try:
+            if name in self._resumed_phases:
+                LOGGER.info("%s was completed by import %d.",
+                            name.capitalize(), self.resume_from.id)
+                stats['outcome'] = 'resumed'
+            else:
+                with connection.execute_wrapper(counter):
+                    ran = self.run_phase(name)
+                stats['outcome'] = 'succeeded' if ran else 'skipped'
+        finally:
+            stats.update(
+                seconds=round(time.monotonic() - start, 3),
+                rows_read=self._phase_stats['rows_read'],
+                rows_written=sum(batch.rows for batch in
+                                 self.transactions.batches[batches:]
+                                 if batch.phase == name),
+                rows_skipped=self._phase_stats['rows_skipped'],
+                queries=counter.count,
+                peak_memory=peak_memory(),
+            )
+            with self._stats_lock:
+                self.stats.append(stats)
+                self._save_phases()
+            LOGGER.info("%s %s in %.2fs: %d rows read, %d written, %d "
+                        "skipped, %d queries.", name.capitalize(),
+                        stats['outcome'], stats['seconds'], stats['rows_read'],
+                        stats['rows_written'], stats['rows_skipped'],
+                        stats['queries'])
+
+    def _measure_phase_in_thread(self, name):
+        """Runs `measure_phase` in a worker thread on its own connection."""
+        try:
+            self.measure_phase(name)
+        finally:
+            connection.close()
+
+    def run_concurrently(self):
+        """Runs every phase, independent phases at the same time.
+
+        Each phase runs in a worker thread with its own database connection
+        as soon as the phases listed in `PHASES` as its dependencies
+        completed. The measurements in `stats` keep the order of `PHASES`.
+        """
+        order = [name for name, _, _ in self.PHASES]
+        self._phases_overlap = True
+        try:
+            run_phase_graph(
+                [(name, depends) for name, _, depends in self.PHASES],
+                self._measure_phase_in_thread, self.phase_workers)
+        finally:
+            self._phases_overlap = False
+            self.stats.sort(key=lambda stats: order.index(stats['name']))
+
+    def _start_peak_memory(self):
+        """Starts measuring the peak memory of a run or phase anew.
+
+        A worker runs many imports, so the peak of the whole process would
+        only show the largest import it ever ran. The peak measured so far is
+        kept for the `ImportRun` before it is reset. Where the peak can not
+        be reset, e.g. outside of Linux, the peak of the process is recorded.
+        """
+        self._run_peak_memory = max(self._run_peak_memory, peak_memory())
+        if not reset_peak_memory():
+            LOGGER.debug("Peak memory can not be reset, recording the peak "
+                         "of the process.")
+
+    def _new_run(self):
+        """Creates the `ImportRun` recording `import_all`."""
+        return ImportRun.objects.create(resumed_from=self.resume_from)
+
+    def _save_phases(self):
+        """Stores the phases completed so far, the checkpoint of a resume.
+
+        A failure to store them, e.g. because the database connection was
+        lost, must not hide the error that failed the phase.
+        """
+        if self.import_run is None:
+            return
+        self.import_run.set_phases(self.stats)
+        try:
+            self.import_run.save(update_fields=['phases'])
+        except DatabaseError:
+            LOGGER.exception("Could not store the completed import phases.")
+
+    def _save_checkpoint(self):
+        """Keeps a copy of the files until the import succeeded.
+
+        A resumed import takes over the checkpoint of the run it resumes.
+        Otherwise the files are copied into a directory of their own under
+        `checkpoint_dir`.
+        """
+        if self.resume_from is not None and self.resume_from.checkpoint:
+            path = self.resume_from.checkpoint
+            self.resume_from.checkpoint = ''
+            self.resume_from.save(update_fields=['checkpoint'])
+        elif self.checkpoint_dir:
+            path = os.path.join(self.checkpoint_dir,
+                                'run-{0}'.format(self.import_run.id))
+            os.makedirs(path, exist_ok=True)
+            for attribute, filename in EXPORT_FILES:
+                fileobj = getattr(self, attribute)
+                fileobj.seek(0)
+                with open(os.path.join(path, filename), 'wb') as checkpoint:
+                    shutil.copyfileobj(fileobj, checkpoint)
+                fileobj.seek(0)
+        else:
+            return
+        self.import_run.checkpoint = path
+        self.import_run.save(update_fields=['checkpoint'])
+
+    def _finish_run(self, status, error=''):
+        """Stores the outcome and measurements of `import_run`.
+
+        The checkpoint of a successful import is no longer needed and is
+        deleted.
+        """
+        if self.import_run is None:
+            return
+        if status == ImportRun.SUCCEEDED and self.import_run.checkpoint:
+            shutil.rmtree(self.import_run.checkpoint, ignore_errors=True)
+            self.import_run.checkpoint = ''
+        self.import_run.finished = timezone.now()
+        self.import_run.status = status
+        self.import_run.error = error
+        self.import_run.set_phases(self.stats)
+        # Validation and import problems use different categories.
+        self.import_run.set_problems(dict(self.validation_report.as_dict(),
+                                          **self.report.as_dict()))
+        self.import_run.peak_memory = max(self._run_peak_memory,
+                                          peak_memory())
+        self.import_run.save()
+
     def import_all(self):
-        """Runs all of the import functions in the correct order."""
+        """Runs all of the import functions in the correct order.
+
+        Each phase writes its rows in transactions of at most
+        `transaction_batch_size` rows. With `atomic` set the whole import runs
+        in one transaction instead. The transactions of every phase are
+        logged once the import completed.
+
+        With several `phase_workers` independent phases run concurrently, see
+        `run_concurrently`. A single transaction cannot span threads, so
+        atomic imports always run their phases one after another.
+
+        The run and the measurements of every phase are recorded in an
+        `ImportRun`, whether the import succeeds or fails. The phases are
+        stored as soon as each completes, so a run can be resumed even if
+        the process running it dies, see `Resume`.
+
+        The headers of all files are checked and the references between
+        them are validated before the first phase runs, so a file whose
+        layout changed or, depending on `validation`, a broken export fails
+        the import before anything is written.
+
+        Faculty, students and guardians are compared with a compact
+        `RosterSnapshot` rather than loaded as model instances, see
+        `load_snapshot`.
+        """
         LOGGER.info("DJO Importer started.")
-        self.import_faculty()
-        self.import_classes()
-        self.import_students()
-        self.import_guardians()
-        self.import_enrollment()
+        self.stats = []
+        self._run_peak_memory = 0
+        reset_peak_memory()
+        # Read before the new run is recorded, which makes every saved
+        # snapshot outdated.
+        self.snapshot = self.load_snapshot()
+        if not self.dry_run:
+            self.import_run = self._new_run()
+            self._save_checkpoint()
+        try:
+            self.check_headers()
+            self.validate()
+            if self.skip_unchanged:
+                self.phase_digests()
+            if self.atomic:
+                with self.transactions.atomic('all'):
+                    for name, _, _ in self.PHASES:
+                        self.measure_phase(name)
+            elif self.phase_workers > 1:
+                self.run_concurrently()
+            else:
+                for name, _, _ in self.PHASES:
+                    self.measure_phase(name)
+        except Exception as error:
+            if self.atomic:
+                # Nothing the completed phases wrote was committed.
+                for stats in self.stats:
+                    if stats['outcome'] in ('succeeded', 'skipped'):
+                        stats['outcome'] = 'rolled back'
+            self._finish_run(ImportRun.FAILED, repr(error))
+            raise
+        finally:
+            self.shutdown_parse_pool()
+        self._finish_run(ImportRun.SUCCEEDED)
+        self._save_snapshot()
+        for phase, totals in self.transactions.summary().items():
+            LOGGER.info("%s: %d rows in %d transactions (%d commits), "
+                        "%.2fs.", phase.capitalize(), totals['rows'],
+                        totals['transactions'], totals['commits'],
+                        totals['seconds'])
         LOGGER.info("DJO Importer completed.")
 
+    def import_staged(self):
+        """Runs the whole import through staging tables and set-based SQL.
+
+        See `paperlesspermission.djo_staging`. Database backends the staged
+        import does not support fall back to `import_all`. Change detection
+        does not apply to staged imports: every file is merged and the state
+        `skip_unchanged` relies on is reset, see `forget_file_states`. The
+        import is recorded as an `ImportRun`, without phases. Dry runs
+        always use `import_all`.
+
+        The files are checked with `check_headers` and `validate` before
+        anything is staged, so the `validation` policy applies like it does
+        to `import_all`.
+
+        Raises:
+            InvalidExportError: References dangle and `validation` is abort
+        """
+        if self.dry_run:
+            self.import_all()
+            return
+        if not StagingImport.is_supported():
+            LOGGER.info("Staged imports are not supported on this database, "
+                        "falling back to the ORM importer.")
+            self.import_all()
+            return
+        # The staged merge does not keep the saved snapshot up to date.
+        self.discard_snapshot()
+        self.stats = []
+        self._run_peak_memory = 0
+        reset_peak_memory()
+        self.import_run = self._new_run()
+        try:
+            self.check_headers()
+            self.validate()
+            self.forget_file_states()
+            StagingImport(self).import_all()
+        except Exception as error:
+            self._finish_run(ImportRun.FAILED, repr(error))
+            raise
+        finally:
+            self.shutdown_parse_pool()
+        self._finish_run(ImportRun.SUCCEEDED)
+
     def close(self):
-        """Closes the ByteIO buffers."""
+        """Closes the data files and stops the parse workers."""
+        self.shutdown_parse_pool()
         self.fs_classes.close()
         self.fs_enrollment.close()
         self.fs_faculty.close()
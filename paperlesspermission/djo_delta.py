@@ -0,0 +1,499 @@
+"""Imports the changes of a delta export on top of the last full import.
+
+A full export holds every record and is imported with `DJOImport`. A delta
+export only holds the records that changed upstream between two watermarks,
+so frequent syncs, e.g. every 15 minutes, only touch the changed rows.
+Full imports stay the periodic consistency check.
+
+A delta export is a directory (or any other `ImportSource`) holding:
+
+    fs_delta.txt: A single row with the SINCE and UNTIL watermarks of the
+        changes, e.g. `2020-05-06T08:00:00` and `2020-05-06T08:15:00`
+    fs_faculty.txt, fs_classes.txt, ...: Any of the export files with the
+        changed records and an extra CHANGE column, `U` for records that were
+        created or updated and `D` for records that were deleted
+
+Watermarks are opaque to the importer, but have to sort in the order they
+were taken, like ISO 8601 timestamps do. The UNTIL watermark of every
+imported delta is stored on its `ImportRun`. A delta whose UNTIL watermark
+was already reached is skipped, and a delta starting after the stored
+watermark is refused with a `DeltaGapError`, as the changes in between are
+missing. A full import holds every record and resets the watermark, so the
+first delta after it, like the very first delta, is always imported.
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from collections import namedtuple
+import logging
+
+from paperlesspermission.djo import (BULK_BATCH_SIZE, DJOImport,
+                                     InvalidExportError, bulk_upsert)
+from paperlesspermission.djo_rows import (DELETE, ROW_FORMATS, UPSERT,
+                                          RowFormat, change_format,
+                                          read_changes)
+from paperlesspermission.djo_sources import EXPORT_FILES, close_files
+from paperlesspermission.models import (Guardian, Student, Faculty, Course,
+                                        Section, ImportRun)
+from paperlesspermission.utils import chunked
+
+LOGGER = logging.getLogger(__name__)
+
+DeltaWindow = namedtuple('DeltaWindow', ['since', 'until'])
+
+MANIFEST_FORMAT = RowFormat('fs_delta.txt', ['SINCE', 'UNTIL'],
+                            DeltaWindow._make)
+
+# The files of a delta export. Only fs_delta.txt is required.
+DELTA_FILES = (('fs_delta', 'fs_delta.txt'),) + EXPORT_FILES
+
+
+class DeltaGapError(ValueError):
+    """A delta export starts after the last imported watermark."""
+
+
+def current_watermark():
+    """Returns the watermark the roster was brought up to, or `None`.
+
+    That is the watermark of the last successful import if it was a delta,
+    and `None` if it was a full import or there was none.
+    """
+    return ImportRun.objects.filter(status=ImportRun.SUCCEEDED).order_by(
+        '-started', '-id').values_list('watermark', flat=True).first() or None
+
+
+class DeltaImport(DJOImport):
+    """Imports a delta export, see the module documentation.
+
+    Upserted records are created or updated and unhidden, deleted faculty,
+    students and sections are hidden, like a full import hides the records
+    missing from its files. Deleted enrollment rows remove the enrollment.
+    A guardian row lists all contacts of a student, so the student's
+    guardian links are made to match it, and a deleted guardian row removes
+    them all. Courses and guardians are never hidden by a delta, as other
+    sections or students may still reference them; the next full import
+    hides them if they are gone.
+
+    Every query is restricted to the keys in the delta, so an import of a
+    few changes does not load whole tables. The delta is imported in a
+    single transaction and recorded as an `ImportRun` with its watermark.
+    References are resolved against the database, which holds the records
+    imported earlier, so `validate` does not check them.
+
+    Attributes:
+        fs_delta (file): The fs_delta.txt file
+        window (DeltaWindow): Watermarks of the delta, read by `import_all`
+    """
+
+    def __init__(self, fs_delta, fs_classes=None, fs_faculty=None,
+                 fs_student=None, fs_parent=None, fs_enrollment=None,
+                 **kwargs):
+        # Deltas are small: they always run in one transaction, compare every
+        # record and are fetched again instead of being resumed.
+        kwargs.update(atomic=True, skip_unchanged=False, checkpoint_dir=None,
+                      resume_from=None, snapshot_path=None)
+        super().__init__(fs_classes, fs_faculty, fs_student, fs_parent,
+                         fs_enrollment, **kwargs)
+        self.fs_delta = fs_delta
+        self.window = None
+
+    @classmethod
+    def FromSource(cls, source, **kwargs):
+        """Constructor for `DeltaImport` class that reads from an import source.
+
+        Raises:
+            FileNotFoundError: The source holds no fs_delta.txt
+        """
+        files = source.fetch(DELTA_FILES, required=False)
+        if 'fs_delta' not in files:
+            close_files(files)
+            raise FileNotFoundError('The delta export has no fs_delta.txt.')
+        return cls(**files, **kwargs)
+
+    def read_window(self):
+        """Returns the watermarks of the delta from fs_delta.txt.
+
+        Raises:
+            InvalidExportError: fs_delta.txt does not hold exactly one row
+                with an UNTIL watermark
+        """
+        rows = list(MANIFEST_FORMAT.read(self.fs_delta))
+        if len(rows) != 1 or not rows[0].until:
+            raise InvalidExportError('fs_delta.txt has to hold a single row '
+                                     'with the UNTIL watermark.')
+        return rows[0]
+
+    def check_headers(self):
+        """Checks the header of fs_delta.txt and of every changed file."""
+        MANIFEST_FORMAT.check_header(self.fs_delta)
+        for attribute in ROW_FORMATS:
+            fileobj = getattr(self, attribute)
+            if fileobj is not None:
+                change_format(attribute).check_header(fileobj)
+
+    def validate(self):
+        """Skipped, a delta references records imported before it."""
+        return 0
+
+    def load_snapshot(self):
+        """Skipped, a delta only reads the rows of the keys it holds."""
+        return None
+
+    def run_phase(self, name):
+        """Runs phase `name` if the delta holds its file."""
+        for phase, attribute, _ in self.PHASES:
+            if phase == name and getattr(self, attribute) is None:
+                LOGGER.info("No %s changes.", name)
+                return False
+        getattr(self, 'import_' + name)()
+        return True
+
+    def _new_run(self):
+        return ImportRun.objects.create(delta=True,
+                                        watermark=self.window.until)
+
+    def _changes(self, attribute, key):
+        """Returns the last change of every record in a delta file.
+
+        Parameters:
+            attribute (String): Attribute holding the file, e.g. `fs_faculty`
+            key (callable): Returns the key of a row
+
+        Returns:
+            tuple: Dicts of the upserted and of the deleted rows by key
+        """
+        upserts, deletes = {}, {}
+        for change, row in read_changes(attribute, getattr(self, attribute)):
+            self._phase_stats['rows_read'] += 1
+            record_id = key(row)
+            if change not in (UPSERT, DELETE):
+                self.report.add('unknown_change', record_id, change)
+                continue
+            upserts.pop(record_id, None)
+            deletes.pop(record_id, None)
+            (upserts if change == UPSERT else deletes)[record_id] = row
+        return upserts, deletes
+
+    def _ids(self, model, key_field, keys):
+        """Returns a map of the given `key_field` values to primary keys.
+
+        Like `_id_map`, but only the rows of `keys` are loaded.
+        """
+        ids = {}
+        for chunk in chunked(list(keys), BULK_BATCH_SIZE):
+            ids.update(model.objects.filter(
+                **{key_field + '__in': chunk}).values_list(key_field, 'id'))
+        if self.dry_run:
+            for key in self.diff.created(model._meta.model_name):
+                ids.setdefault(key, ('new', key))
+        return ids
+
+    def _upsert_keys(self, name, model, key_field, records, fields,
+                     defaults=None):
+        """Runs `bulk_upsert` loading only the rows of `records`."""
+        result = bulk_upsert(model, key_field, records, fields,
+                             defaults=defaults, load_all=False,
+                             **self._writes(name))
+        self._phase_stats['rows_skipped'] += result.unchanged
+        LOGGER.info("%s: %d created, %d updated, %d unchanged.",
+                    model.__name__, *result)
+        return result
+
+    def _set_hidden(self, name, model, key_field, keys, hidden):
+        """Sets the `hidden` flag of the rows of `keys` that differ.
+
+        Returns:
+            int: Number of rows whose flag changed
+        """
+        key_in = key_field + '__in'
+        changed = []
+        for chunk in chunked(list(keys), BULK_BATCH_SIZE):
+            changed.extend(model.objects.filter(
+                **{key_in: chunk, 'hidden': not hidden}).values_list(
+                    key_field, flat=True))
+
+        writes = self._writes(name)
+        writes['batches'](changed, lambda chunk: model.objects.filter(
+            **{key_in: chunk}).update(hidden=hidden))
+        if writes['diff'] is not None:
+            writes['diff'].record(model._meta.model_name,
+                                  'hidden' if hidden else 'unhidden', changed)
+        return len(changed)
+
+    def _links(self, through, source_field, target_field, lookup, keys):
+        """Returns the links whose `lookup` column is one of `keys`.
+
+        Returns:
+            dict: Maps (source pk, target pk) pairs to the link's id
+        """
+        current = {}
+        for chunk in chunked(list(keys), BULK_BATCH_SIZE):
+            for link_id, source, target in through.objects.filter(
+                    **{lookup + '__in': chunk}).values_list(
+                        'id', source_field, target_field):
+                current[(source, target)] = link_id
+        return current
+
+    def _write_links(self, name, through, source_field, target_field, added,
+                     removed):
+        """Inserts the `added` pairs and deletes the `removed` links.
+
+        Parameters:
+            added (list): (source pk, target pk) pairs to insert
+            removed (dict): Maps (source pk, target pk) pairs to the id of
+                the link to delete
+
+        Returns:
+            tuple: Number of links added and number of links removed
+        """
+        writes = self._writes(name)
+        if writes['diff'] is not None:
+            writes['diff'].record(through._meta.model_name, 'added', added)
+            writes['diff'].record(through._meta.model_name, 'removed',
+                                  removed)
+        writes['batches'](
+            [through(**{source_field: source, target_field: target})
+             for source, target in added],
+            lambda chunk: through.objects.bulk_create(
+                chunk, batch_size=BULK_BATCH_SIZE))
+        writes['batches'](list(removed.values()), lambda chunk: [
+            through.objects.filter(id__in=ids).delete()
+            for ids in chunked(chunk, BULK_BATCH_SIZE)])
+        return len(added), len(removed)
+
+    def _forget(self, name, keys):
+        """Makes the next full import compare the records of `keys` again.
+
+        A full import with `skip_unchanged` skips files and rows that did not
+        change since it last ran, which would keep the changes of a delta even
+        where the full export disagrees with them.
+        """
+        if self.dry_run:
+            return
+        state = self._file_state(name)
+        fingerprints = state.get_row_fingerprints()
+        for key in keys:
+            fingerprints.pop(key, None)
+        state.digest = ''
+        state.set_row_fingerprints(fingerprints)
+        state.save()
+
+    def import_faculty(self):
+        """Imports the changed faculty."""
+        upserts, deletes = self._changes('fs_faculty',
+                                         lambda row: row.record_id)
+        records = {record_id: {
+            'first_name': row.first_name,
+            'last_name': row.last_name,
+            'email': row.email,
+            'preferred_name': row.preferred_name,
+        } for record_id, row in upserts.items()}
+        self._upsert_keys('faculty', Faculty, 'person_id', records,
+                          ['first_name', 'last_name', 'email',
+                           'preferred_name'],
+                          defaults={'notify_cell': False})
+        self._set_hidden('faculty', Faculty, 'person_id', upserts, False)
+        self._set_hidden('faculty', Faculty, 'person_id', deletes, True)
+        self._forget('faculty', list(upserts) + list(deletes))
+
+    def import_classes(self):
+        """Imports the changed sections and their courses.
+
+        Teachers are resolved like in `DJOImport.import_classes`.
+        """
+        upserts, deletes = self._changes('fs_classes',
+                                         lambda row: row.record_id)
+
+        course_records = {}
+        for row in upserts.values():
+            course_records.setdefault(row.course_number,
+                                      {'course_name': row.course_name})
+        self._upsert_keys('classes', Course, 'course_number', course_records,
+                          ['course_name'])
+        self._set_hidden('classes', Course, 'course_number', course_records,
+                         False)
+
+        courses = self._ids(Course, 'course_number', course_records)
+        faculty = self._ids(Faculty, 'person_id', {
+            person_id for row in upserts.values()
+            for person_id in (row.teacher, row.coteacher) if person_id})
+
+        def resolve_teacher(row, field):
+            """Returns the Faculty primary key referenced by `row.<field>`."""
+            person_id = getattr(row, field)
+            if not person_id:
+                return None
+            if person_id not in faculty:
+                self.report.add('unknown_' + field, row.record_id, person_id)
+                return None
+            return faculty[person_id]
+
+        section_records = {section_id: {
+            'course_id': courses[row.course_number],
+            'section_number': row.section_number,
+            'teacher_id': resolve_teacher(row, 'teacher'),
+            'coteacher_id': resolve_teacher(row, 'coteacher'),
+            'school_year': row.school_year,
+            'room': row.room,
+            'period': row.expression,
+        } for section_id, row in upserts.items()}
+        self._upsert_keys('classes', Section, 'section_id', section_records,
+                          ['course_id', 'section_number', 'teacher_id',
+                           'coteacher_id', 'school_year', 'room', 'period'])
+        self._set_hidden('classes', Section, 'section_id', upserts, False)
+        self._set_hidden('classes', Section, 'section_id', deletes, True)
+        self._forget('classes', list(upserts) + list(deletes))
+
+    def import_students(self):
+        """Imports the changed students."""
+        upserts, deletes = self._changes('fs_student',
+                                         lambda row: row.record_id)
+        records = {record_id: {
+            'grade_level': row.grade_level,
+            'first_name': row.first_name,
+            'last_name': row.last_name,
+            'email': row.email,
+            'notify_cell': False,
+        } for record_id, row in upserts.items()}
+        self._upsert_keys('students', Student, 'person_id', records,
+                          ['grade_level', 'first_name', 'last_name', 'email',
+                           'notify_cell'])
+        self._set_hidden('students', Student, 'person_id', upserts, False)
+        self._set_hidden('students', Student, 'person_id', deletes, True)
+        self._forget('students', list(upserts) + list(deletes))
+
+    def import_guardians(self):
+        """Imports the changed guardians and their links to students."""
+        upserts, deletes = self._changes('fs_parent',
+                                         lambda row: row.student_number)
+
+        records = {}
+        for row in upserts.values():
+            for contact in row.contacts:
+                if contact is not None and contact.person_id not in records:
+                    cell_number = self.cell_number(contact)
+                    records[contact.person_id] = {
+                        'first_name': contact.first_name,
+                        'last_name': contact.last_name,
+                        'email': contact.email,
+                        'cell_number': cell_number,
+                        'notify_cell': bool(cell_number),
+                        'relationship': contact.relationship,
+                    }
+        self._upsert_keys('guardians', Guardian, 'person_id', records,
+                          ['first_name', 'last_name', 'email', 'cell_number',
+                           'notify_cell', 'relationship'])
+        self._set_hidden('guardians', Guardian, 'person_id', records, False)
+
+        guardians = self._ids(Guardian, 'person_id', records)
+        students = self._ids(Student, 'person_id',
+                             list(upserts) + list(deletes))
+        links = set()
+        for student_number, row in upserts.items():
+            for contact in row.contacts:
+                if contact is None:
+                    continue
+                if student_number not in students:
+                    self.report.add('unknown_guardian_student',
+                                    contact.person_id, student_number)
+                else:
+                    links.add((guardians[contact.person_id],
+                               students[student_number]))
+
+        through = Guardian.students.through
+        current = self._links(through, 'guardian_id', 'student_id',
+                              'student_id', students.values())
+        added, removed = self._write_links(
+            'guardians', through, 'guardian_id', 'student_id',
+            [pair for pair in links if pair not in current],
+            {pair: link_id for pair, link_id in current.items()
+             if pair not in links})
+        self._label_links(through, guardians, students)
+        LOGGER.info("Guardian links: %d added, %d removed.", added, removed)
+        self._forget('guardians', records)
+
+    def import_enrollment(self):
+        """Imports the changed enrollments."""
+        upserts, deletes = self._changes(
+            'fs_enrollment', lambda row: (row.student_number, row.section_id))
+        changed = list(upserts) + list(deletes)
+        students = self._ids(Student, 'person_id',
+                             {student for student, _ in changed})
+        sections = self._ids(Section, 'section_id',
+                             {section for _, section in changed})
+
+        through = Section.students.through
+        current = self._links(through, 'section_id', 'student_id',
+                              'student_id', students.values())
+        added = []
+        for student_number, section_id in upserts:
+            if student_number not in students:
+                self.report.add('unknown_enrolled_student', section_id,
+                                student_number)
+            elif section_id not in sections:
+                self.report.add('unknown_section', student_number,
+                                section_id)
+            else:
+                pair = (sections[section_id], students[student_number])
+                if pair not in current:
+                    added.append(pair)
+        # Deleted enrollments of unknown students or sections are gone.
+        removed = {}
+        for student_number, section_id in deletes:
+            pair = (sections.get(section_id), students.get(student_number))
+            if pair in current:
+                removed[pair] = current[pair]
+        added, removed = self._write_links('enrollment', through,
+                                           'section_id', 'student_id',
+                                           added, removed)
+        self._label_links(through, sections, students)
+        LOGGER.info("Enrollment: %d added, %d removed.", added, removed)
+        self._forget('enrollment', ())
+
+    def import_all(self):
+        """Imports the delta, unless it was imported already.
+
+        Raises:
+            DeltaGapError: The delta starts after the watermark of the last
+                imported delta
+        """
+        self.check_headers()
+        self.window = self.read_window()
+        watermark = current_watermark()
+        if watermark is not None:
+            if self.window.until <= watermark:
+                LOGGER.info("Changes up to %s were imported already, "
+                            "skipping the delta.", self.window.until)
+                return
+            if self.window.since > watermark:
+                raise DeltaGapError(
+                    'The delta starts at {0}, but only the changes up to {1} '
+                    'were imported. Run a full import.'.format(
+                        self.window.since, watermark))
+        LOGGER.info("Importing the changes from %s to %s.",
+                    self.window.since or 'the start', self.window.until)
+        super().import_all()
+
+    def import_staged(self):
+        """Runs `import_all`, deltas are too small for staging tables."""
+        self.import_all()
+
+    def close(self):
+        """Closes the data files."""
+        self.fs_delta.close()
+        for attribute, _ in EXPORT_FILES:
+            fileobj = getattr(self, attribute)
+            if fileobj is not None:
+                fileobj.close()
@@ -0,0 +1,101 @@
+"""Collects the changes made by a roster import.
+
+`DJOImport(dry_run=True)` works out every change an import would make with
+bulk reads only and records them in an `ImportDiff` instead of writing them,
+see the `--dry-run` option of the `import` management command.
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+def skip_writes(items, write):
+    """A `batches` argument for the bulk helpers in `djo` that never writes."""
+    return []
+
+
+class ImportDiff():
+    """The changes of an import, grouped by table and kind of change.
+
+    Tables are named after their model, e.g. `student`, or
+    `section_students` for the enrollment links. The kinds of changes are:
+
+        created:   Keys of new rows
+        updated:   [key, [changed fields]] of existing rows
+        hidden:    Keys of rows that disappeared upstream
+        unhidden:  Keys of hidden rows that reappeared upstream
+        added:     [source, target] links that are added
+        removed:   [source, target] links that are removed
+
+    Links are recorded with primary keys. `label_links` registers the
+    upstream keys they are shown as.
+
+    Attributes:
+        changes (dict): Maps each table to a dict of change lists
+    """
+
+    def __init__(self):
+        self.changes = {}
+        self._labels = {}
+
+    def record(self, table, change, items):
+        """Adds `items` to the `change` list of `table`.
+
+        Parameters:
+            table (String): Name of the changed table, e.g. `student`
+            change (String): Kind of change, e.g. `created`
+            items (iterable): Changed keys, [key, fields] or [source, target]
+        """
+        items = list(items)
+        if items:
+            self.changes.setdefault(table, {}).setdefault(
+                change, []).extend(items)
+
+    def created(self, table):
+        """Returns the keys of the rows created in `table`."""
+        return self.changes.get(table, {}).get('created', [])
+
+    def label_links(self, table, source_labels, target_labels):
+        """Sets how the primary keys of the links in `table` are shown.
+
+        Parameters:
+            table (String): Name of the link table, e.g. `section_students`
+            source_labels (dict): Maps source primary keys to upstream keys
+            target_labels (dict): Maps target primary keys to upstream keys
+        """
+        self._labels[table] = (source_labels, target_labels)
+
+    def summary(self):
+        """Returns the number of changes of each kind per table."""
+        return {table: {change: len(items) for change, items in changes.items()}
+                for table, changes in self.changes.items()}
+
+    def as_dict(self):
+        """Returns the changes as a plain, JSON serializable dict."""
+        result = {}
+        for table, changes in self.changes.items():
+            sources, targets = self._labels.get(table, ({}, {}))
+            result[table] = {}
+            for change, items in sorted(changes.items()):
+                if change in ('added', 'removed'):
+                    items = [[sources.get(source, source),
+                              targets.get(target, target)]
+                             for source, target in items]
+                result[table][change] = sorted(
+                    list(item) if isinstance(item, tuple) else item
+                    for item in items)
+        return result
+
+    def __bool__(self):
+        return bool(self.changes)
@@ -0,0 +1,151 @@
+"""Makes sure only one DJO import runs at a time.
+
+Two imports running side by side would both sweep hidden rows and reconcile
+the enrollment links, doubling the load on the database and leaving the
+roster in a mix of both runs. `ImportLock` is a lease held in the cache,
+which every Celery worker and web server shares, for as long as an import
+runs. The lease expires on its own, so a worker that dies halfway through an
+import cannot block imports forever.
+
+Triggers that arrive while an import is queued or running are coalesced: a
+trigger during a run requests a single follow-up run, however many triggers
+arrive, and a trigger while a run is queued is dropped.
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from uuid import uuid4
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+LOGGER = logging.getLogger(__name__)
+
+LOCK_KEY = 'paperlesspermission:djo_import:lock'
+QUEUED_KEY = 'paperlesspermission:djo_import:queued'
+FOLLOW_UP_KEY = 'paperlesspermission:djo_import:follow_up'
+
+# Seconds an import may hold the lock before it expires. Imports normally
+# take minutes; the lease only has to outlive the slowest one.
+LOCK_TIMEOUT = 2 * 60 * 60
+
+
+class ImportLock():
+    """Cache-backed lease that only one import can hold at a time.
+
+    The lease is taken with the cache's atomic `add`, so of several workers
+    trying at once exactly one succeeds. Every lease has a random token and
+    is only released by its holder, so an import that outlived its lease
+    cannot release the lease of the next one.
+
+    Attributes:
+        timeout (int): Seconds until the lease expires, defaults to the
+            `DJO_IMPORT_LOCK_TIMEOUT` setting
+        token (String): Token of the lease while it is held, else `None`
+    """
+
+    # Outcomes of `trigger`.
+    QUEUED = 'queued'
+    ALREADY_QUEUED = 'already queued'
+    FOLLOW_UP = 'follow-up requested'
+
+    def __init__(self, timeout=None):
+        if timeout is None:
+            timeout = getattr(settings, 'DJO_IMPORT_LOCK_TIMEOUT', LOCK_TIMEOUT)
+        self.timeout = timeout
+        self.token = None
+
+    @staticmethod
+    def is_running():
+        """Returns whether any import currently holds the lease."""
+        return cache.get(LOCK_KEY) is not None
+
+    @staticmethod
+    def follow_up_requested():
+        """Returns whether a run was requested while the current one runs."""
+        return bool(cache.get(FOLLOW_UP_KEY))
+
+    def trigger(self, queue):
+        """Queues an import, unless one is queued or running already.
+
+        Parameters:
+            queue (callable): Queues the import task, e.g. its `delay`
+
+        Returns:
+            String: `QUEUED` if `queue` was called, `ALREADY_QUEUED` if an
+                import was queued already and `FOLLOW_UP` if the running
+                import will be followed by another one
+        """
+        if self.is_running():
+            cache.set(FOLLOW_UP_KEY, True, self.timeout)
+            # The import may have finished before it could see the request,
+            # in which case a new import is queued below instead.
+            if self.is_running():
+                return self.FOLLOW_UP
+            cache.delete(FOLLOW_UP_KEY)
+
+        if cache.add(QUEUED_KEY, True, self.timeout):
+            queue()
+            return self.QUEUED
+        return self.ALREADY_QUEUED
+
+    def acquire(self, coalesce=True):
+        """Takes the lease for an import that is about to start.
+
+        The queued import is marked as started either way, so new triggers
+        are no longer dropped. If another import holds the lease, a
+        follow-up run is requested instead.
+
+        Parameters:
+            coalesce (bool): Whether the import is the triggered full import.
+                Delta imports pass `False`: they leave the queued import
+                alone and are dropped while another import runs, as the next
+                delta picks up their changes.
+
+        Returns:
+            bool: Whether the lease was taken
+        """
+        if coalesce:
+            cache.delete(QUEUED_KEY)
+        token = uuid4().hex
+        if cache.add(LOCK_KEY, token, self.timeout):
+            self.token = token
+            return True
+        if coalesce:
+            cache.set(FOLLOW_UP_KEY, True, self.timeout)
+            LOGGER.info("Another import is running, requested a follow-up "
+                        "run.")
+        return False
+
+    def release(self):
+        """Gives up the lease.
+
+        The lease is given up before the follow-up request is read: a trigger
+        that still sees the lease requests a follow-up this call reads, and a
+        trigger that no longer sees it queues an import itself.
+
+        Returns:
+            bool: Whether a follow-up run was requested during the import
+        """
+        if self.token is not None and cache.get(LOCK_KEY) == self.token:
+            cache.delete(LOCK_KEY)
+        elif self.token is not None:
+            LOGGER.warning("The import outlived its %d second lease.",
+                           self.timeout)
+        self.token = None
+        follow_up = self.follow_up_requested()
+        cache.delete(FOLLOW_UP_KEY)
+        return follow_up
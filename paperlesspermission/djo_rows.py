@@ -0,0 +1,327 @@
+"""Typed rows of the SQLRunner export files.
+
+Every export file is parsed into namedtuples of its own row type. The header
+of a file is checked once, before its first row is read, and the position of
+every column is resolved from it, so each row costs a single tuple instead
+of a dict keyed by the header. A file whose header lacks a column fails
+right away with a `HeaderError` naming the missing columns, instead of with
+a `KeyError` halfway through an import.
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from collections import deque, namedtuple
+from csv import reader as csv_reader
+from functools import lru_cache
+from io import BytesIO
+from operator import itemgetter
+
+import phonenumbers
+
+from paperlesspermission.utils import iter_text_lines
+
+FACULTY_COLUMNS = ['RECORDID', 'FIRST_NAME', 'LAST_NAME', 'EMAIL_ADDR',
+                   'PREFERREDNAME']
+CLASSES_COLUMNS = ['RECORDID', 'COURSE_NUMBER', 'SECTION_NUMBER', 'TERMID',
+                   'SCHOOLYEAR', 'TEACHER', 'ROOM', 'COURSE_NAME',
+                   'EXPRESSION', 'COTEACHER']
+STUDENT_COLUMNS = ['RECORDID', 'GRADE_LEVEL', 'FIRST_NAME', 'LAST_NAME',
+                   'EMAIL']
+CONTACT_FIELDS = ('ID', 'FNAME', 'LNAME', 'REL', 'CPHONE', 'EMAIL')
+PARENT_COLUMNS = ['STUDENT_NUMBER'] + [
+    'CNT{0}_{1}'.format(i, column) for i in range(1, 4)
+    for column in CONTACT_FIELDS]
+ENROLLMENT_COLUMNS = ['STUDENT_NUMBER', 'SECTIONID']
+
+# Bytes of a file parsed at a time by a worker of `read_rows_parallel`. Big
+# enough to outweigh sending the chunk to the worker and the rows back.
+PARSE_CHUNK_SIZE = 2 * 1024 * 1024
+
+# Region of the phone numbers in the exports that lack a country code.
+PHONE_REGION = 'US'
+
+# Number of distinct raw phone numbers `normalize_phone` remembers. Siblings
+# share their guardians' numbers, so a parent file holds far fewer distinct
+# numbers than contact blocks.
+PHONE_CACHE_SIZE = 4096
+
+# Delta exports have the columns of the full export plus a CHANGE column
+# telling whether the row was upserted or deleted upstream.
+CHANGE_COLUMN = 'CHANGE'
+UPSERT = 'U'
+DELETE = 'D'
+
+FacultyRow = namedtuple('FacultyRow', ['record_id', 'first_name', 'last_name',
+                                       'email', 'preferred_name'])
+SectionRow = namedtuple('SectionRow', ['record_id', 'course_number',
+                                       'section_number', 'term_id',
+                                       'school_year', 'teacher', 'room',
+                                       'course_name', 'expression',
+                                       'coteacher'])
+StudentRow = namedtuple('StudentRow', ['record_id', 'grade_level',
+                                       'first_name', 'last_name', 'email'])
+ContactRow = namedtuple('ContactRow', ['person_id', 'first_name', 'last_name',
+                                       'relationship', 'cell_phone', 'email'])
+# `contacts` holds the CNT1, CNT2 and CNT3 blocks in order, `None` where a
+# block is empty.
+GuardianRow = namedtuple('GuardianRow', ['student_number', 'contacts'])
+EnrollmentRow = namedtuple('EnrollmentRow', ['student_number', 'section_id'])
+
+
+class HeaderError(ValueError):
+    """An export file does not have the columns the importer reads."""
+
+
+def _guardian_row(values):
+    """Builds a `GuardianRow`, splitting the three contact blocks."""
+    width = len(CONTACT_FIELDS)
+    contacts = []
+    for start in range(1, 1 + 3 * width, width):
+        block = values[start:start + width]
+        contacts.append(ContactRow._make(block) if block[0] else None)
+    return GuardianRow(values[0], tuple(contacts))
+
+
+class RowFormat():
+    """Layout of an export file and the row type it is parsed into.
+
+    Attributes:
+        filename (String): Name of the exported file
+        columns (list): Columns read from the file, in the order `make`
+            expects their values
+        make (callable): Builds a row from a tuple of column values
+    """
+
+    def __init__(self, filename, columns, make):
+        self.filename = filename
+        self.columns = columns
+        self.make = make
+
+    def indexes(self, header):
+        """Returns the position of every column in `header`.
+
+        Raises:
+            HeaderError: `header` lacks some of the columns
+        """
+        positions = {column: index for index, column in enumerate(header)}
+        missing = [column for column in self.columns
+                   if column not in positions]
+        if missing:
+            raise HeaderError('{0} is missing the column(s) {1}, its header '
+                              'is: {2}'.format(self.filename,
+                                               ', '.join(missing),
+                                               ' '.join(header)))
+        return [positions[column] for column in self.columns]
+
+    def check_header(self, fileobj):
+        """Checks the header of `fileobj` without reading any further.
+
+        Raises:
+            HeaderError: The header lacks some of the columns
+        """
+        lines = iter_text_lines(fileobj)
+        header = next(csv_reader(lines, delimiter='\t'), [])
+        lines.close()
+        fileobj.seek(0)
+        self.indexes(header)
+
+    def read(self, fileobj):
+        """Yields the rows of the binary TSV file `fileobj`.
+
+        Blank lines are skipped and missing trailing values are read as
+        empty strings.
+
+        Raises:
+            HeaderError: The header lacks some of the columns
+        """
+        rows = csv_reader(iter_text_lines(fileobj), delimiter='\t')
+        indexes = self.indexes(next(rows, []))
+        width = max(indexes) + 1
+        get = itemgetter(*indexes)
+        make = self.make
+        for values in rows:
+            if not values:
+                continue
+            if len(values) < width:
+                values += [''] * (width - len(values))
+            yield make(get(values))
+
+
+# The format of every export file, keyed by the `DJOImport` attribute that
+# holds it.
+ROW_FORMATS = {
+    'fs_faculty': RowFormat('fs_faculty.txt', FACULTY_COLUMNS,
+                            FacultyRow._make),
+    'fs_classes': RowFormat('fs_classes.txt', CLASSES_COLUMNS,
+                            SectionRow._make),
+    'fs_student': RowFormat('fs_student.txt', STUDENT_COLUMNS,
+                            StudentRow._make),
+    'fs_parent': RowFormat('fs_parent.txt', PARENT_COLUMNS, _guardian_row),
+    'fs_enrollment': RowFormat('fs_enrollment.txt', ENROLLMENT_COLUMNS,
+                               EnrollmentRow._make),
+}
+
+
+def read_rows(attribute, fileobj):
+    """Yields the typed rows of the export file held in `attribute`.
+
+    Parameters:
+        attribute (String): `DJOImport` attribute of the file, e.g.
+            `fs_faculty`
+        fileobj (file): Binary file object holding the TSV data
+    """
+    return ROW_FORMATS[attribute].read(fileobj)
+
+
+def split_lines(fileobj, chunk_size=PARSE_CHUNK_SIZE):
+    """Splits a binary TSV file into its header and chunks of whole lines.
+
+    Every chunk holds at least `chunk_size` bytes, except the last, and
+    ends on a line boundary outside of a quoted value, so each can be parsed
+    on its own.
+
+    Returns:
+        tuple: The header line and an iterator over the chunks
+    """
+    fileobj.seek(0)
+    header = fileobj.readline()
+
+    def chunks():
+        while True:
+            data = fileobj.read(chunk_size)
+            if not data:
+                return
+            data += fileobj.readline()
+            # An odd number of quotes means the chunk ends inside a quoted
+            # value that spans lines.
+            while data.count(b'"') % 2:
+                line = fileobj.readline()
+                if not line:
+                    break
+                data += line
+            yield data
+
+    return header, chunks()
+
+
+def parse_chunk(attribute, header, data):
+    """Returns the typed rows of a chunk from `split_lines`.
+
+    Runs in the worker processes of `read_rows_parallel`, so it only deals
+    in picklable values.
+    """
+    return list(read_rows(attribute, BytesIO(header + data)))
+
+
+def read_rows_parallel(attribute, fileobj, executor, workers,
+                       chunk_size=PARSE_CHUNK_SIZE):
+    """Yields the same rows as `read_rows`, parsed by a process pool.
+
+    The file is split into chunks of whole lines which `executor` parses
+    and turns into typed rows, each chunk in a single task. The rows are
+    yielded in file order, and at most twice as many chunks as there are
+    `workers` are in flight, so memory stays bounded however large the
+    file. A file of a single chunk is parsed in the calling process.
+
+    Parameters:
+        attribute (String): `DJOImport` attribute of the file, e.g.
+            `fs_parent`
+        fileobj (file): Binary file object holding the TSV data
+        executor (concurrent.futures.Executor): Pool parsing the chunks
+        workers (int): Number of workers of `executor`
+        chunk_size (int): Bytes per chunk, see `split_lines`
+
+    Raises:
+        HeaderError: The header lacks some of the columns
+    """
+    ROW_FORMATS[attribute].check_header(fileobj)
+    header, chunks = split_lines(fileobj, chunk_size)
+    first = next(chunks, b'')
+    second = next(chunks, None)
+    if second is None:
+        yield from parse_chunk(attribute, header, first)
+        return
+
+    pending = deque(executor.submit(parse_chunk, attribute, header, data)
+                    for data in (first, second))
+    try:
+        for data in chunks:
+            pending.append(executor.submit(parse_chunk, attribute, header,
+                                           data))
+            while len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def change_format(attribute):
+    """Returns the `RowFormat` of the delta export file of `attribute`.
+
+    Its rows are (change, row) pairs, where change is the raw value of the
+    CHANGE column, normally `UPSERT` or `DELETE`, and row is the row type of
+    the full export file.
+    """
+    row_format = ROW_FORMATS[attribute]
+    make = row_format.make
+    return RowFormat(row_format.filename, [CHANGE_COLUMN] + row_format.columns,
+                     lambda values: (values[0], make(values[1:])))
+
+
+def read_changes(attribute, fileobj):
+    """Yields the (change, row) pairs of a delta export file.
+
+    Parameters:
+        attribute (String): `DJOImport` attribute of the file, e.g.
+            `fs_faculty`
+        fileobj (file): Binary file object holding the TSV data
+    """
+    return change_format(attribute).read(fileobj)
+
+
+@lru_cache(maxsize=PHONE_CACHE_SIZE)
+def normalize_phone(raw, region=PHONE_REGION):
+    """Returns the E.164 form of a phone number from an export file.
+
+    Parsing a phone number is slow and the same numbers appear on the row of
+    every sibling, so the results are memoized.
+
+    Numbers of a length no number of their region has, and local numbers
+    missing their area code, cannot be texted and are rejected. The number
+    plan is not checked any further, as a new area code would then be
+    rejected until the phone number metadata caught up with it.
+
+    Parameters:
+        raw (String): Phone number as exported, e.g. `703-555-1111`
+        region (String): Region of numbers without a country code
+
+    Returns:
+        String: The number in E.164 form, e.g. `+17035551111`, an empty
+            string if `raw` is empty or `None` if it cannot be parsed or is
+            not a possible number
+    """
+    if not raw.strip():
+        return ''
+    try:
+        number = phonenumbers.parse(raw, region)
+    except phonenumbers.NumberParseException:
+        return None
+    if (phonenumbers.is_possible_number_with_reason(number)
+            != phonenumbers.ValidationResult.IS_POSSIBLE):
+        return None
+    return phonenumbers.format_number(number,
+                                      phonenumbers.PhoneNumberFormat.E164)
@@ -0,0 +1,250 @@
+"""Compact in-memory snapshot of the roster for import diffing.
+
+To work out what an import changes, every faculty member, student and
+guardian has to be compared with the incoming rows. Loading them as model
+instances costs several KiB per row, hundreds of MB for a district-sized
+roster. A `RosterSnapshot` instead holds the compared fields only, read with
+one `values_list` query per table: upstream IDs are interned, primary keys
+live in an `array` column and the values of every row in a namedtuple, a
+tuple with `__slots__` and no per-instance dict. The same roster fits in
+tens of MB.
+
+A snapshot can be saved to disk after a successful import and loaded by the
+next one, which can then diff the export against it without reading the
+people tables at all. A saved snapshot is only used while the import that
+saved it is still the latest recorded import, so a failed, delta, resumed
+or staged import in between makes the next import read the database again.
+Edits made through the admin panel are not noticed until then, just like
+with `DJOImport(skip_unchanged=True)`.
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from array import array
+from collections import namedtuple
+import gzip
+import json
+import logging
+import os
+import sys
+
+from paperlesspermission.models import Faculty, Guardian, ImportRun, Student
+from paperlesspermission.utils import chunked
+
+LOGGER = logging.getLogger(__name__)
+
+# Bumped whenever the layout of a saved snapshot changes. Snapshots of
+# another version are ignored.
+SNAPSHOT_VERSION = 1
+
+# The tables held by a snapshot, with the fields held for every row. They
+# are the fields the import phases compare, plus the hidden flag.
+SNAPSHOT_TABLES = (
+    (Faculty, 'person_id', ('first_name', 'last_name', 'email',
+                            'preferred_name', 'hidden')),
+    (Student, 'person_id', ('grade_level', 'first_name', 'last_name',
+                            'email', 'notify_cell', 'hidden')),
+    (Guardian, 'person_id', ('first_name', 'last_name', 'email',
+                             'cell_number', 'notify_cell', 'relationship',
+                             'hidden')),
+)
+
+
+def current_run_id():
+    """Returns the ID of the latest import run if it succeeded, else `None`."""
+    run = ImportRun.objects.order_by('-id').values_list('id', 'status').first()
+    if run is None or run[1] != ImportRun.SUCCEEDED:
+        return None
+    return run[0]
+
+
+class RosterTable():
+    """The rows of one table of a snapshot.
+
+    Attributes:
+        key_field (String): Unique field identifying a record upstream
+        fields (tuple): Names of the fields held for every row
+        ids (array): Primary key of every row
+        records (list): Field values of every row as a `Record`
+    """
+
+    def __init__(self, key_field, fields):
+        self.key_field = key_field
+        self.fields = tuple(fields)
+        self.Record = namedtuple('Record', self.fields)
+        self.ids = array('q')
+        self.records = []
+        self._positions = {}
+
+    def add(self, pk, key, values):
+        """Adds a row, or replaces the row of `key`.
+
+        Parameters:
+            pk (int): Primary key of the row
+            key (String): Upstream key of the row
+            values (iterable): Values of `fields`, in order
+        """
+        record = self.Record._make(values)
+        position = self._positions.get(key)
+        if position is None:
+            self._positions[sys.intern(key)] = len(self.records)
+            self.ids.append(pk)
+            self.records.append(record)
+        else:
+            self.ids[position] = pk
+            self.records[position] = record
+
+    def load(self, queryset):
+        """Adds the rows of `queryset` with a single `values_list` query."""
+        for pk, key, *values in queryset.values_list(
+                'id', self.key_field, *self.fields).iterator():
+            self.add(pk, key, values)
+
+    def load_keys(self, model, keys, batch_size):
+        """Adds or replaces the rows of `model` with the upstream `keys`.
+
+        Parameters:
+            model (django.db.models.Model): Model class of the rows
+            keys (list): Upstream keys of the rows, e.g. of new rows
+            batch_size (int): Maximum number of keys per query
+        """
+        for chunk in chunked(keys, batch_size):
+            self.load(model.objects.filter(**{self.key_field + '__in': chunk}))
+
+    def get(self, key):
+        """Returns the (primary key, record) of `key`, or `None`."""
+        position = self._positions.get(key)
+        if position is None:
+            return None
+        return self.ids[position], self.records[position]
+
+    def update(self, key, values):
+        """Sets some of the field values of the row of `key`.
+
+        Parameters:
+            key (String): Upstream key of the row
+            values (dict): New values of some of the `fields`
+        """
+        position = self._positions[key]
+        self.records[position] = self.records[position]._replace(**{
+            field: value for field, value in values.items()
+            if field in self.fields})
+
+    def covers(self, fields):
+        """Returns whether the table holds every field of `fields`."""
+        return set(fields) <= set(self.fields)
+
+    def items(self):
+        """Yields the (key, record) of every row."""
+        for key, position in self._positions.items():
+            yield key, self.records[position]
+
+    def id_map(self):
+        """Returns a map of upstream keys to primary keys."""
+        return {key: self.ids[position]
+                for key, position in self._positions.items()}
+
+    def as_dict(self):
+        """Returns the rows as a plain, JSON serializable dict."""
+        return {'key_field': self.key_field, 'fields': list(self.fields),
+                'keys': list(self._positions), 'ids': self.ids.tolist(),
+                'records': [list(record) for record in self.records]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Returns a table from the output of `as_dict`."""
+        table = cls(data['key_field'], data['fields'])
+        for pk, key, values in zip(data['ids'], data['keys'], data['records']):
+            table.add(pk, key, values)
+        return table
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __len__(self):
+        return len(self.records)
+
+
+class RosterSnapshot():
+    """Compact copy of the people tables, see the module documentation.
+
+    Attributes:
+        run_id (int): ID of the import run the snapshot was taken after, or
+            `None` if no recorded import had succeeded last
+        tables (dict): Maps the name of every model to its `RosterTable`
+    """
+
+    def __init__(self, run_id=None):
+        self.run_id = run_id
+        self.tables = {}
+
+    @classmethod
+    def from_database(cls):
+        """Reads a snapshot of the people tables from the database."""
+        snapshot = cls(current_run_id())
+        for model, key_field, fields in SNAPSHOT_TABLES:
+            table = RosterTable(key_field, fields)
+            table.load(model.objects.all())
+            snapshot.tables[model._meta.model_name] = table
+        LOGGER.info("Roster snapshot read: %s.", ', '.join(
+            '{0} {1}'.format(len(table), name)
+            for name, table in snapshot.tables.items()))
+        return snapshot
+
+    @classmethod
+    def load(cls, path):
+        """Loads a snapshot saved with `save`.
+
+        Returns:
+            RosterSnapshot: The snapshot, or `None` if there is no readable
+                snapshot of the current version at `path`
+        """
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as snapshot_file:
+                data = json.load(snapshot_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            LOGGER.warning("Ignoring unreadable roster snapshot %s: %r",
+                           path, error)
+            return None
+        if data.get('version') != SNAPSHOT_VERSION:
+            return None
+        snapshot = cls(data['run_id'])
+        for name, table in data['tables'].items():
+            snapshot.tables[name] = RosterTable.from_dict(table)
+        return snapshot
+
+    def save(self, path):
+        """Saves the snapshot to `path` as gzipped JSON.
+
+        The file is replaced in one step, so a concurrent `load` never reads
+        half a snapshot.
+        """
+        partial_path = path + '.partial'
+        with gzip.open(partial_path, 'wt', encoding='utf-8') as snapshot_file:
+            json.dump({'version': SNAPSHOT_VERSION, 'run_id': self.run_id,
+                       'tables': {name: table.as_dict()
+                                  for name, table in self.tables.items()}},
+                      snapshot_file, separators=(',', ':'))
+        os.replace(partial_path, path)
+
+    def is_current(self):
+        """Returns whether no import ran since the snapshot was taken."""
+        return self.run_id is not None and self.run_id == current_run_id()
+
+    def table(self, model):
+        """Returns the `RosterTable` of `model`, or `None`."""
+        return self.tables.get(model._meta.model_name)
@@ -0,0 +1,402 @@
+"""Imports roster data through staging tables and set-based SQL.
+
+This module defines an alternative engine for `DJOImport`. Instead of
+resolving every row in Python, each TSV file is bulk loaded as-is into a
+dedicated staging table. Upserts, hidden flags and the many-to-many links are
+then applied with a handful of INSERT ... SELECT, UPDATE and DELETE statements
+inside a single transaction, leaving the heavy lifting to the database.
+
+The SQL is written for MySQL/MariaDB, which is what Paperless Permission runs
+on in production, and for SQLite. Other database backends fall back to the
+ORM based importer, see `DJOImport.import_staged`.
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+
+from django.db import connection, transaction
+
+from paperlesspermission.models import (Guardian, Student, Faculty, Course,
+                                        Section, StagedFaculty, StagedSection,
+                                        StagedStudent, StagedContact,
+                                        StagedEnrollment)
+from paperlesspermission.utils import chunked
+
+LOGGER = logging.getLogger(__name__)
+
+# Number of staged rows sent to the database per executemany() call.
+LOAD_BATCH_SIZE = 1000
+
+STAGED_MODELS = (StagedFaculty, StagedSection, StagedStudent, StagedContact,
+                 StagedEnrollment)
+
+
+class StagingImport():
+    """Runs a `DJOImport` through staging tables and set-based SQL.
+
+    The files and the problem report of the wrapped `DJOImport` are used, so
+    unknown references end up in `djoimport.report` just like they do with
+    the ORM importer. Once `djoimport` validated the files, the skip policy
+    leaves the dangling references out of the staging tables, see
+    `DJOImport.exported`.
+
+    Attributes:
+        djoimport (DJOImport): Importer holding the files to import
+    """
+
+    SUPPORTED_VENDORS = ('mysql', 'sqlite')
+
+    def __init__(self, djoimport):
+        self.djoimport = djoimport
+        self.cursor = None
+
+    @classmethod
+    def is_supported(cls):
+        """Returns whether the default database can run a staged import."""
+        return connection.vendor in cls.SUPPORTED_VENDORS
+
+    @staticmethod
+    def _names():
+        """Returns the quoted table names and literals used in the SQL."""
+        quote = connection.ops.quote_name
+        names = {
+            'faculty': Faculty, 'course': Course, 'section': Section,
+            'student': Student, 'guardian': Guardian,
+            'enrollment': Section.students.through,
+            'guardian_student': Guardian.students.through,
+            'staged_faculty': StagedFaculty, 'staged_section': StagedSection,
+            'staged_student': StagedStudent, 'staged_contact': StagedContact,
+            'staged_enrollment': StagedEnrollment,
+        }
+        tables = {name: quote(model._meta.db_table)
+                  for name, model in names.items()}
+        # MySQL and SQLite both store booleans as integers.
+        return dict(tables, false='0')
+
+    def _execute(self, sql, params=()):
+        """Executes a statement and returns the number of affected rows."""
+        self.cursor.execute(sql.format(**self._names()), params)
+        return self.cursor.rowcount
+
+    def _upsert(self, table, key, columns, values, source, insert_only=()):
+        """Inserts the rows selected from `source`, updating existing keys.
+
+        `source` has to yield at most one row per key and must end with a
+        WHERE clause, which SQLite needs to parse ON CONFLICT after a join.
+
+        On MySQL the rows are selected into the derived table `incoming`, so
+        the ON DUPLICATE KEY UPDATE clause can refer to the incoming values
+        as `incoming.<column>`. Neither `VALUES(<column>)`, deprecated in
+        MySQL 8, nor the `AS new` row alias, which MariaDB lacks and MySQL
+        does not allow after a SELECT, is needed.
+
+        Parameters:
+            table (String): Name of the target table in `_names()`
+            key (String): Unique column of the target table
+            columns (list): Columns to fill, starting with `key`
+            values (list): SQL expression of the value of every column
+            source (String): FROM and WHERE clauses of the SELECT
+            insert_only (tuple): Columns only written for new rows
+        """
+        updated = [column for column in columns
+                   if column != key and column not in insert_only]
+        target = '{' + table + '}'
+        select = 'SELECT {0} {1}'.format(', '.join(
+            '{0} AS {1}'.format(value, column)
+            for value, column in zip(values, columns)), source)
+        if connection.vendor == 'mysql':
+            sql = ('SELECT {0} FROM ({1}) AS incoming '
+                   'ON DUPLICATE KEY UPDATE {2}').format(
+                       ', '.join(columns), select, ', '.join(
+                           '{0}.{1} = incoming.{1}'.format(target, column)
+                           for column in updated))
+        else:
+            # Without the WHERE clause SQLite would rewrite unchanged rows.
+            sql = '{0} ON CONFLICT ({1}) DO UPDATE SET {2} WHERE {3}'.format(
+                select, key,
+                ', '.join('{0} = excluded.{0}'.format(column)
+                          for column in updated),
+                ' OR '.join('{0}.{1} IS NOT excluded.{1}'.format(target, column)
+                            for column in updated))
+        return self._execute('INSERT INTO {0} ({1}) {2}'.format(
+            target, ', '.join(columns), sql))
+
+    def _sweep_hidden(self, table, key, staged_table):
+        """Updates the hidden flags of `table` from the keys in `staged_table`."""
+        hidden = self._execute(
+            'UPDATE {{{0}}} SET hidden = %s WHERE hidden = %s AND {1} NOT IN '
+            '(SELECT {1} FROM {{{2}}})'.format(table, key, staged_table),
+            [True, False])
+        unhidden = self._execute(
+            'UPDATE {{{0}}} SET hidden = %s WHERE hidden = %s AND {1} IN '
+            '(SELECT {1} FROM {{{2}}})'.format(table, key, staged_table),
+            [False, True])
+        return hidden, unhidden
+
+    def _report(self, category, sql):
+        """Adds every (record ID, value) row returned by `sql` to the report."""
+        self.cursor.execute(sql.format(**self._names()))
+        for record_id, value in self.cursor.fetchall():
+            self.djoimport.report.add(category, record_id, value)
+
+    def _load(self, model, columns, rows):
+        """Bulk loads `rows` of `columns` values into a staging table."""
+        sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+            connection.ops.quote_name(model._meta.db_table),
+            ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        count = 0
+        for batch in chunked(rows, LOAD_BATCH_SIZE):
+            self.cursor.executemany(sql, batch)
+            count += len(batch)
+        LOGGER.info("Staged %d rows into %s.", count, model._meta.db_table)
+
+    def load(self):
+        """Loads all five files into the staging tables.
+
+        Dangling teachers are staged blank and dangling enrollments are not
+        staged when `djoimport` skips dangling references.
+        """
+        djoimport = self.djoimport
+        djoimport.check_headers()
+
+        def teacher(person_id):
+            """Returns the teacher to stage for `person_id`."""
+            return person_id if djoimport.exported('fs_faculty',
+                                                   person_id) else ''
+
+        # FacultyRow and StudentRow are in the staging column order.
+        self._load(StagedFaculty, ['line', 'person_id', 'first_name',
+                                   'last_name', 'email', 'preferred_name'], (
+            (line,) + row
+            for line, row in enumerate(djoimport.rows('fs_faculty'))))
+
+        self._load(StagedSection, ['line', 'section_id', 'course_number',
+                                   'course_name', 'section_number', 'teacher',
+                                   'coteacher', 'school_year', 'room',
+                                   'period'], (
+            (line, row.record_id, row.course_number, row.course_name,
+             row.section_number, teacher(row.teacher),
+             teacher(row.coteacher), row.school_year, row.room,
+             row.expression)
+            for line, row in enumerate(djoimport.rows('fs_classes'))))
+
+        self._load(StagedStudent, ['line', 'person_id', 'grade_level',
+                                   'first_name', 'last_name', 'email'], (
+            (line,) + row
+            for line, row in enumerate(djoimport.rows('fs_student'))))
+
+        self._load(StagedContact, ['position', 'student_number', 'person_id',
+                                   'first_name', 'last_name', 'relationship',
+                                   'cell_number', 'email'],
+                   self._contacts())
+
+        self._load(StagedEnrollment, ['student_number', 'section_id'], (
+            row for row in djoimport.rows('fs_enrollment')
+            if djoimport.exported('fs_student', row.student_number)
+            and djoimport.exported('fs_classes', row.section_id)))
+
+    def _contacts(self):
+        """Yields one staged row per filled CNT{number} block of fs_parent.
+
+        Phone numbers are stored in E.164 form, the way `PhoneNumberField`
+        stores them, so the merge can compare them with the database as plain
+        strings. A skipped dangling student is staged blank, which keeps the
+        guardian but not the link.
+        """
+        reader = self.djoimport.rows('fs_parent')
+        for line, row in enumerate(reader):
+            student_number = row.student_number
+            if not self.djoimport.exported('fs_student', student_number):
+                student_number = ''
+            for i, contact in enumerate(row.contacts, 1):
+                if contact is None:
+                    continue
+                yield (line * 3 + i, student_number, contact.person_id,
+                       contact.first_name, contact.last_name,
+                       contact.relationship,
+                       self.djoimport.cell_number(contact), contact.email)
+
+    def merge_faculty(self):
+        """Upserts Faculty from the staged rows, the last row of an ID wins."""
+        self._upsert('faculty', 'person_id',
+                     ['person_id', 'first_name', 'last_name', 'email',
+                      'preferred_name', 'cell_number', 'notify_cell', 'hidden'],
+                     ['s.person_id', 's.first_name', 's.last_name', 's.email',
+                      's.preferred_name', "''", '{false}', '{false}'],
+                     'FROM {staged_faculty} s WHERE s.line = ('
+                     'SELECT MAX(l.line) FROM {staged_faculty} l '
+                     'WHERE l.person_id = s.person_id)',
+                     insert_only=('cell_number', 'notify_cell', 'hidden'))
+        self._sweep_hidden('faculty', 'person_id', 'staged_faculty')
+
+    def merge_classes(self):
+        """Upserts Courses and Sections and reports unknown teachers."""
+        # Courses are repeated on every section row, the first row wins.
+        self._upsert('course', 'course_number',
+                     ['course_number', 'course_name', 'hidden'],
+                     ['s.course_number', 's.course_name', '{false}'],
+                     'FROM {staged_section} s WHERE s.line = ('
+                     'SELECT MIN(f.line) FROM {staged_section} f '
+                     'WHERE f.course_number = s.course_number)',
+                     insert_only=('hidden',))
+        self._sweep_hidden('course', 'course_number', 'staged_section')
+
+        for column in ('teacher', 'coteacher'):
+            self._report(
+                'unknown_' + column,
+                'SELECT s.section_id, s.{0} FROM {{staged_section}} s '
+                'LEFT JOIN {{faculty}} f ON f.person_id = s.{0} '
+                'WHERE s.{0} <> \'\' AND f.id IS NULL '
+                'ORDER BY s.line'.format(column))
+
+        self._upsert('section', 'section_id',
+                     ['section_id', 'course_id', 'section_number',
+                      'teacher_id', 'coteacher_id', 'school_year', 'room',
+                      'period', 'hidden'],
+                     ['s.section_id', 'c.id', 's.section_number', 't.id',
+                      'ct.id', 's.school_year', 's.room', 's.period',
+                      '{false}'],
+                     'FROM {staged_section} s '
+                     'JOIN {course} c ON c.course_number = s.course_number '
+                     'LEFT JOIN {faculty} t ON t.person_id = s.teacher '
+                     'LEFT JOIN {faculty} ct ON ct.person_id = s.coteacher '
+                     'WHERE s.line = (SELECT MAX(l.line) FROM {staged_section} l '
+                     'WHERE l.section_id = s.section_id)',
+                     insert_only=('hidden',))
+        self._sweep_hidden('section', 'section_id', 'staged_section')
+
+    def merge_students(self):
+        """Upserts Students from the staged rows, the last row of an ID wins."""
+        self._upsert('student', 'person_id',
+                     ['person_id', 'grade_level', 'first_name', 'last_name',
+                      'email', 'cell_number', 'notify_cell', 'hidden'],
+                     ['s.person_id', 's.grade_level', 's.first_name',
+                      's.last_name', 's.email', "''", '{false}', '{false}'],
+                     'FROM {staged_student} s WHERE s.line = ('
+                     'SELECT MAX(l.line) FROM {staged_student} l '
+                     'WHERE l.person_id = s.person_id)',
+                     insert_only=('cell_number', 'hidden'))
+        self._sweep_hidden('student', 'person_id', 'staged_student')
+
+    def merge_guardians(self):
+        """Upserts Guardians and reconciles their links to Students.
+
+        Guardian details come from the first contact block a guardian appears
+        in. Only the links of guardians present in the file are touched.
+        """
+        self._upsert('guardian', 'person_id',
+                     ['person_id', 'first_name', 'last_name', 'email',
+                      'cell_number', 'notify_cell', 'relationship', 'hidden'],
+                     ['c.person_id', 'c.first_name', 'c.last_name', 'c.email',
+                      'c.cell_number', "c.cell_number <> ''", 'c.relationship',
+                      '{false}'],
+                     'FROM {staged_contact} c WHERE c.position = ('
+                     'SELECT MIN(f.position) FROM {staged_contact} f '
+                     'WHERE f.person_id = c.person_id)',
+                     insert_only=('hidden',))
+        self._sweep_hidden('guardian', 'person_id', 'staged_contact')
+
+        # With the skip policy every student left is in the file.
+        if not self.djoimport.skips_dangling:
+            self._report(
+                'unknown_guardian_student',
+                'SELECT MIN(c.person_id), c.student_number '
+                'FROM {staged_contact} c '
+                'LEFT JOIN {student} s ON s.person_id = c.student_number '
+                'WHERE s.id IS NULL GROUP BY c.student_number')
+
+        removed = self._execute(
+            'DELETE FROM {guardian_student} WHERE guardian_id IN ('
+            'SELECT g.id FROM {guardian} g '
+            'JOIN {staged_contact} c ON c.person_id = g.person_id) '
+            'AND NOT EXISTS (SELECT 1 FROM {staged_contact} c '
+            'JOIN {guardian} g ON g.person_id = c.person_id '
+            'JOIN {student} s ON s.person_id = c.student_number '
+            'WHERE g.id = {guardian_student}.guardian_id '
+            'AND s.id = {guardian_student}.student_id)')
+        added = self._execute(
+            'INSERT INTO {guardian_student} (guardian_id, student_id) '
+            'SELECT DISTINCT g.id, s.id FROM {staged_contact} c '
+            'JOIN {guardian} g ON g.person_id = c.person_id '
+            'JOIN {student} s ON s.person_id = c.student_number '
+            'WHERE NOT EXISTS (SELECT 1 FROM {guardian_student} l '
+            'WHERE l.guardian_id = g.id AND l.student_id = s.id)')
+        LOGGER.info("Guardian links: %d added, %d removed.", added, removed)
+
+    def merge_enrollment(self):
+        """Reconciles `Section.students` with the staged enrollment rows."""
+        self._report('unknown_enrolled_student',
+                     'SELECT MIN(e.section_id), e.student_number '
+                     'FROM {staged_enrollment} e '
+                     'LEFT JOIN {student} s ON s.person_id = e.student_number '
+                     'WHERE s.id IS NULL GROUP BY e.student_number')
+        self._report('unknown_section',
+                     'SELECT MIN(e.student_number), e.section_id '
+                     'FROM {staged_enrollment} e '
+                     'JOIN {student} st ON st.person_id = e.student_number '
+                     'LEFT JOIN {section} s ON s.section_id = e.section_id '
+                     'WHERE s.id IS NULL GROUP BY e.section_id')
+
+        removed = self._execute(
+            'DELETE FROM {enrollment} WHERE NOT EXISTS ('
+            'SELECT 1 FROM {staged_enrollment} e '
+            'JOIN {section} s ON s.section_id = e.section_id '
+            'JOIN {student} st ON st.person_id = e.student_number '
+            'WHERE s.id = {enrollment}.section_id '
+            'AND st.id = {enrollment}.student_id)')
+        added = self._execute(
+            'INSERT INTO {enrollment} (section_id, student_id) '
+            'SELECT DISTINCT s.id, st.id FROM {staged_enrollment} e '
+            'JOIN {section} s ON s.section_id = e.section_id '
+            'JOIN {student} st ON st.person_id = e.student_number '
+            'WHERE NOT EXISTS (SELECT 1 FROM {enrollment} l '
+            'WHERE l.section_id = s.id AND l.student_id = st.id)')
+        LOGGER.info("Enrollment: %d added, %d removed.", added, removed)
+
+    def _clear(self):
+        """Empties every staging table."""
+        for model in STAGED_MODELS:
+            self.cursor.execute('DELETE FROM {0}'.format(
+                connection.ops.quote_name(model._meta.db_table)))
+
+    def import_all(self):
+        """Loads and merges all five files in a single transaction.
+
+        Raises:
+            ValueError: The default database does not support staged
+                imports, see `is_supported`
+        """
+        if not self.is_supported():
+            raise ValueError(
+                'Staged imports are not supported on {0}.'.format(
+                    connection.vendor))
+
+        LOGGER.info("Staged DJO Importer started.")
+        with transaction.atomic(), connection.cursor() as cursor:
+            self.cursor = cursor
+            try:
+                self._clear()
+                self.load()
+                LOGGER.info("Merging staged rows.")
+                self.merge_faculty()
+                self.merge_classes()
+                self.merge_students()
+                self.merge_guardians()
+                self.merge_enrollment()
+                self._clear()
+            finally:
+                self.cursor = None
+        LOGGER.info("Staged DJO Importer completed.")
@@ -0,0 +1,345 @@
+"""Generates synthetic SQLRunner exports and benchmarks the importer.
+
+`SyntheticRoster` builds the five TSV files `DJOImport` reads, in the exact
+column layout SQLRunner exports, for a school of any size. `run_benchmark`
+imports such a roster into the current database and measures a cold import,
+an incremental import after some churn and an import of unchanged files.
+`benchmark_parsing` measures how parsing the files scales with the number
+of parse workers.
+
+The `generate_roster` and `benchmark_import` management commands wrap these.
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import copy
+import multiprocessing
+import random
+import time
+
+from django.db import connection
+
+from paperlesspermission.djo import DJOImport
+from paperlesspermission.djo_rows import (CLASSES_COLUMNS, ENROLLMENT_COLUMNS,
+                                          FACULTY_COLUMNS, PARENT_COLUMNS,
+                                          PARSE_CHUNK_SIZE, STUDENT_COLUMNS,
+                                          read_rows, read_rows_parallel)
+
+FIRST_NAMES = ['Abe', 'Alice', 'Andy', 'Bax', 'Carla', 'Doug', 'Dukey',
+               'Garv', 'Jupiter', 'Karla', 'Lulu', 'Mary', 'Matt', 'Nia',
+               'Omar', 'Priya', 'Quinn', 'Rosa', 'Sam', 'Taylor', 'Tessa',
+               'Uma', 'Victor', 'Wen', 'Xavier', 'Yusuf', 'Zoe']
+LAST_NAMES = ['Adelede', 'Ateman', 'Battern', 'Callis', 'Doe', 'Hartman',
+              'Hun', 'Johnston', 'Kimm', 'Lordon', 'MacConal', 'McMennum',
+              'Nguyen', 'Okafor', 'Patel', 'Rossi', 'Smith', 'Tesco',
+              'Walters', 'Yamada']
+SUBJECTS = ['Algebra', 'Art', 'Biology', 'Chemistry', 'English', 'French',
+            'Geometry', 'Government', 'History', 'Music', 'PE', 'Physics',
+            'Spanish', 'Spelling', 'Theater']
+RELATIONSHIPS = ['Mother', 'Father', 'Guardian', 'Grandparent']
+
+
+class SyntheticRoster():
+    """A synthetic school roster in the SQLRunner export layout.
+
+    Every file is held as a list of rows, each row a dict keyed by the
+    file's columns. The same `seed` always produces the same roster.
+
+    Attributes:
+        rows (dict): Maps each `DJOImport` file attribute, e.g. `fs_student`,
+            to its list of rows
+    """
+
+    def __init__(self, students=5000, faculty=400, courses=300, sections=1500,
+                 enrollments=60000, seed=0):
+        self._random = random.Random(seed)
+        self._next_id = 0
+        self.rows = {}
+        self._generate(students, faculty, courses, sections, enrollments)
+
+    def _name(self):
+        return (self._random.choice(FIRST_NAMES),
+                self._random.choice(LAST_NAMES))
+
+    def _id(self):
+        """Returns a new unique record ID."""
+        self._next_id += 1
+        return str(self._next_id)
+
+    def _phone(self):
+        if self._random.random() < 0.15:
+            return ''
+        return '{0}-555-{1:04d}'.format(self._random.choice([201, 571, 703]),
+                                         self._random.randrange(10000))
+
+    def _faculty_row(self):
+        first, last = self._name()
+        return {'RECORDID': self._id(), 'FIRST_NAME': first,
+                'LAST_NAME': last,
+                'EMAIL_ADDR': '{0}{1}@school.test'.format(first[0], last).lower(),
+                'PREFERREDNAME': 'Mx. ' + last}
+
+    def _student_row(self):
+        first, last = self._name()
+        record_id = self._id()
+        return {'RECORDID': record_id,
+                'GRADE_LEVEL': str(self._random.randint(9, 12)),
+                'FIRST_NAME': first, 'LAST_NAME': last,
+                'EMAIL': '{0}{1}{2}@school.test'.format(
+                    first[0], last, record_id).lower()}
+
+    def _contact(self, last_name):
+        first, _ = self._name()
+        return [self._id(), first, last_name,
+                self._random.choice(RELATIONSHIPS), self._phone(),
+                '{0}.{1}@mail.test'.format(first, last_name).lower()]
+
+    def _generate(self, students, faculty, courses, sections, enrollments):
+        self.rows['fs_faculty'] = [self._faculty_row() for _ in range(faculty)]
+        teachers = [row['RECORDID'] for row in self.rows['fs_faculty']]
+
+        course_rows = [('{0:04d}'.format(number), '{0} {1}'.format(
+            self._random.choice(SUBJECTS), number % 4 + 1))
+                       for number in range(1, courses + 1)]
+        self.rows['fs_classes'] = []
+        for number in range(sections):
+            course_number, course_name = course_rows[number % len(course_rows)]
+            coteacher = ''
+            if self._random.random() < 0.1:
+                coteacher = self._random.choice(teachers)
+            self.rows['fs_classes'].append({
+                'RECORDID': self._id(),
+                'COURSE_NUMBER': course_number,
+                'SECTION_NUMBER': str(number // len(course_rows) + 1),
+                'TERMID': '1901',
+                'SCHOOLYEAR': self._random.choice(['2019-2020', 'Semester 1',
+                                                   'Semester 2']),
+                'TEACHER': self._random.choice(teachers),
+                'ROOM': str(self._random.randint(100, 350)),
+                'COURSE_NAME': course_name,
+                'EXPRESSION': '{0}(A1-B1,A3)'.format(
+                    self._random.randint(1, 8)),
+                'COTEACHER': coteacher,
+            })
+
+        self.rows['fs_student'] = [self._student_row()
+                                   for _ in range(students)]
+
+        # Families: one to three contacts, shared by siblings.
+        self.rows['fs_parent'] = []
+        family = None
+        for row in self.rows['fs_student']:
+            if family is None or self._random.random() > 0.2:
+                family = [self._contact(row['LAST_NAME'])
+                          for _ in range(self._random.choice([1, 2, 2, 3]))]
+            self.rows['fs_parent'].append(self._parent_row(
+                row['RECORDID'], family))
+
+        self.rows['fs_enrollment'] = []
+        self._enroll(self.rows['fs_student'], enrollments)
+
+    def _parent_row(self, student_number, family):
+        values = [student_number]
+        for i in range(3):
+            values.extend(family[i] if i < len(family) else [''] * 6)
+        return dict(zip(PARENT_COLUMNS, values))
+
+    def _enroll(self, students, enrollments):
+        """Spreads `enrollments` rows evenly across `students`."""
+        section_ids = [row['RECORDID'] for row in self.rows['fs_classes']]
+        if not students or not section_ids:
+            return
+        per_student, extra = divmod(enrollments, len(students))
+        for index, row in enumerate(students):
+            count = min(per_student + (index < extra), len(section_ids))
+            for section_id in self._random.sample(section_ids, count):
+                self.rows['fs_enrollment'].append({
+                    'STUDENT_NUMBER': row['RECORDID'], 'SECTIONID': section_id})
+
+    def churn(self, fraction=0.01, seed=1):
+        """Returns a copy of the roster with a `fraction` of it changed.
+
+        About `fraction` of the students and faculty have their name or grade
+        changed, the same number of students leave and new students join in
+        their place, and `fraction` of the enrollment rows move to another
+        section.
+        """
+        roster = copy.deepcopy(self)
+        roster._random = random.Random(seed)
+        rng = roster._random
+        rows = roster.rows
+
+        def pick(items):
+            return rng.sample(items, max(1, int(len(items) * fraction))
+                              if items else 0)
+
+        for row in pick(rows['fs_faculty']):
+            row['PREFERREDNAME'] = 'Dr. ' + row['LAST_NAME']
+        for row in pick(rows['fs_student']):
+            row['GRADE_LEVEL'] = str(min(int(row['GRADE_LEVEL']) + 1, 12))
+
+        leaving = {row['RECORDID'] for row in pick(rows['fs_student'])}
+        rows['fs_student'] = [row for row in rows['fs_student']
+                              if row['RECORDID'] not in leaving]
+        rows['fs_parent'] = [row for row in rows['fs_parent']
+                             if row['STUDENT_NUMBER'] not in leaving]
+        enrollments = [row for row in rows['fs_enrollment']
+                       if row['STUDENT_NUMBER'] not in leaving]
+        per_student = len(enrollments) // max(len(rows['fs_student']), 1)
+        rows['fs_enrollment'] = enrollments
+
+        joining = [roster._student_row() for _ in leaving]
+        rows['fs_student'].extend(joining)
+        for row in joining:
+            rows['fs_parent'].append(roster._parent_row(
+                row['RECORDID'], [roster._contact(row['LAST_NAME'])]))
+        roster._enroll(joining, per_student * len(joining))
+
+        section_ids = [row['RECORDID'] for row in rows['fs_classes']]
+        for row in pick(rows['fs_enrollment']):
+            row['SECTIONID'] = rng.choice(section_ids)
+        return roster
+
+    def to_bytes(self, attribute):
+        """Returns the TSV contents of the file held in `attribute`."""
+        columns = {
+            'fs_faculty': FACULTY_COLUMNS, 'fs_classes': CLASSES_COLUMNS,
+            'fs_student': STUDENT_COLUMNS, 'fs_parent': PARENT_COLUMNS,
+            'fs_enrollment': ENROLLMENT_COLUMNS,
+        }[attribute]
+        lines = ['\t'.join(columns)]
+        lines.extend('\t'.join(row[column] for column in columns)
+                     for row in self.rows[attribute])
+        return ('\n'.join(lines) + '\n').encode()
+
+    def files(self):
+        """Returns the five files as `BytesIO` objects, keyed for `DJOImport`."""
+        return {attribute: BytesIO(self.to_bytes(attribute))
+                for attribute in self.rows}
+
+    def shape(self):
+        """Returns the number of rows in every file."""
+        return {attribute: len(rows) for attribute, rows in self.rows.items()}
+
+
+def benchmark_import(roster, **kwargs):
+    """Imports `roster` once and returns its timing and query counts.
+
+    Parameters:
+        roster (SyntheticRoster): Roster to import
+        **kwargs: Passed on to the `DJOImport` constructor
+
+    Returns:
+        dict: Total `seconds` and `queries`, the per phase measurements of
+            `DJOImport.stats` and the number of problems found
+    """
+    importer = DJOImport(**roster.files(), **kwargs)
+    start = time.monotonic()
+    importer.import_all()
+    seconds = time.monotonic() - start
+    return {
+        'seconds': round(seconds, 3),
+        'queries': sum(phase['queries'] for phase in importer.stats),
+        'phases': importer.stats,
+        'problems': sum(len(problems) for problems
+                        in importer.report.problems.values()),
+    }
+
+
+def run_benchmark(roster, churn=0.01, seed=1, **kwargs):
+    """Benchmarks cold, incremental and unchanged imports of `roster`.
+
+    The current database should hold no roster yet. Every scenario imports
+    into the database left behind by the one before it:
+
+        cold:        `roster` into the empty database
+        incremental: `roster.churn(churn)`
+        unchanged:   the churned roster again
+
+    Parameters:
+        roster (SyntheticRoster): Roster to import
+        churn (float): Fraction of the roster changed for `incremental`
+        seed (int): Seed of the churn
+        **kwargs: Passed on to the `DJOImport` constructor
+
+    Returns:
+        dict: The database vendor, the roster shape and the results of each
+            scenario, see `benchmark_import`
+    """
+    churned = roster.churn(churn, seed=seed)
+    return {
+        'database': connection.vendor,
+        'shape': roster.shape(),
+        'churn': churn,
+        'options': kwargs,
+        'scenarios': {
+            'cold': benchmark_import(roster, **kwargs),
+            'incremental': benchmark_import(churned, **kwargs),
+            'unchanged': benchmark_import(churned, **kwargs),
+        },
+    }
+
+
+def benchmark_parsing(roster, workers=(1, 2, 4),
+                      attributes=('fs_parent', 'fs_enrollment'),
+                      chunk_size=PARSE_CHUNK_SIZE):
+    """Parses files of `roster` with different numbers of parse workers.
+
+    A single worker parses in the calling process with `read_rows`, more
+    workers use `read_rows_parallel` like `DJOImport(parse_workers=...)`.
+    The worker processes are started before the clock starts.
+
+    Parameters:
+        roster (SyntheticRoster): Roster whose files are parsed
+        workers (iterable): Numbers of workers to measure
+        attributes (iterable): Files to parse, by `DJOImport` attribute
+        chunk_size (int): Bytes per chunk, see `split_lines`
+
+    Returns:
+        list: A dict of `workers`, `rows`, `seconds` and `speedup` over the
+            first measurement for every number of workers
+    """
+    files = {attribute: BytesIO(roster.to_bytes(attribute))
+             for attribute in attributes}
+    results = []
+    for count in workers:
+        executor = None
+        if count > 1:
+            executor = ProcessPoolExecutor(
+                count, mp_context=multiprocessing.get_context('spawn'))
+            list(executor.map(abs, range(count)))
+        try:
+            rows = 0
+            start = time.monotonic()
+            for attribute, fileobj in files.items():
+                if executor is None:
+                    reader = read_rows(attribute, fileobj)
+                else:
+                    reader = read_rows_parallel(attribute, fileobj, executor,
+                                                count, chunk_size)
+                for _ in reader:
+                    rows += 1
+            seconds = time.monotonic() - start
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        results.append({'workers': count, 'rows': rows, 'seconds': seconds})
+    baseline = results[0]['seconds']
+    for result in results:
+        result['speedup'] = round(baseline / result['seconds'], 2)
+        result['seconds'] = round(result['seconds'], 3)
+    return results
@@ -0,0 +1,79 @@
+"""Watches the DJO export files for changes.
+
+PowerSchool only rewrites the export files a few times a day, yet imports
+are scheduled far more often so that changes show up quickly. Most runs
+therefore download and parse files that did not change. `exports_changed`
+instead compares the modification time and size of the files, which a
+single directory listing returns, with those seen by the last poll, so a
+frequently scheduled watcher only triggers an import when there is
+something to import.
+
+The stats are kept as `ExportFileStat` rows as soon as a change is seen,
+so polls while the triggered import is queued or running do not trigger
+it again. An import that fails for good calls `forget_export_stats`, and
+the next poll triggers another import.
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+
+from django.db import transaction
+
+from paperlesspermission.djo_sources import EXPORT_FILES
+from paperlesspermission.models import ExportFileStat
+
+LOGGER = logging.getLogger(__name__)
+
+
+def exports_changed(source, files=EXPORT_FILES):
+    """Returns whether the export files changed since the last call.
+
+    The first call always reports a change. The stats of the files are
+    remembered whether or not they changed.
+
+    Parameters:
+        source (ImportSource): Where to look for the export files
+        files (tuple): (attribute, filename) pairs of the files to watch
+
+    Returns:
+        bool: Whether any file was added, removed, modified or resized
+    """
+    stats = source.stat(files)
+    seen = {stat.filename: stat.as_stat()
+            for stat in ExportFileStat.objects.all()}
+    changed = sorted(filename for filename in set(stats) | set(seen)
+                     if filename not in seen or filename not in stats
+                     or stats[filename] != seen[filename])
+    if changed:
+        LOGGER.info("Export files changed: %s", ', '.join(changed))
+        with transaction.atomic():
+            ExportFileStat.objects.exclude(filename__in=stats).delete()
+            for filename in changed:
+                if filename in stats:
+                    mtime, size = stats[filename] or (None, None)
+                    ExportFileStat.objects.update_or_create(
+                        filename=filename,
+                        defaults={'mtime': mtime, 'size': size})
+    return bool(changed)
+
+
+def forget_export_stats():
+    """Makes the next call of `exports_changed` report a change.
+
+    Called when an import failed for good, so the export it failed on is
+    imported again by the next poll.
+    """
+    ExportFileStat.objects.all().delete()
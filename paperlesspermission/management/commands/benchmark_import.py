@@ -0,0 +1,107 @@
+"""Defines the benchmark_import command for manage.py.
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from paperlesspermission.djo_synthetic import benchmark_parsing, run_benchmark
+from paperlesspermission.management.commands.generate_roster import add_roster_arguments, roster_from_options
+
+
+class Command(BaseCommand):
+    """Benchmarks DJOImport against a synthetic roster.
+
+    The imports run against a freshly created test database, just like the
+    test suite, so the database user needs permission to create databases.
+    The real database is never touched.
+    """
+
+    help = 'Benchmarks cold, incremental and unchanged roster imports.'
+
+    def add_arguments(self, parser):
+        add_roster_arguments(parser)
+        parser.add_argument('--churn', type=float, default=0.01,
+                            help='Fraction of the roster changed for the '
+                                 'incremental import (default: %(default)s)')
+        parser.add_argument('--full', action='store_true',
+                            help='Import every file and row, instead of '
+                                 'skipping unchanged ones like scheduled '
+                                 'imports do')
+        parser.add_argument('--phase-workers', type=int, default=1,
+                            help='Number of import phases run at the same '
+                                 'time (default: %(default)s)')
+        parser.add_argument('--parse-workers', type=int, default=1,
+                            help='Number of processes parsing the files '
+                                 '(default: %(default)s)')
+        parser.add_argument('--parse-scaling', type=str,
+                            help='Only measure parsing the parent and '
+                                 'enrollment files with each of these '
+                                 'numbers of parse workers, e.g. 1,2,4,8')
+        parser.add_argument('--output', type=str,
+                            help='Write the results to this file as JSON')
+        parser.add_argument('--noinput', '--no-input', action='store_false',
+                            dest='interactive',
+                            help='Delete an existing test database without '
+                                 'asking')
+
+    def handle(self, *args, **options):
+        roster = roster_from_options(options)
+        if options['parse_scaling']:
+            self.parse_scaling(roster, options)
+            return
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=not options['interactive'])
+        try:
+            results = run_benchmark(roster, churn=options['churn'],
+                                    seed=options['seed'] + 1,
+                                    skip_unchanged=not options['full'],
+                                    phase_workers=options['phase_workers'],
+                                    parse_workers=options['parse_workers'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results['finished'] = timezone.now().isoformat()
+        for name, scenario in results['scenarios'].items():
+            self.stdout.write('{0}: {1:.2f}s, {2} queries'.format(
+                name, scenario['seconds'], scenario['queries']))
+            for phase in scenario['phases']:
+                self.stdout.write(
+                    '  {name}: {seconds:.2f}s, {rows_read} read, '
+                    '{rows_written} written, {queries} queries'.format(**phase))
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def parse_scaling(self, roster, options):
+        """Measures parsing with each number of workers of --parse-scaling."""
+        workers = [int(count) for count in options['parse_scaling'].split(',')]
+        results = {'shape': roster.shape(),
+                   'parsing': benchmark_parsing(roster, workers),
+                   'finished': timezone.now().isoformat()}
+        for result in results['parsing']:
+            self.stdout.write(
+                '{workers} workers: {rows} rows in {seconds:.2f}s, '
+                '{speedup:.2f}x'.format(**result))
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
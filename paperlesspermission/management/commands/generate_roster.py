@@ -0,0 +1,76 @@
+"""Defines the generate_roster command for manage.py.
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+
+from django.core.management.base import BaseCommand
+from paperlesspermission.djo import EXPORT_FILES
+from paperlesspermission.djo_synthetic import SyntheticRoster
+
+
+def add_roster_arguments(parser):
+    """Adds the options describing the size of a synthetic roster."""
+    parser.add_argument('--students', type=int, default=5000,
+                        help='Number of students (default: %(default)s)')
+    parser.add_argument('--faculty', type=int, default=400,
+                        help='Number of faculty (default: %(default)s)')
+    parser.add_argument('--courses', type=int, default=300,
+                        help='Number of courses (default: %(default)s)')
+    parser.add_argument('--sections', type=int, default=1500,
+                        help='Number of sections (default: %(default)s)')
+    parser.add_argument('--enrollments', type=int, default=60000,
+                        help='Number of enrollment rows (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed, the same seed always generates the '
+                             'same roster (default: %(default)s)')
+
+
+def roster_from_options(options):
+    """Returns the `SyntheticRoster` described by the parsed options."""
+    return SyntheticRoster(
+        students=options['students'], faculty=options['faculty'],
+        courses=options['courses'], sections=options['sections'],
+        enrollments=options['enrollments'], seed=options['seed'])
+
+
+class Command(BaseCommand):
+    """Writes a synthetic SQLRunner export to a directory."""
+
+    help = 'Generates synthetic SQLRunner export files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', type=str,
+                            help='Directory to write the export files to')
+        add_roster_arguments(parser)
+        parser.add_argument('--churn', type=float, default=0.0,
+                            help='Fraction of the roster to change after '
+                                 'generating it, e.g. 0.01')
+
+    def handle(self, *args, **options):
+        roster = roster_from_options(options)
+        if options['churn']:
+            roster = roster.churn(options['churn'], seed=options['seed'] + 1)
+
+        os.makedirs(options['directory'], exist_ok=True)
+        for attribute, filename in EXPORT_FILES:
+            with open(os.path.join(options['directory'], filename),
+                      'wb') as export_file:
+                export_file.write(roster.to_bytes(attribute))
+        self.stdout.write('Wrote {0} to {1}.'.format(
+            ', '.join('{0} {1} rows'.format(count, attribute)
+                      for attribute, count in roster.shape().items()),
+            options['directory']))
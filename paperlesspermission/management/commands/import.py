@@ -15,14 +15,23 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from django.core.management.base import BaseCommand
-from paperlesspermission.djo import DJOImport
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from paperlesspermission.djo import (DJOImport, PARSE_WORKERS, PHASE_WORKERS,
+                                     PROCEED, TRANSACTION_BATCH_SIZE,
+                                     VALIDATION_POLICIES)
+from paperlesspermission.djo_delta import DeltaGapError, DeltaImport
+from paperlesspermission.djo_lock import ImportLock
+from paperlesspermission.djo_rows import PHONE_REGION
+from paperlesspermission.djo_sources import source_from_url
+from paperlesspermission.tasks import async_djo_import_enrollment_data
 
 
 class Command(BaseCommand):
-    """Import command imports data from SFTP dropsite."""
+    """Import command imports data from SFTP dropsite or another source."""
 
-    help = 'Imports data from SFTP dropsite.'
+    help = 'Imports data from SFTP dropsite or another source.'
 
     def add_arguments(self, parser):
         parser.add_argument('hostname', nargs='?', type=str,
@@ -33,8 +42,132 @@ class Command(BaseCommand):
                             help='Password to connect over SFTP with')
         parser.add_argument('rsa_fingerprint', nargs='?',
                             type=str, help='RSA Fingerprint of SSH Server')
+        parser.add_argument('--source', type=str,
+                            help='URL of the export files instead of the '
+                                 'SFTP arguments, e.g. file:///srv/export or '
+                                 'file:///srv/export.tar.gz')
+        parser.add_argument('--delta', action='store_true',
+                            help='Import a delta export with the changes '
+                                 'since the last delta, see djo_delta')
+        parser.add_argument('--skip-unchanged', action='store_true',
+                            help='Skip files and rows that did not change '
+                                 'since the last import')
+        parser.add_argument('--staged', action='store_true',
+                            help='Merge through the staging tables with '
+                                 'set-based SQL instead of the ORM')
+        parser.add_argument('--atomic', action='store_true',
+                            help='Run the whole import in a single '
+                                 'transaction')
+        parser.add_argument('--transaction-batch-size', type=int,
+                            default=TRANSACTION_BATCH_SIZE,
+                            help='Maximum number of rows written per '
+                                 'transaction (default: %(default)s)')
+        parser.add_argument('--phase-workers', type=int, default=PHASE_WORKERS,
+                            help='Number of import phases run at the same '
+                                 'time, each on its own database connection '
+                                 '(default: %(default)s)')
+        parser.add_argument('--parse-workers', type=int, default=PARSE_WORKERS,
+                            help='Number of processes parsing large files '
+                                 '(default: %(default)s)')
+        parser.add_argument('--validation', choices=VALIDATION_POLICIES,
+                            default=PROCEED,
+                            help='What to do about references between the '
+                                 'files that do not resolve: import anyway, '
+                                 'skip them or abort (default: %(default)s)')
+        parser.add_argument('--phone-region', default=PHONE_REGION,
+                            help='Region of the phone numbers without a '
+                                 'country code (default: %(default)s)')
+        parser.add_argument('--snapshot', type=str,
+                            help='File to keep a snapshot of the roster in '
+                                 'between imports, so unchanged imports do '
+                                 'not have to read it from the database')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only print the changes the import would '
+                                 'make, without writing anything')
+        parser.add_argument('--diff-file', type=str,
+                            help='With --dry-run, write the changes and '
+                                 'problems found to this file as JSON')
 
     def handle(self, *args, **options):
-        with DJOImport.GetFromSFTP(options['hostname'], options['username'],
-                       options['password'], options['rsa_fingerprint']) as importer:
-            importer.import_all()
+        # Dry runs write nothing, so they may run next to another import.
+        if options['dry_run']:
+            self.import_data(options)
+            return
+
+        lock = ImportLock()
+        if not lock.acquire(coalesce=False):
+            raise CommandError('Another import is running, try again once it '
+                               'completed.')
+        try:
+            self.import_data(options)
+        finally:
+            if lock.release():
+                self.stdout.write('Import requested during the run, queueing '
+                                  'another.')
+                lock.trigger(async_djo_import_enrollment_data.delay)
+
+    def import_data(self, options):
+        """Fetches the export files and imports them."""
+        kwargs = {
+            'skip_unchanged': options['skip_unchanged'],
+            'atomic': options['atomic'],
+            'transaction_batch_size': options['transaction_batch_size'],
+            'dry_run': options['dry_run'],
+            'phase_workers': options['phase_workers'],
+            'parse_workers': options['parse_workers'],
+            'validation': options['validation'],
+            'phone_region': options['phone_region'],
+            'snapshot_path': options['snapshot'],
+        }
+        importer_class = DeltaImport if options['delta'] else DJOImport
+        if options['delta'] and not options['source']:
+            raise CommandError('--delta needs the --source of the delta '
+                               'export.')
+        if options['source']:
+            try:
+                source = source_from_url(options['source'])
+            except ValueError as error:
+                raise CommandError(error)
+            importer = importer_class.FromSource(source, **kwargs)
+        else:
+            importer = DJOImport.GetFromSFTP(
+                options['hostname'], options['username'],
+                options['password'], options['rsa_fingerprint'], **kwargs)
+
+        try:
+            self.run_import(importer, options)
+        except DeltaGapError as error:
+            raise CommandError(error)
+
+    def run_import(self, importer, options):
+        """Runs the import the options ask for."""
+        with importer:
+            if options['dry_run']:
+                importer.import_all()
+                self.print_diff(importer)
+                if options['diff_file']:
+                    with open(options['diff_file'], 'w') as diff_file:
+                        json.dump({'changes': importer.diff.as_dict(),
+                                   'problems': importer.report.as_dict(),
+                                   'validation':
+                                       importer.validation_report.as_dict()},
+                                  diff_file, indent=2, sort_keys=True)
+            elif options['staged']:
+                importer.import_staged()
+            else:
+                importer.import_all()
+
+    def print_diff(self, importer):
+        """Prints a summary of the changes found by a dry run."""
+        summary = importer.diff.summary()
+        if not summary:
+            self.stdout.write('No changes.')
+        for table, changes in sorted(summary.items()):
+            self.stdout.write('{0}: {1}'.format(table, ', '.join(
+                '{0} {1}'.format(count, change)
+                for change, count in sorted(changes.items()))))
+        found = dict(importer.validation_report.as_dict(),
+                     **importer.report.as_dict())
+        for category, problems in sorted(found.items()):
+            self.stdout.write(self.style.WARNING('{0}: {1} problems'.format(
+                category, len(problems))))
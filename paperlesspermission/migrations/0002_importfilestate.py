@@ -0,0 +1,23 @@
+# Generated by Django 3.0.7 on 2026-10-16 22:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paperlesspermission', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportFileState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=30, unique=True)),
+                ('digest', models.CharField(blank=True, max_length=64)),
+                ('row_fingerprints', models.TextField(blank=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
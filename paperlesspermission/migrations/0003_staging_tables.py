@@ -0,0 +1,75 @@
+# Generated by Django 3.0.7 on 2026-10-16 22:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paperlesspermission', '0002_importfilestate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagedContact',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.IntegerField()),
+                ('student_number', models.CharField(db_index=True, max_length=200)),
+                ('person_id', models.CharField(db_index=True, max_length=200)),
+                ('first_name', models.CharField(max_length=200)),
+                ('last_name', models.CharField(max_length=200)),
+                ('relationship', models.CharField(max_length=30)),
+                ('cell_number', models.CharField(max_length=128)),
+                ('email', models.CharField(max_length=254)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StagedEnrollment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('student_number', models.CharField(db_index=True, max_length=200)),
+                ('section_id', models.CharField(db_index=True, max_length=30)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StagedFaculty',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line', models.IntegerField()),
+                ('person_id', models.CharField(db_index=True, max_length=200)),
+                ('first_name', models.CharField(max_length=200)),
+                ('last_name', models.CharField(max_length=200)),
+                ('email', models.CharField(max_length=254)),
+                ('preferred_name', models.CharField(max_length=200)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StagedSection',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line', models.IntegerField()),
+                ('section_id', models.CharField(db_index=True, max_length=30)),
+                ('course_number', models.CharField(db_index=True, max_length=30)),
+                ('course_name', models.CharField(max_length=200)),
+                ('section_number', models.CharField(max_length=30)),
+                ('teacher', models.CharField(max_length=200)),
+                ('coteacher', models.CharField(max_length=200)),
+                ('school_year', models.CharField(max_length=30)),
+                ('room', models.CharField(max_length=30)),
+                ('period', models.CharField(max_length=30)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StagedStudent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line', models.IntegerField()),
+                ('person_id', models.CharField(db_index=True, max_length=200)),
+                ('grade_level', models.CharField(max_length=2)),
+                ('first_name', models.CharField(max_length=200)),
+                ('last_name', models.CharField(max_length=200)),
+                ('email', models.CharField(max_length=254)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.0.7 on 2026-10-16 22:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paperlesspermission', '0003_staging_tables'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('status', models.IntegerField(choices=[(0, 'Running'), (1, 'Succeeded'), (2, 'Failed')], default=0)),
+                ('error', models.TextField(blank=True)),
+                ('phases', models.TextField(blank=True)),
+                ('problems', models.TextField(blank=True)),
+                ('peak_memory', models.IntegerField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-started'],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.7 on 2026-10-16 22:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paperlesspermission', '0004_importrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importrun',
+            name='checkpoint',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='importrun',
+            name='resumed_from',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='resumed_by', to='paperlesspermission.ImportRun'),
+        ),
+    ]
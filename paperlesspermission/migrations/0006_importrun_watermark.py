@@ -0,0 +1,23 @@
+# Generated by Django 3.0.7 on 2026-10-16 22:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paperlesspermission', '0005_importrun_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importrun',
+            name='delta',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='importrun',
+            name='watermark',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
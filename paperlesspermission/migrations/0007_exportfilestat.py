@@ -0,0 +1,30 @@
+# Generated by Django 3.0.7 on 2026-10-16 23:38
+
+from django.db import migrations, models
+
+
+def remove_watcher_state(apps, schema_editor):
+    """Removes the stats the watcher used to keep in ImportFileState."""
+    ImportFileState = apps.get_model('paperlesspermission', 'ImportFileState')
+    ImportFileState.objects.filter(name='watcher').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paperlesspermission', '0006_importrun_watermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportFileStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=255, unique=True)),
+                ('mtime', models.BigIntegerField(blank=True, null=True)),
+                ('size', models.BigIntegerField(blank=True, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(remove_watcher_state, migrations.RunPython.noop),
+    ]
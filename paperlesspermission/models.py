@@ -19,6 +19,7 @@ limitations under the License.
 """
 
 from hashlib import sha256
+import json
 
 from django.db import models
 from django.db.models import Q
@@ -504,3 +505,221 @@ class PermissionSlipLink(models.Model):
                 name='Only tied to one person.'
             )
         ]
+
+
+class ImportFileState(models.Model):
+    """Remembers what the last import saw for each upstream data file.
+
+    `DJOImport` uses this to skip files that have not changed since the last
+    import, and rows within a file that have not changed.
+
+    Attributes:
+        name (CharField): Import phase the file belongs to, e.g. `faculty`
+        digest (CharField): SHA-256 digest of the file and the files it
+            depends on, as of the last successful import
+        row_fingerprints (TextField): JSON object mapping each record ID to a
+            fingerprint of its imported values
+        updated (DateTimeField): Last time this state was written
+    """
+    name = models.CharField(unique=True, max_length=30)
+    digest = models.CharField(max_length=64, blank=True)
+    row_fingerprints = models.TextField(blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def get_row_fingerprints(self):
+        """Returns the stored row fingerprints as a dict."""
+        return json.loads(self.row_fingerprints or '{}')
+
+    def set_row_fingerprints(self, fingerprints):
+        """Stores a dict of row fingerprints."""
+        self.row_fingerprints = json.dumps(fingerprints, separators=(',', ':'))
+
+    def __str__(self):
+        return self.name
+
+
+class ExportFileStat(models.Model):
+    """Remembers the modification time and size of an export file.
+
+    `djo_watch` compares them with the current ones to tell whether the
+    export changed since the last poll.
+
+    Attributes:
+        filename (CharField): Name of the export file, e.g. `fs_student.txt`
+        mtime (BigIntegerField): Modification time in seconds since the
+            epoch, null if the file was missing
+        size (BigIntegerField): Size in bytes, null if the file was missing
+        updated (DateTimeField): Last time the file was seen to change
+    """
+    filename = models.CharField(unique=True, max_length=255)
+    mtime = models.BigIntegerField(null=True, blank=True)
+    size = models.BigIntegerField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def as_stat(self):
+        """Returns the stat in the form of `ImportSource.stat`."""
+        if self.mtime is None:
+            return None
+        return [self.mtime, self.size]
+
+    def __str__(self):
+        return self.filename
+
+
+class ImportRun(models.Model):
+    """Records a single `DJOImport.import_all` run.
+
+    Attributes:
+        started (DateTimeField): When the import started
+        finished (DateTimeField): When the import succeeded or failed
+        status (IntegerField Choice): Outcome of the import
+        error (TextField): Exception that failed the import, if any
+        phases (TextField): JSON list with one object per import phase,
+            holding its `name`, `outcome`, `seconds`, `rows_read`,
+            `rows_written`, `rows_skipped`, `queries` and `peak_memory`
+        problems (TextField): JSON object of the problems found in the
+            upstream data, see `ImportReport`
+        peak_memory (IntegerField): Peak resident memory of the importing
+            process during the run in KiB. Where the peak can not be reset,
+            e.g. outside of Linux, the peak since the process started
+        checkpoint (CharField): Directory holding a copy of the imported
+            files until the import succeeds, so a failed import can resume
+        resumed_from (ForeignKey): Failed run this run resumed, if any
+        delta (BooleanField): Whether the run imported a delta export
+        watermark (CharField): Upstream watermark a delta export brings the
+            roster up to, see `paperlesspermission.djo_delta`
+    """
+    RUNNING = 0
+    SUCCEEDED = 1
+    FAILED = 2
+    STATUS_CHOICES = (
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+
+    started = models.DateTimeField(auto_now_add=True, db_index=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    status = models.IntegerField(choices=STATUS_CHOICES, default=RUNNING)
+    error = models.TextField(blank=True)
+    phases = models.TextField(blank=True)
+    problems = models.TextField(blank=True)
+    peak_memory = models.IntegerField(null=True, blank=True)
+    checkpoint = models.CharField(max_length=255, blank=True)
+    resumed_from = models.ForeignKey('self', on_delete=models.SET_NULL,
+                                     null=True, blank=True,
+                                     related_name='resumed_by')
+    delta = models.BooleanField(default=False)
+    watermark = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        ordering = ['-started']
+
+    def get_phases(self):
+        """Returns the recorded phases as a list of dicts."""
+        return json.loads(self.phases or '[]')
+
+    def set_phases(self, phases):
+        """Stores a list of phase dicts."""
+        self.phases = json.dumps(phases)
+
+    def completed_phases(self):
+        """Returns the names of the phases whose writes were committed."""
+        return [phase['name'] for phase in self.get_phases()
+                if phase['outcome'] in ('succeeded', 'skipped', 'resumed')]
+
+    def get_problems(self):
+        """Returns the recorded problems as a dict."""
+        return json.loads(self.problems or '{}')
+
+    def set_problems(self, problems):
+        """Stores a dict of problems, see `ImportReport.as_dict`."""
+        self.problems = json.dumps(problems)
+
+    @property
+    def seconds(self):
+        """Returns the total wall time of the import in seconds."""
+        if self.finished is None:
+            return None
+        return (self.finished - self.started).total_seconds()
+
+    def as_dict(self):
+        """Returns the run as a plain, JSON serializable dict."""
+        return {
+            'id': self.id,
+            'started': self.started.isoformat(),
+            'finished': self.finished.isoformat() if self.finished else None,
+            'status': self.get_status_display(),
+            'seconds': self.seconds,
+            'error': self.error,
+            'peak_memory': self.peak_memory,
+            'phases': self.get_phases(),
+            'problems': self.get_problems(),
+            'resumed_from': self.resumed_from_id,
+            'delta': self.delta,
+            'watermark': self.watermark,
+        }
+
+    def __str__(self):
+        return 'Import {0} ({1})'.format(
+            self.started.strftime('%Y-%m-%d %H:%M'), self.get_status_display())
+
+
+class StagedFaculty(models.Model):
+    """Staging table for `fs_faculty.txt` rows, used by `StagingImport`.
+
+    The staging tables are emptied at the start and the end of every staged
+    import and are never read outside of it.
+    """
+    line = models.IntegerField()
+    person_id = models.CharField(max_length=200, db_index=True)
+    first_name = models.CharField(max_length=200)
+    last_name = models.CharField(max_length=200)
+    email = models.CharField(max_length=254)
+    preferred_name = models.CharField(max_length=200)
+
+
+class StagedSection(models.Model):
+    """Staging table for `fs_classes.txt` rows, used by `StagingImport`."""
+    line = models.IntegerField()
+    section_id = models.CharField(max_length=30, db_index=True)
+    course_number = models.CharField(max_length=30, db_index=True)
+    course_name = models.CharField(max_length=200)
+    section_number = models.CharField(max_length=30)
+    teacher = models.CharField(max_length=200)
+    coteacher = models.CharField(max_length=200)
+    school_year = models.CharField(max_length=30)
+    room = models.CharField(max_length=30)
+    period = models.CharField(max_length=30)
+
+
+class StagedStudent(models.Model):
+    """Staging table for `fs_student.txt` rows, used by `StagingImport`."""
+    line = models.IntegerField()
+    person_id = models.CharField(max_length=200, db_index=True)
+    grade_level = models.CharField(max_length=2)
+    first_name = models.CharField(max_length=200)
+    last_name = models.CharField(max_length=200)
+    email = models.CharField(max_length=254)
+
+
+class StagedContact(models.Model):
+    """Staging table for `fs_parent.txt` contact blocks.
+
+    Every CNT{number} block of a parent file row is stored as its own row.
+    `position` orders the blocks as they appear in the file.
+    """
+    position = models.IntegerField()
+    student_number = models.CharField(max_length=200, db_index=True)
+    person_id = models.CharField(max_length=200, db_index=True)
+    first_name = models.CharField(max_length=200)
+    last_name = models.CharField(max_length=200)
+    relationship = models.CharField(max_length=30)
+    cell_number = models.CharField(max_length=128)
+    email = models.CharField(max_length=254)
+
+
+class StagedEnrollment(models.Model):
+    """Staging table for `fs_enrollment.txt` rows, used by `StagingImport`."""
+    student_number = models.CharField(max_length=200, db_index=True)
+    section_id = models.CharField(max_length=30, db_index=True)
@@ -37,6 +37,17 @@ env = environ.Env(
     DJO_SFTP_USER=(str, ''),
     DJO_SFTP_PASS=(str, ''),
     DJO_SFTP_FINGERPRINT=(str, ''),
+    DJO_SFTP_POOL_IDLE_TIMEOUT=(int, 1200),
+    DJO_IMPORT_SOURCE=(str, ''),
+    DJO_IMPORT_DELTA_SOURCE=(str, ''),
+    DJO_IMPORT_STAGED=(bool, False),
+    DJO_IMPORT_PHASE_WORKERS=(int, 1),
+    DJO_IMPORT_PARSE_WORKERS=(int, 1),
+    DJO_IMPORT_LOCK_TIMEOUT=(int, 7200),
+    DJO_IMPORT_CHECKPOINT_DIR=(str, ''),
+    DJO_IMPORT_VALIDATION=(str, 'proceed'),
+    DJO_IMPORT_PHONE_REGION=(str, 'US'),
+    DJO_IMPORT_SNAPSHOT_PATH=(str, ''),
     EMAIL_HOST=(str, ''),
     EMAIL_PORT=(str, ''),
     EMAIL_HOST_USER=(str, ''),
@@ -303,6 +314,17 @@ DJO_SFTP_HOST = env('DJO_SFTP_HOST')
 DJO_SFTP_USER = env('DJO_SFTP_USER')
 DJO_SFTP_PASS = env('DJO_SFTP_PASS')
 DJO_SFTP_FINGERPRINT = env('DJO_SFTP_FINGERPRINT')
+DJO_SFTP_POOL_IDLE_TIMEOUT = env('DJO_SFTP_POOL_IDLE_TIMEOUT')
+DJO_IMPORT_SOURCE = env('DJO_IMPORT_SOURCE')
+DJO_IMPORT_DELTA_SOURCE = env('DJO_IMPORT_DELTA_SOURCE')
+DJO_IMPORT_STAGED = env('DJO_IMPORT_STAGED')
+DJO_IMPORT_PHASE_WORKERS = env('DJO_IMPORT_PHASE_WORKERS')
+DJO_IMPORT_PARSE_WORKERS = env('DJO_IMPORT_PARSE_WORKERS')
+DJO_IMPORT_LOCK_TIMEOUT = env('DJO_IMPORT_LOCK_TIMEOUT')
+DJO_IMPORT_CHECKPOINT_DIR = env('DJO_IMPORT_CHECKPOINT_DIR') or None
+DJO_IMPORT_VALIDATION = env('DJO_IMPORT_VALIDATION')
+DJO_IMPORT_PHONE_REGION = env('DJO_IMPORT_PHONE_REGION')
+DJO_IMPORT_SNAPSHOT_PATH = env('DJO_IMPORT_SNAPSHOT_PATH') or None
 
 
 EMAIL_HOST = env('EMAIL_HOST')
@@ -17,13 +17,23 @@ limitations under the License.
 
 from __future__ import absolute_import, unicode_literals
 
+import socket
+
+import paramiko
 from celery import shared_task
+from celery.signals import worker_process_shutdown
 from celery.utils.log import get_task_logger
 
 from django.conf import settings
 from django.core.mail import send_mass_mail
-
-from .djo import DJOImport
+from django.db import DatabaseError, InterfaceError, OperationalError
+
+from .djo import DJOImport, resumable_run
+from .djo_delta import DeltaImport
+from .djo_lock import ImportLock
+from .djo_sources import (POOL_IDLE_TIMEOUT, SESSION_POOL, SFTPSource,
+                          source_from_url)
+from .djo_watch import exports_changed, forget_export_stats
 from .models import FieldTrip, PermissionSlip, PermissionSlipLink
 
 LOGGER = get_task_logger(__name__)
@@ -33,16 +43,156 @@ def async_print(value):
     print(value)
 
 
+def sftp_pool():
+    """ Return the SSH session pool of this worker process.
+
+    Imports borrow an open connection to the SFTP dropsite from the pool
+    instead of opening a new one every run. Returns `None` if pooling is
+    disabled with a `DJO_SFTP_POOL_IDLE_TIMEOUT` of 0.
+    """
+    idle_timeout = getattr(settings, 'DJO_SFTP_POOL_IDLE_TIMEOUT',
+                           POOL_IDLE_TIMEOUT)
+    if not idle_timeout:
+        return None
+    SESSION_POOL.idle_timeout = idle_timeout
+    return SESSION_POOL
+
+
+@worker_process_shutdown.connect
+def close_sftp_pool(**kwargs):
+    """ Close the pooled SSH connections when a worker process exits. """
+    SESSION_POOL.close()
+
+
+# Errors that may well be gone when the import is retried: a dropped
+# database connection, a network error or an SFTP server that went away.
+# Other database errors, e.g. an IntegrityError, would only fail again, and
+# so would other OSErrors, e.g. a missing or unreadable export file.
+TRANSIENT_IMPORT_ERRORS = (OperationalError, InterfaceError, ConnectionError,
+                           socket.timeout, EOFError, paramiko.SSHException)
+
+
+@shared_task(bind=True, autoretry_for=TRANSIENT_IMPORT_ERRORS,
+             retry_backoff=60, max_retries=3)
+def async_djo_import_enrollment_data(self):
+    """ Import all DJO enrollment data.
+
+    Only one import runs at a time. If another import is running, this one
+    is turned into a single follow-up run of it, see `ImportLock`.
+
+    Transient errors are retried a few times. With a checkpoint directory
+    configured, a retry resumes the failed import instead of starting over.
+    Once the import failed for good, the next poll of
+    `async_watch_djo_exports` queues another one.
+    """
+    lock = ImportLock()
+    if not lock.acquire():
+        return
+    try:
+        djo_import_enrollment_data(retrying=self.request.retries > 0)
+    except Exception as error:
+        if (not isinstance(error, TRANSIENT_IMPORT_ERRORS)
+                or self.request.retries >= self.max_retries):
+            try:
+                forget_export_stats()
+            except DatabaseError:
+                LOGGER.exception("Could not reset the export watcher.")
+        raise
+    finally:
+        if lock.release():
+            LOGGER.info("Import requested during the run, queueing another.")
+            lock.trigger(async_djo_import_enrollment_data.delay)
+
+
+def import_source():
+    """ Return the source of the full exports configured in the settings. """
+    source_url = getattr(settings, 'DJO_IMPORT_SOURCE', '')
+    if source_url:
+        return source_from_url(source_url, pool=sftp_pool())
+    return SFTPSource(getattr(settings, 'DJO_SFTP_HOST'),
+                      getattr(settings, 'DJO_SFTP_USER'),
+                      getattr(settings, 'DJO_SFTP_PASS'),
+                      getattr(settings, 'DJO_SFTP_FINGERPRINT'),
+                      pool=sftp_pool())
+
+
 @shared_task
-def async_djo_import_enrollment_data():
-    """ Import all DJO enrollment data. """
-    print("Importing DJO enrollment data")
-    sftp_host = getattr(settings, 'DJO_SFTP_HOST')
-    sftp_user = getattr(settings, 'DJO_SFTP_USER')
-    sftp_pass = getattr(settings, 'DJO_SFTP_PASS')
-    sftp_fingerprint = getattr(settings, 'DJO_SFTP_FINGERPRINT')
-    djoimport = DJOImport.GetFromSFTP(sftp_host, sftp_user, sftp_pass, sftp_fingerprint)
-    djoimport.import_all()
+def async_watch_djo_exports():
+    """ Queue an import if the DJO export files changed since the last poll.
+
+    Only the modification time and size of the files are looked at, so this
+    is cheap enough to be scheduled every minute or two in place of
+    scheduling `async_djo_import_enrollment_data` itself.
+    """
+    if exports_changed(import_source()):
+        LOGGER.info("DJO exports changed, queueing an import.")
+        ImportLock().trigger(async_djo_import_enrollment_data.delay)
+
+
+def djo_import_enrollment_data(retrying=False):
+    """ Import all DJO enrollment data without taking the import lock.
+
+    A failed import is only resumed from its checkpoint when `retrying` it
+    after a transient error, see `resumable_run`.
+    """
+    LOGGER.info("Importing DJO enrollment data.")
+    # Scheduled imports only touch the files and rows that changed since the
+    # last run.
+    options = {
+        'skip_unchanged': True,
+        'phase_workers': getattr(settings, 'DJO_IMPORT_PHASE_WORKERS', 1),
+        'parse_workers': getattr(settings, 'DJO_IMPORT_PARSE_WORKERS', 1),
+        'checkpoint_dir': getattr(settings, 'DJO_IMPORT_CHECKPOINT_DIR', None),
+        'validation': getattr(settings, 'DJO_IMPORT_VALIDATION', 'proceed'),
+        'phone_region': getattr(settings, 'DJO_IMPORT_PHONE_REGION', 'US'),
+        'snapshot_path': getattr(settings, 'DJO_IMPORT_SNAPSHOT_PATH', None),
+    }
+    staged = getattr(settings, 'DJO_IMPORT_STAGED', False)
+    # Staged imports keep no checkpoint and cannot be resumed.
+    failed_run = None if staged else resumable_run(retrying)
+    if failed_run is not None:
+        LOGGER.info("Resuming failed import %d.", failed_run.id)
+        djoimport = DJOImport.Resume(failed_run, **options)
+    else:
+        djoimport = DJOImport.FromSource(import_source(), **options)
+    if staged:
+        djoimport.import_staged()
+    else:
+        djoimport.import_all()
+
+
+@shared_task(autoretry_for=TRANSIENT_IMPORT_ERRORS, retry_backoff=60,
+             max_retries=3)
+def async_djo_import_delta():
+    """ Import the latest DJO delta export.
+
+    Meant to be scheduled every few minutes. A delta is dropped while another
+    import runs; the next one picks up its changes. A full import requested
+    during the delta is queued once it completed.
+    """
+    lock = ImportLock()
+    if not lock.acquire(coalesce=False):
+        LOGGER.info("Another import is running, skipping the delta.")
+        return
+    try:
+        djo_import_delta()
+    finally:
+        if lock.release():
+            LOGGER.info("Import requested during the delta, queueing it.")
+            lock.trigger(async_djo_import_enrollment_data.delay)
+
+
+def djo_import_delta():
+    """ Import the latest DJO delta export without taking the import lock. """
+    source_url = getattr(settings, 'DJO_IMPORT_DELTA_SOURCE', '')
+    if not source_url:
+        LOGGER.info("No DJO_IMPORT_DELTA_SOURCE configured.")
+        return
+    source = source_from_url(source_url, pool=sftp_pool())
+    phone_region = getattr(settings, 'DJO_IMPORT_PHONE_REGION', 'US')
+    with DeltaImport.FromSource(source,
+                                phone_region=phone_region) as djoimport:
+        djoimport.import_all()
 
 
 @shared_task
@@ -15,11 +15,30 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import os
+import threading
+from datetime import timedelta
 from io import BytesIO
-from django.test import TestCase
-from paperlesspermission.models import Faculty, Course, Section, Student, Guardian
-from paperlesspermission.djo import DJOImport
-from paperlesspermission.utils import disable_logging
+from tempfile import TemporaryDirectory
+from unittest import mock
+from django.db import DatabaseError, connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from paperlesspermission.models import Faculty, Course, Section, Student, Guardian, ImportFileState, ImportRun
+from paperlesspermission.djo import DJOImport, EXPORT_FILES, InvalidExportError, TransactionBatches, bulk_upsert, reconcile_links, resumable_run, run_phase_graph, sweep_hidden
+from paperlesspermission.djo_synthetic import SyntheticRoster
+from paperlesspermission.utils import disable_logging, file_digest
+
+
+def statements(queries):
+    """Returns the captured queries, leaving out transaction savepoints.
+
+    Inside a TestCase every transaction run by the importer becomes a
+    savepoint, which is not a statement the importer asked for.
+    """
+    return [query['sql'] for query in queries.captured_queries
+            if 'SAVEPOINT' not in query['sql']]
 
 
 class DJOImportTestCase(TestCase):
@@ -96,6 +115,50 @@ class DJOImportTestCase(TestCase):
         self.fs_enrollment.close()
 
 
+class GetFromSFTPTests(TestCase):
+    """Tests the GetFromSFTP() constructor with a fake SSH client."""
+
+    def setUp(self):
+        self.channels = []
+
+        def open_sftp():
+            channel = mock.Mock()
+            channel.getfo.side_effect = (
+                lambda path, fileobj: fileobj.write(path.encode()))
+            self.channels.append(channel)
+            return channel
+
+        patcher = mock.patch('paperlesspermission.djo_sources.paramiko')
+        self.paramiko = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ssh_client = self.paramiko.client.SSHClient.return_value
+        self.ssh_client.open_sftp.side_effect = open_sftp
+
+    @disable_logging
+    def test_get_from_sftp(self):
+        """Tests that every file is downloaded over its own channel."""
+        with DJOImport.GetFromSFTP('host', 'user', 'pass', 'AAAA') as importer:
+            for attribute, filename in EXPORT_FILES:
+                fileobj = getattr(importer, attribute)
+                fileobj.seek(0)
+                self.assertEqual(fileobj.read(),
+                                 b'ps_data_export/' + filename.encode())
+
+        self.assertEqual(len(self.channels), len(EXPORT_FILES))
+        for channel in self.channels:
+            channel.close.assert_called_once_with()
+        self.ssh_client.close.assert_called_once_with()
+
+    @disable_logging
+    def test_get_from_sftp_failure(self):
+        """Tests that a failed download closes the connection and raises."""
+        self.ssh_client.open_sftp.side_effect = OSError('channel closed')
+
+        with self.assertRaises(OSError):
+            DJOImport.GetFromSFTP('host', 'user', 'pass', 'AAAA')
+        self.ssh_client.close.assert_called_once_with()
+
+
 class ImportFacultyTests(DJOImportTestCase):
     """Tests the import_faculty() method"""
 
@@ -207,6 +270,132 @@ class ImportFacultyTests(DJOImportTestCase):
         self.assertFalse(Faculty.objects.get(person_id='1004').hidden)
 
 
+class BulkUpsertTests(TestCase):
+    """Tests the bulk_upsert() helper."""
+
+    fields = ['first_name', 'last_name', 'email', 'preferred_name']
+
+    def setUp(self):
+        self.records = {
+            '1001': {'first_name': 'John', 'last_name': 'Doe',
+                     'email': 'jdoe@school.test', 'preferred_name': 'Dr. Doe'},
+            '1002': {'first_name': 'Alice', 'last_name': 'Hartman',
+                     'email': 'ahartman@school.test',
+                     'preferred_name': 'Ms. Hartman'},
+        }
+
+    def test_creates_missing_rows(self):
+        """Tests that unknown keys are created with the given defaults."""
+        result = bulk_upsert(Faculty, 'person_id', self.records, self.fields,
+                             defaults={'notify_cell': False})
+
+        self.assertEqual(result, (2, 0, 0))
+        self.assertEqual(Faculty.objects.count(), 2)
+        self.assertFalse(Faculty.objects.get(person_id='1001').notify_cell)
+
+    def test_skips_unchanged_rows(self):
+        """Tests that a repeated upsert does not write anything."""
+        bulk_upsert(Faculty, 'person_id', self.records, self.fields,
+                    defaults={'notify_cell': False})
+
+        # One SELECT for the existing rows and no writes.
+        with self.assertNumQueries(1):
+            result = bulk_upsert(Faculty, 'person_id', self.records,
+                                 self.fields, defaults={'notify_cell': False})
+        self.assertEqual(result, (0, 0, 2))
+
+    def test_updates_changed_rows(self):
+        """Tests that only changed rows are updated."""
+        bulk_upsert(Faculty, 'person_id', self.records, self.fields,
+                    defaults={'notify_cell': False})
+
+        self.records['1002']['last_name'] = 'Smith'
+        result = bulk_upsert(Faculty, 'person_id', self.records, self.fields,
+                             defaults={'notify_cell': False})
+
+        self.assertEqual(result, (0, 1, 1))
+        self.assertEqual(Faculty.objects.get(person_id='1002').last_name,
+                         'Smith')
+
+
+class SweepHiddenTests(TestCase):
+    """Tests the sweep_hidden() helper."""
+
+    def setUp(self):
+        for number in range(10):
+            Course.objects.create(course_number=str(number),
+                                  course_name='Course {0}'.format(number),
+                                  hidden=number >= 5)
+
+    def visible(self):
+        return set(Course.objects.filter(hidden=False)
+                   .values_list('course_number', flat=True))
+
+    def test_sweep_hidden(self):
+        """Tests that unseen rows are hidden and seen rows are unhidden."""
+        # Load the keys and flags, unhide and hide.
+        with CaptureQueriesContext(connection) as queries:
+            result = sweep_hidden(Course, 'course_number', ['0', '1', '7'])
+
+        self.assertEqual(len(statements(queries)), 3)
+        self.assertEqual(result, (3, 1))
+        self.assertEqual(self.visible(), {'0', '1', '7'})
+
+    def test_sweep_hidden_chunked(self):
+        """Tests the sweep when the seen keys do not fit in one statement."""
+        result = sweep_hidden(Course, 'course_number', ['0', '1', '7'],
+                              chunk_size=2)
+
+        self.assertEqual(result, (3, 1))
+        self.assertEqual(self.visible(), {'0', '1', '7'})
+
+
+class TransactionBatchesTests(TestCase):
+    """Tests the TransactionBatches helper."""
+
+    def create_courses(self, numbers):
+        for number in numbers:
+            if number == 'fail':
+                raise ValueError(number)
+            Course.objects.create(course_number=number, course_name=number)
+        return len(numbers)
+
+    def test_run_chunks(self):
+        """Tests that every chunk is written in its own transaction."""
+        batches = TransactionBatches(size=2)
+
+        result = batches.run('classes', ['1', '2', '3'], self.create_courses)
+
+        self.assertEqual(result, [2, 1])
+        self.assertEqual([batch.rows for batch in batches.batches], [2, 1])
+        summary = batches.summary()['classes']
+        self.assertEqual(summary['transactions'], 2)
+        self.assertEqual(summary['rows'], 3)
+        # The TestCase transaction turns every batch into a savepoint.
+        self.assertEqual(summary['commits'], 0)
+
+    def test_run_unbatched(self):
+        """Tests that a size of None writes everything at once."""
+        batches = TransactionBatches(size=None)
+
+        batches.run('classes', ['1', '2', '3'], self.create_courses)
+        batches.run('classes', [], self.create_courses)
+
+        self.assertEqual([batch.rows for batch in batches.batches], [3])
+
+    def test_failed_chunk_is_rolled_back(self):
+        """Tests that only the failing chunk is rolled back."""
+        batches = TransactionBatches(size=2)
+
+        with self.assertRaises(ValueError):
+            batches.run('classes', ['1', '2', '3', 'fail'],
+                        self.create_courses)
+
+        self.assertEqual(
+            set(Course.objects.values_list('course_number', flat=True)),
+            {'1', '2'})
+
+
 class ImportClassesTest(DJOImportTestCase):
     """Test the import_classes() method."""
 
@@ -298,6 +487,43 @@ class ImportClassesTest(DJOImportTestCase):
 
         self.assertTrue(Section.objects.get(section_id='15122').hidden)
 
+    @disable_logging
+    def test_import_classes_teachers(self):
+        """Tests that teachers and coteachers are linked to sections."""
+        self.importer.import_faculty()
+        self.importer.import_classes()
+
+        section = Section.objects.get(section_id='15131')
+        self.assertEqual(section.teacher.person_id, '1004')
+        self.assertEqual(section.coteacher.person_id, '1001')
+        self.assertIsNone(Section.objects.get(section_id='15110').coteacher)
+
+    @disable_logging
+    def test_import_classes_unknown_teacher(self):
+        """Tests that unknown teachers are reported instead of raising."""
+        self.importer.import_faculty()
+        Faculty.objects.filter(person_id='1001').delete()
+        self.importer.import_classes()
+
+        self.assertEqual(Section.objects.count(), 4)
+        self.assertIsNone(Section.objects.get(section_id='15110').teacher)
+        self.assertEqual(self.importer.report.problems['unknown_teacher'],
+                         [('15110', '1001')])
+        self.assertEqual(self.importer.report.problems['unknown_coteacher'],
+                         [('15131', '1001')])
+
+    @disable_logging
+    def test_import_classes_unchanged(self):
+        """Tests that re-importing the same classes does not write rows."""
+        self.importer.import_faculty()
+        self.importer.import_classes()
+
+        # Faculty map, course upsert, course map, section upsert and one
+        # SELECT for each of the two sweeps.
+        with CaptureQueriesContext(connection) as queries:
+            self.importer.import_classes()
+        self.assertEqual(len(statements(queries)), 6)
+
 
 class ImportStudentsTest(DJOImportTestCase):
     @disable_logging
@@ -460,6 +686,67 @@ class ImportGuardiansTest(DJOImportTestCase):
         # Third test: ensure hidden flag removed on parent
         self.assertFalse(Guardian.objects.get(person_id='98').hidden)
 
+    @disable_logging
+    def test_import_guardians_links(self):
+        """Tests that guardian/student links follow the parent file."""
+        self.importer.import_faculty()
+        self.importer.import_classes()
+        self.importer.import_students()
+        self.importer.import_guardians()
+
+        self.assertEqual(Guardian.students.through.objects.count(), 10)
+        self.assertEqual(set(Guardian.objects.get(person_id='91')
+                             .students.values_list('person_id', flat=True)),
+                         {'1', '3'})
+
+        # Student 3 no longer lists guardians 91 and 92, and guardian 98
+        # disappears entirely.
+        self.importer.fs_parent = BytesIO(
+            b'STUDENT_NUMBER\tCNT1_ID\tCNT1_FNAME\tCNT1_LNAME\tCNT1_REL\tCNT1_CPHONE\tCNT1_EMAIL\tCNT2_ID\tCNT2_FNAME\tCNT2_LNAME\tCNT2_REL\tCNT2_CPHONE\tCNT2_EMAIL\tCNT3_ID\tCNT3_FNAME\tCNT3_LNAME\tCNT3_REL\tCNT3_CPHONE\tCNT3_EMAIL\n'
+            + b'1\t91\tJupiter\tTesco\tMother\t703-555-1111\tjtesco@gmail.test\t92\tAdam\tTesco\tFather\t703-555-2222\tate@gmail.test\t\t\t\t\t\t\n'
+            + b'2\t93\tGarv\tCallis\tFather\t701-555-3333\tgcallis0@email.test\t94\tKarla\tCallis\tMother\t\tkcallis@gmail.test\t95\tDukey\tMacConal\tGrandparent\t201-555-6666\tdmacconnal5@sun.test\n'
+            + b'4\t96\tAlford\tLordon\tFather\t843-444-3222\talorton@gmail.test\t\t\t\t\t\t\t\t\t\t\t\t\n'
+            + b'5\t97\tBax\tKimm\tFather\t433-555-5555\tbkimm@gmail.test\t\t\t\t\t\t\t\t\t\t\t\t\n'
+        )
+        self.importer.import_guardians()
+
+        self.assertEqual(set(Guardian.objects.get(person_id='91')
+                             .students.values_list('person_id', flat=True)),
+                         {'1'})
+        # Hidden guardians keep their students for historical records.
+        self.assertTrue(Guardian.objects.get(person_id='98')
+                        .students.filter(person_id='6').exists())
+
+    @disable_logging
+    def test_import_guardians_phone_numbers(self):
+        """Tests that cell numbers are stored in E.164 form and numbers
+        that cannot be parsed or are impossible are reported and dropped."""
+        self.importer.import_students()
+        self.importer.fs_parent = BytesIO(self.importer.fs_parent.getvalue()
+                                          .replace(b'433-555-5555', b'n/a')
+                                          .replace(b'323-555-2222',
+                                                   b'555-2222'))
+        self.importer.import_guardians()
+
+        self.assertEqual(Guardian.objects.get(person_id='91').cell_number,
+                         '+17035551111')
+        self.assertTrue(Guardian.objects.get(person_id='91').notify_cell)
+        self.assertEqual(Guardian.objects.get(person_id='97').cell_number, '')
+        self.assertFalse(Guardian.objects.get(person_id='97').notify_cell)
+        self.assertEqual(Guardian.objects.get(person_id='98').cell_number, '')
+        self.assertFalse(Guardian.objects.get(person_id='98').notify_cell)
+        self.assertEqual(self.importer.report.as_dict(),
+                         {'invalid_phone': [['97', 'n/a'], ['98', '555-2222']]})
+
+    @disable_logging
+    def test_import_guardians_unknown_student(self):
+        """Tests that rows for unknown students are skipped and reported."""
+        self.importer.import_students()
+        Student.objects.filter(person_id='6').delete()
+
+        self.assertEqual(self.importer.import_guardians(), ['6'])
+        self.assertFalse(Guardian.objects.get(person_id='98').students.exists())
+
 
 class ImportEnrollmentTest(DJOImportTestCase):
     @disable_logging
@@ -528,6 +815,113 @@ class ImportEnrollmentTest(DJOImportTestCase):
                                         .exists())
 
 
+class ReconcileLinksTests(DJOImportTestCase):
+    """Tests the reconcile_links() helper."""
+
+    @disable_logging
+    def setUp(self):
+        super().setUp()
+        self.importer.import_faculty()
+        self.importer.import_classes()
+        self.importer.import_students()
+        self.through = Section.students.through
+        self.sections = dict(Section.objects.values_list('section_id', 'id'))
+        self.students = dict(Student.objects.values_list('person_id', 'id'))
+
+    def link(self, section_id, person_id):
+        return (self.sections[section_id], self.students[person_id])
+
+    def test_reconcile_links(self):
+        """Tests that only the difference is written."""
+        links = {self.link('15110', '1'), self.link('15110', '2')}
+        self.assertEqual(reconcile_links(self.through, 'section_id',
+                                         'student_id', links), (2, 0))
+
+        links = {self.link('15110', '1'), self.link('15121', '1')}
+        self.assertEqual(reconcile_links(self.through, 'section_id',
+                                         'student_id', links), (1, 1))
+        self.assertEqual(set(self.through.objects.values_list(
+            'section_id', 'student_id')), links)
+
+    def test_reconcile_links_unchanged(self):
+        """Tests that reconciling an unchanged relation writes nothing."""
+        links = {self.link('15110', '1'), self.link('15110', '2')}
+        reconcile_links(self.through, 'section_id', 'student_id', links)
+
+        self.assertEqual(reconcile_links(self.through, 'section_id',
+                                         'student_id', links), (0, 0))
+
+    def test_reconcile_links_sources(self):
+        """Tests that links of other sources are left alone."""
+        links = {self.link('15110', '1'), self.link('15121', '1')}
+        reconcile_links(self.through, 'section_id', 'student_id', links)
+
+        result = reconcile_links(self.through, 'section_id', 'student_id',
+                                 set(), sources={self.sections['15110']})
+        self.assertEqual(result, (0, 1))
+        self.assertEqual(set(self.through.objects.values_list(
+            'section_id', 'student_id')), {self.link('15121', '1')})
+
+
+class ValidateTests(DJOImportTestCase):
+    """Tests the validate() method and the validation policies."""
+
+    def setUp(self):
+        super().setUp()
+        # Student 6 left, but is still enrolled and has a guardian.
+        self.fs_student = BytesIO(self.fs_student.getvalue().replace(
+            b'6\t12\tTaylor\tJohnston\t18tjohnston6@school.test\n', b''))
+        self.fs_enrollment = BytesIO(
+            self.fs_enrollment.getvalue() + b'1\t99999\n')
+
+    def make_importer(self, validation):
+        return DJOImport(self.fs_classes, self.fs_faculty, self.fs_student,
+                         self.fs_parent, self.fs_enrollment,
+                         validation=validation)
+
+    @disable_logging
+    def test_validate(self):
+        """Tests that dangling references are found without any query."""
+        importer = self.make_importer('proceed')
+        with self.assertNumQueries(0):
+            self.assertEqual(importer.validate(), 3)
+
+        self.assertEqual(importer.validation_report.as_dict(), {
+            'dangling_guardian_student': [['98', '6']],
+            'dangling_enrolled_student': [['15131', '6']],
+            'dangling_section': [['1', '99999']],
+        })
+
+    @disable_logging
+    def test_abort(self):
+        """Tests that the abort policy fails before anything is written."""
+        with self.assertRaises(InvalidExportError):
+            self.make_importer('abort').import_all()
+
+        self.assertFalse(Faculty.objects.exists())
+        run = ImportRun.objects.get()
+        self.assertEqual(run.status, ImportRun.FAILED)
+        self.assertIn('dangling_section', run.get_problems())
+
+    @disable_logging
+    def test_proceed_and_skip(self):
+        """Tests that skip leaves out links the export cannot back up."""
+        self.importer.import_all()
+
+        self.make_importer('proceed').import_all()
+        student = Student.objects.get(person_id='6')
+        self.assertTrue(student.hidden)
+        self.assertEqual(student.section_set.count(), 1)
+
+        self.make_importer('skip').import_all()
+        self.assertEqual(student.section_set.count(), 0)
+        self.assertEqual(student.guardian_set.count(), 0)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            self.make_importer('ignore')
+
+
 class ImportAllTests(DJOImportTestCase):
     @disable_logging
     def test_import_all(self):
@@ -549,3 +943,372 @@ class ImportAllTests(DJOImportTestCase):
                 importer.import_all()
         except Exception:
             self.fail("With syntax did not successfully run.")
+
+    @disable_logging
+    def test_transaction_batches(self):
+        """Tests that the phases write in transactions of the given size."""
+        importer = DJOImport(self.fs_classes, self.fs_faculty,
+                             self.fs_student, self.fs_parent,
+                             self.fs_enrollment, transaction_batch_size=4)
+        importer.import_all()
+
+        summary = importer.transactions.summary()
+        # The 6 new students are created in two transactions.
+        self.assertEqual(summary['students']['transactions'], 2)
+        self.assertEqual(summary['students']['rows'], 6)
+        self.assertEqual(summary['enrollment']['rows'], 12)
+
+    @disable_logging
+    def test_atomic_import_rolls_back(self):
+        """Tests that a failed atomic import leaves the roster untouched."""
+        importer = DJOImport(self.fs_classes, self.fs_faculty,
+                             self.fs_student, self.fs_parent,
+                             self.fs_enrollment, atomic=True)
+
+        with mock.patch.object(importer, 'import_enrollment',
+                               side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            importer.import_all()
+
+        self.assertFalse(Faculty.objects.exists())
+        self.assertFalse(Student.objects.exists())
+
+    @disable_logging
+    def test_import_run_recorded(self):
+        """Tests that every phase is measured and recorded."""
+        self.importer.import_all()
+
+        run = ImportRun.objects.get()
+        self.assertEqual(run, self.importer.import_run)
+        self.assertEqual(run.status, ImportRun.SUCCEEDED)
+        self.assertIsNotNone(run.seconds)
+        phases = {phase['name']: phase for phase in run.get_phases()}
+        self.assertEqual(list(phases), [name for name, _, _ in DJOImport.PHASES])
+        self.assertEqual(phases['faculty']['outcome'], 'succeeded')
+        self.assertEqual(phases['faculty']['rows_read'], 4)
+        self.assertEqual(phases['faculty']['rows_written'], 4)
+        self.assertGreater(phases['faculty']['queries'], 0)
+        self.assertEqual(phases['enrollment']['rows_written'], 12)
+        self.assertEqual(run.as_dict()['status'], 'Succeeded')
+
+    @disable_logging
+    def test_import_run_skipped_rows(self):
+        """Tests that unchanged records are counted as skipped."""
+        self.importer.import_all()
+        self.importer.import_all()
+
+        phases = {phase['name']: phase
+                  for phase in self.importer.import_run.get_phases()}
+        self.assertEqual(phases['students']['rows_skipped'], 6)
+        self.assertEqual(phases['students']['rows_written'], 0)
+
+    @disable_logging
+    def test_failed_import_run_recorded(self):
+        """Tests that a failed import is recorded with its error."""
+        with mock.patch.object(self.importer, 'import_enrollment',
+                               side_effect=RuntimeError('boom')), \
+                self.assertRaises(RuntimeError):
+            self.importer.import_all()
+
+        run = ImportRun.objects.get()
+        self.assertEqual(run.status, ImportRun.FAILED)
+        self.assertIn('boom', run.error)
+        self.assertEqual(run.get_phases()[-1]['outcome'], 'failed')
+
+    @disable_logging
+    def test_failed_import_keeps_completed_phases(self):
+        """Tests that phases before a failure are kept without `atomic`."""
+        with mock.patch.object(self.importer, 'import_enrollment',
+                               side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            self.importer.import_all()
+
+        self.assertEqual(Student.objects.count(), 6)
+
+
+class ResumeTests(DJOImportTestCase):
+    """Tests checkpoints and DJOImport.Resume()."""
+
+    def setUp(self):
+        super().setUp()
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint_dir = directory.name
+
+    def failed_run(self, phase='import_guardians', **kwargs):
+        importer = DJOImport(self.fs_classes, self.fs_faculty,
+                             self.fs_student, self.fs_parent,
+                             self.fs_enrollment,
+                             checkpoint_dir=self.checkpoint_dir, **kwargs)
+        with mock.patch.object(importer, phase,
+                               side_effect=DatabaseError('gone away')), \
+                self.assertRaises(DatabaseError):
+            importer.import_all()
+        return importer.import_run
+
+    @disable_logging
+    def test_resume(self):
+        """Tests that a resumed import only runs the phases left to do."""
+        failed = self.failed_run()
+        self.assertEqual(failed.completed_phases(),
+                         ['faculty', 'classes', 'students'])
+        self.assertEqual(sorted(os.listdir(failed.checkpoint)),
+                         [filename for _, filename in sorted(EXPORT_FILES)])
+        self.assertEqual(resumable_run(retrying=True), failed)
+
+        with DJOImport.Resume(failed, checkpoint_dir=self.checkpoint_dir) \
+                as importer, \
+                mock.patch.object(importer, 'import_students') as students:
+            importer.import_all()
+
+        students.assert_not_called()
+        self.assertEqual([phase['outcome'] for phase in importer.stats],
+                         ['resumed'] * 3 + ['succeeded'] * 2)
+        self.assertEqual(Guardian.objects.count(), 8)
+        self.assertEqual(importer.import_run.resumed_from, failed)
+        self.assertEqual(importer.import_run.checkpoint, '')
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+        self.assertIsNone(resumable_run(retrying=True))
+
+    @disable_logging
+    def test_failure_not_retried(self):
+        """Tests that a failed import is only resumed by its retry."""
+        failed = self.failed_run()
+        self.assertIsNone(resumable_run())
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+        failed.refresh_from_db()
+        self.assertEqual(failed.checkpoint, '')
+
+    @disable_logging
+    def test_outdated_not_resumed(self):
+        """Tests that imports started long ago are not resumed."""
+        failed = self.failed_run()
+        ImportRun.objects.filter(id=failed.id).update(
+            status=ImportRun.RUNNING,
+            started=timezone.now() - timedelta(days=1))
+        self.assertIsNone(resumable_run(retrying=True))
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+    @disable_logging
+    def test_resume_interrupted(self):
+        """Tests that a run left running by a dead worker is resumed."""
+        failed = self.failed_run()
+        ImportRun.objects.filter(id=failed.id).update(status=ImportRun.RUNNING)
+        failed.refresh_from_db()
+
+        DJOImport.Resume(failed).close()
+
+        failed.refresh_from_db()
+        self.assertEqual(failed.status, ImportRun.FAILED)
+        self.assertEqual(failed.error, 'Interrupted')
+
+    @disable_logging
+    def test_give_up(self):
+        """Tests that an import failing again and again is given up on."""
+        failed = self.failed_run()
+        for _ in range(3):
+            with DJOImport.Resume(failed) as importer, \
+                    mock.patch.object(importer, 'import_guardians',
+                                      side_effect=DatabaseError), \
+                    self.assertRaises(DatabaseError):
+                importer.import_all()
+            failed = importer.import_run
+
+        self.assertIsNone(resumable_run(retrying=True))
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+    @disable_logging
+    def test_atomic_failure_not_resumed(self):
+        """Tests that phases rolled back with the import are run again."""
+        failed = self.failed_run(atomic=True)
+        self.assertEqual(failed.completed_phases(), [])
+
+
+class RunPhaseGraphTests(TestCase):
+    """Tests the run_phase_graph() function."""
+
+    def test_dependency_order(self):
+        """Tests that phases wait for their dependencies and no longer."""
+        started = []
+        both_running = threading.Barrier(2, timeout=5)
+
+        def run(name):
+            started.append(name)
+            if name in ('faculty', 'students'):
+                # Fails with BrokenBarrierError unless both run at once.
+                both_running.wait()
+
+        run_phase_graph(
+            [(name, depends) for name, _, depends in DJOImport.PHASES],
+            run, workers=3)
+
+        self.assertEqual(set(started[:2]), {'faculty', 'students'})
+        self.assertLess(started.index('faculty'), started.index('classes'))
+        self.assertLess(started.index('students'), started.index('guardians'))
+        self.assertEqual(started[-1], 'enrollment')
+
+    def test_failure(self):
+        """Tests that a failed phase stops the phases depending on it."""
+        started = []
+
+        def run(name):
+            started.append(name)
+            if name == 'a':
+                raise KeyError(name)
+
+        with self.assertRaises(KeyError):
+            run_phase_graph([('a', ()), ('b', ('a',))], run, workers=2)
+        self.assertEqual(started, ['a'])
+
+    def test_cycle(self):
+        with self.assertRaises(ValueError):
+            run_phase_graph([('a', ('b',)), ('b', ('a',))], print, workers=2)
+
+
+class ConcurrentImportTests(TransactionTestCase):
+    """Tests DJOImport(phase_workers=...).
+
+    The phases write on their own connections, so the data has to be
+    committed for the test to see it.
+    """
+
+    @disable_logging
+    def test_concurrent_import(self):
+        roster = SyntheticRoster(students=30, faculty=5, courses=4,
+                                 sections=8, enrollments=120)
+        importer = DJOImport(**roster.files(), phase_workers=3)
+        importer.import_all()
+
+        self.assertFalse(importer.report)
+        self.assertEqual([phase['name'] for phase in importer.stats],
+                         [name for name, _, _ in DJOImport.PHASES])
+        self.assertEqual(Faculty.objects.count(), 5)
+        self.assertEqual(Student.objects.count(), 30)
+        self.assertEqual(Section.students.through.objects.count(), 120)
+        self.assertEqual(ImportRun.objects.get().status, ImportRun.SUCCEEDED)
+
+
+class PeakMemoryTests(TestCase):
+    """Tests the peak memory recorded per phase and per run."""
+
+    @disable_logging
+    def test_peak_memory_per_phase(self):
+        roster = SyntheticRoster(students=5, faculty=2, courses=2,
+                                 sections=2, enrollments=10)
+        importer = DJOImport(**roster.files())
+        # The start and end of each phase, then the end of the run. The
+        # peak before the first phase is the one of loading the snapshot.
+        peaks = [300, 100, 5, 50, 5, 200, 5, 20, 5, 30, 40]
+        with mock.patch('paperlesspermission.djo.peak_memory',
+                        side_effect=peaks), \
+                mock.patch('paperlesspermission.djo.reset_peak_memory',
+                           return_value=True) as reset:
+            importer.import_all()
+
+        self.assertEqual([phase['peak_memory'] for phase in importer.stats],
+                         [100, 50, 200, 20, 30])
+        self.assertEqual(ImportRun.objects.get().peak_memory, 300)
+        self.assertEqual(reset.call_count, 1 + len(DJOImport.PHASES))
+
+
+class SkipUnchangedTests(DJOImportTestCase):
+    """Tests the file digest and row fingerprint change detection."""
+
+    def make_importer(self):
+        for fileobj in (self.fs_classes, self.fs_faculty, self.fs_student,
+                        self.fs_parent, self.fs_enrollment):
+            fileobj.seek(0)
+        return DJOImport(self.fs_classes, self.fs_faculty, self.fs_student,
+                         self.fs_parent, self.fs_enrollment,
+                         skip_unchanged=True)
+
+    def phases_run(self, importer):
+        return [name for name, _, _ in importer.PHASES
+                if importer.run_phase(name)]
+
+    @disable_logging
+    def test_first_import_runs_all_phases(self):
+        """Tests that every phase runs when nothing was imported before."""
+        self.assertEqual(self.phases_run(self.make_importer()),
+                         ['faculty', 'classes', 'students', 'guardians',
+                          'enrollment'])
+        self.assertEqual(ImportFileState.objects.count(), 5)
+        self.assertEqual(len(ImportFileState.objects.get(name='students')
+                             .get_row_fingerprints()), 6)
+
+    @disable_logging
+    def test_unchanged_import_skips_all_phases(self):
+        """Tests that re-importing identical files does nothing."""
+        self.make_importer().import_all()
+
+        self.assertEqual(self.phases_run(self.make_importer()), [])
+
+    @disable_logging
+    def test_concurrent_phases_share_digests(self):
+        """Tests that the files are digested once, before the phases run."""
+        importer = self.make_importer()
+        importer.phase_workers = 3
+
+        def run_concurrently():
+            # Every digest was worked out before the first phase started.
+            self.assertEqual(digest.call_count, len(DJOImport.PHASES))
+            for name, _, _ in importer.PHASES:
+                importer.measure_phase(name)
+
+        with mock.patch('paperlesspermission.djo.file_digest',
+                        wraps=file_digest) as digest, \
+                mock.patch.object(importer, 'run_concurrently',
+                                  run_concurrently):
+            importer.import_all()
+
+        self.assertEqual(digest.call_count, len(DJOImport.PHASES))
+        expected = {name: self.make_importer().phase_digest(name)
+                    for name, _, _ in DJOImport.PHASES}
+        self.assertEqual(dict(ImportFileState.objects.values_list(
+            'name', 'digest')), expected)
+
+    @disable_logging
+    def test_changed_file_reruns_dependent_phases(self):
+        """Tests that a changed file reruns its phase and its dependents."""
+        self.make_importer().import_all()
+
+        self.fs_faculty = BytesIO(
+            self.fs_faculty.getvalue().replace(b'Dr. Doe', b'Prof. Doe'))
+        self.assertEqual(self.phases_run(self.make_importer()),
+                         ['faculty', 'classes', 'enrollment'])
+        self.assertEqual(Faculty.objects.get(person_id='1001').preferred_name,
+                         'Prof. Doe')
+
+    @disable_logging
+    def test_unchanged_rows_are_skipped(self):
+        """Tests that only rows with a new fingerprint are compared."""
+        self.make_importer().import_all()
+
+        self.fs_student = BytesIO(
+            self.fs_student.getvalue().replace(b'Abe', b'Abraham'))
+        importer = self.make_importer()
+        skip = {}
+
+        def bulk_upsert_spy(*args, **kwargs):
+            skip.update(dict.fromkeys(kwargs['skip']))
+            return bulk_upsert(*args, **kwargs)
+
+        with mock.patch('paperlesspermission.djo.bulk_upsert',
+                        bulk_upsert_spy):
+            importer.run_phase('students')
+
+        self.assertEqual(set(skip), {'2', '3', '4', '5', '6'})
+        self.assertEqual(Student.objects.get(person_id='1').first_name,
+                         'Abraham')
+
+    @disable_logging
+    def test_skipped_rows_missing_from_database_are_created(self):
+        """Tests that unchanged rows deleted from the database come back."""
+        self.make_importer().import_all()
+        Student.objects.filter(person_id='6').delete()
+
+        self.fs_student = BytesIO(
+            self.fs_student.getvalue().replace(b'Abe', b'Abraham'))
+        self.make_importer().run_phase('students')
+
+        self.assertTrue(Student.objects.filter(person_id='6').exists())
@@ -0,0 +1,183 @@
+"""Test module for djo_delta.py
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+from tempfile import TemporaryDirectory
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from paperlesspermission.models import (Faculty, Guardian, ImportFileState,
+                                        ImportRun, Section, Student)
+from paperlesspermission.djo_delta import (DeltaGapError, DeltaImport,
+                                           current_watermark)
+from paperlesspermission.djo_sources import DirectorySource
+from paperlesspermission.test_djo import DJOImportTestCase
+from paperlesspermission.utils import disable_logging
+
+
+class DeltaImportTests(DJOImportTestCase):
+    """Tests the DeltaImport class on top of a full import."""
+
+    @disable_logging
+    def setUp(self):
+        super().setUp()
+        self.importer.skip_unchanged = True
+        self.importer.import_all()
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write_delta(self, since, until, dry_run=False, **files):
+        """Writes a delta export and returns a `DeltaImport` reading it."""
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        files['fs_delta'] = b'SINCE\tUNTIL\n' + '{0}\t{1}\n'.format(
+            since, until).encode()
+        for attribute, data in files.items():
+            with open(os.path.join(self.directory, attribute + '.txt'),
+                      'wb') as fileobj:
+                fileobj.write(data)
+        return DeltaImport.FromSource(DirectorySource(self.directory),
+                                      dry_run=dry_run)
+
+    @disable_logging
+    def test_import_delta(self):
+        with self.write_delta(
+                '', '2020-05-06T08:15:00',
+                fs_faculty=(
+                    b'CHANGE\tRECORDID\tFIRST_NAME\tLAST_NAME\tEMAIL_ADDR\t'
+                    b'PREFERREDNAME\n'
+                    b'U\t1002\tAlice\tHart\tahart@school.test\tMs. Hart\n'),
+                fs_student=(
+                    b'CHANGE\tRECORDID\tGRADE_LEVEL\tFIRST_NAME\tLAST_NAME\t'
+                    b'EMAIL\n'
+                    b'D\t6\t12\tTaylor\tJohnston\t18tjohnston6@school.test\n'
+                    b'U\t7\t9\tNew\tStudent\t21nstudent7@school.test\n'),
+                fs_parent=(
+                    b'CHANGE\tSTUDENT_NUMBER\t' + b'\t'.join(
+                        'CNT{0}_{1}'.format(i, column).encode()
+                        for i in range(1, 4) for column in (
+                            'ID', 'FNAME', 'LNAME', 'REL', 'CPHONE', 'EMAIL'))
+                    + b'\n'
+                    b'U\t3\t91\tJupiter\tTesco\tMother\t703-555-1111\t'
+                    b'jtesco@gmail.test\n'
+                    b'U\t7\t99\tNew\tParent\tMother\t\tnparent@gmail.test\n'),
+                fs_enrollment=(
+                    b'CHANGE\tSTUDENT_NUMBER\tSECTIONID\n'
+                    b'D\t1\t15121\n'
+                    b'U\t7\t15121\n'
+                    b'U\t7\t99999\n')) as delta:
+            delta.import_all()
+
+        self.assertEqual(Faculty.objects.get(person_id='1002').last_name,
+                         'Hart')
+        self.assertTrue(Student.objects.get(person_id='6').hidden)
+        self.assertFalse(Student.objects.get(person_id='5').hidden)
+        self.assertEqual(
+            set(Student.objects.get(person_id='3').guardian_set.values_list(
+                'person_id', flat=True)), {'91'})
+        self.assertEqual(
+            set(Student.objects.get(person_id='1').guardian_set.values_list(
+                'person_id', flat=True)), {'91', '92'})
+        self.assertEqual(
+            set(Guardian.objects.get(person_id='99').students.values_list(
+                'person_id', flat=True)), {'7'})
+        self.assertEqual(
+            set(Section.objects.get(section_id='15121').students.values_list(
+                'person_id', flat=True)), {'7'})
+        self.assertEqual(delta.report.as_dict(),
+                         {'unknown_section': [['7', '99999']]})
+
+        run = ImportRun.objects.filter(delta=True).get()
+        self.assertEqual(run.status, ImportRun.SUCCEEDED)
+        self.assertEqual(current_watermark(), '2020-05-06T08:15:00')
+        self.assertEqual(
+            [phase['outcome'] for phase in run.get_phases()],
+            ['succeeded', 'skipped', 'succeeded', 'succeeded', 'succeeded'])
+        # The next full import has to look at the faculty file again.
+        self.assertEqual(ImportFileState.objects.get(name='faculty').digest,
+                         '')
+        self.assertNotEqual(ImportFileState.objects.get(name='classes').digest,
+                            '')
+
+    @disable_logging
+    def test_watermarks(self):
+        """Tests that old deltas are skipped and gaps are refused."""
+        enrollment = b'CHANGE\tSTUDENT_NUMBER\tSECTIONID\nD\t1\t15121\n'
+        with self.write_delta('', '2020-05-06T08:15',
+                              fs_enrollment=enrollment) as delta:
+            delta.import_all()
+        with self.write_delta('2020-05-06T08:00', '2020-05-06T08:15',
+                              fs_enrollment=enrollment) as delta:
+            delta.import_all()
+        self.assertEqual(ImportRun.objects.filter(delta=True).count(), 1)
+
+        with self.write_delta('2020-05-06T08:30', '2020-05-06T08:45',
+                              fs_enrollment=enrollment) as delta:
+            with self.assertRaises(DeltaGapError):
+                delta.import_all()
+        self.assertEqual(current_watermark(), '2020-05-06T08:15')
+
+    @disable_logging
+    def test_full_import_resets_watermark(self):
+        """Tests that a full import recovers from a gap between deltas."""
+        enrollment = b'CHANGE\tSTUDENT_NUMBER\tSECTIONID\nD\t1\t15121\n'
+        with self.write_delta('', '2020-05-06T08:15',
+                              fs_enrollment=enrollment) as delta:
+            delta.import_all()
+        with self.write_delta('2020-05-06T08:30', '2020-05-06T08:45',
+                              fs_enrollment=enrollment) as delta:
+            with self.assertRaises(DeltaGapError):
+                delta.import_all()
+
+        self.importer.import_all()
+        self.assertIsNone(current_watermark())
+        with self.write_delta('2020-05-06T08:30', '2020-05-06T08:45',
+                              fs_enrollment=enrollment) as delta:
+            delta.import_all()
+        self.assertEqual(current_watermark(), '2020-05-06T08:45')
+        self.assertFalse(Section.objects.get(
+            section_id='15121').students.filter(person_id='1').exists())
+
+    @disable_logging
+    def test_dry_run(self):
+        with self.write_delta('', '1', dry_run=True, fs_student=(
+                b'CHANGE\tRECORDID\tGRADE_LEVEL\tFIRST_NAME\tLAST_NAME\t'
+                b'EMAIL\n'
+                b'D\t6\t12\tTaylor\tJohnston\t18tjohnston6@school.test\n'
+                b'U\t7\t9\tNew\tStudent\t21nstudent7@school.test\n')) as delta:
+            delta.import_all()
+
+        self.assertEqual(delta.diff.summary(), {
+            'student': {'created': 1, 'hidden': 1}})
+        self.assertFalse(Student.objects.filter(person_id='7').exists())
+        self.assertIsNone(current_watermark())
+
+    @disable_logging
+    def test_import_command(self):
+        self.write_delta('', '2', fs_student=(
+            b'CHANGE\tRECORDID\tGRADE_LEVEL\tFIRST_NAME\tLAST_NAME\tEMAIL\n'
+            b'D\t6\t12\tTaylor\tJohnston\t18tjohnston6@school.test\n')).close()
+        call_command('import', '--delta', '--source', self.directory)
+        self.assertTrue(Student.objects.get(person_id='6').hidden)
+
+        self.write_delta('3', '4').close()
+        with self.assertRaises(CommandError):
+            call_command('import', '--delta', '--source', self.directory)
+
+    def test_missing_manifest(self):
+        with self.assertRaises(FileNotFoundError):
+            DeltaImport.FromSource(DirectorySource(self.directory))
@@ -0,0 +1,162 @@
+"""Test module for djo_diff.py and dry-run imports
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import os
+from io import BytesIO, StringIO
+from tempfile import TemporaryDirectory
+from unittest import mock
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from paperlesspermission.models import Faculty, Student, Guardian, ImportFileState
+from paperlesspermission.djo import DJOImport
+from paperlesspermission.djo_diff import ImportDiff
+from paperlesspermission.test_djo import DJOImportTestCase, statements
+from paperlesspermission.utils import disable_logging
+
+
+class ImportDiffTests(TestCase):
+    """Tests the ImportDiff class."""
+
+    def test_record(self):
+        """Tests that changes are grouped by table and kind."""
+        diff = ImportDiff()
+        diff.record('student', 'created', ['2', '1'])
+        diff.record('student', 'hidden', [])
+        diff.record('student', 'updated', [['3', ['email']]])
+
+        self.assertEqual(diff.created('student'), ['2', '1'])
+        self.assertEqual(diff.summary(), {'student': {'created': 2,
+                                                      'updated': 1}})
+        self.assertEqual(diff.as_dict(), {'student': {
+            'created': ['1', '2'], 'updated': [['3', ['email']]]}})
+
+    def test_label_links(self):
+        """Tests that links are shown with their upstream keys."""
+        diff = ImportDiff()
+        diff.record('section_students', 'added', [(1, 2), (1, ('new', '7'))])
+        diff.label_links('section_students', {1: '15110'},
+                         {2: '1', ('new', '7'): '7'})
+
+        self.assertEqual(diff.as_dict(), {'section_students': {
+            'added': [['15110', '1'], ['15110', '7']]}})
+
+    def test_bool(self):
+        diff = ImportDiff()
+        self.assertFalse(diff)
+        diff.record('course', 'hidden', ['0001'])
+        self.assertTrue(diff)
+
+
+class DryRunTests(DJOImportTestCase):
+    """Tests DJOImport(dry_run=True)."""
+
+    def dry_run(self):
+        for fileobj in (self.fs_classes, self.fs_faculty, self.fs_student,
+                        self.fs_parent, self.fs_enrollment):
+            fileobj.seek(0)
+        importer = DJOImport(self.fs_classes, self.fs_faculty,
+                             self.fs_student, self.fs_parent,
+                             self.fs_enrollment, dry_run=True,
+                             skip_unchanged=True)
+        with CaptureQueriesContext(connection) as queries:
+            importer.import_all()
+        self.queries = statements(queries)
+        return importer
+
+    @disable_logging
+    def test_dry_run_into_empty_database(self):
+        """Tests that rows to be created are linked without being written."""
+        importer = self.dry_run()
+
+        self.assertFalse(Faculty.objects.exists())
+        self.assertFalse(ImportFileState.objects.exists())
+        self.assertTrue(all(query.startswith('SELECT')
+                            for query in self.queries))
+        self.assertFalse(importer.report)
+        self.assertEqual(importer.diff.summary(), {
+            'faculty': {'created': 4},
+            'course': {'created': 3},
+            'section': {'created': 4},
+            'student': {'created': 6},
+            'guardian': {'created': 8},
+            'guardian_students': {'added': 10},
+            'section_students': {'added': 12},
+        })
+        self.assertIn(['15131', '6'],
+                      importer.diff.as_dict()['section_students']['added'])
+
+    @disable_logging
+    def test_dry_run_changes(self):
+        """Tests updates, hidden flags and removed links."""
+        self.importer.import_all()
+        Student.objects.filter(person_id='5').update(hidden=True)
+
+        self.fs_student = BytesIO(
+            self.fs_student.getvalue().replace(b'Abe', b'Abraham'))
+        self.fs_faculty = BytesIO(
+            self.fs_faculty.getvalue().replace(b'1004\tAndy', b'1005\tAndy'))
+        self.fs_enrollment = BytesIO(
+            self.fs_enrollment.getvalue().replace(b'6\t15131\n', b''))
+        importer = self.dry_run()
+
+        self.assertEqual(importer.diff.as_dict(), {
+            'faculty': {'created': ['1005'], 'hidden': ['1004']},
+            'student': {'unhidden': ['5'],
+                        'updated': [['1', ['first_name']]]},
+            'section_students': {'removed': [['15131', '6']]},
+        })
+        self.assertEqual(Student.objects.get(person_id='1').first_name, 'Abe')
+        self.assertEqual(Guardian.objects.count(), 8)
+
+    @disable_logging
+    def test_dry_run_unchanged(self):
+        """Tests that re-importing the same files finds no changes."""
+        self.importer.import_all()
+
+        importer = self.dry_run()
+
+        self.assertFalse(importer.diff)
+        self.assertLessEqual(len(self.queries), 20)
+
+
+class ImportCommandDryRunTests(DJOImportTestCase):
+    """Tests the --dry-run option of the import command."""
+
+    @disable_logging
+    def test_dry_run_command(self):
+        """Tests the printed summary and the diff file."""
+        def get_from_sftp(*args, **kwargs):
+            return DJOImport(self.fs_classes, self.fs_faculty,
+                             self.fs_student, self.fs_parent,
+                             self.fs_enrollment, **kwargs)
+
+        out = StringIO()
+        with TemporaryDirectory() as directory, \
+                mock.patch.object(DJOImport, 'GetFromSFTP', get_from_sftp):
+            diff_path = os.path.join(directory, 'diff.json')
+            call_command('import', 'host', 'user', 'pass', 'AAAA',
+                         dry_run=True, diff_file=diff_path, stdout=out)
+            with open(diff_path) as diff_file:
+                diff = json.load(diff_file)
+
+        self.assertFalse(Student.objects.exists())
+        self.assertIn('student: 6 created', out.getvalue())
+        self.assertEqual(len(diff['changes']['student']['created']), 6)
+        self.assertEqual(diff['problems'], {})
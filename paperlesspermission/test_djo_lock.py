@@ -0,0 +1,236 @@
+"""Test module for djo_lock.py
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from io import StringIO
+from unittest import mock
+from celery.exceptions import Retry
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from paperlesspermission import tasks
+from paperlesspermission.djo import DJOImport
+from paperlesspermission.djo_lock import ImportLock, LOCK_KEY
+from paperlesspermission.utils import disable_logging
+
+LOCMEM_CACHE = {'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ImportLockTests(TestCase):
+    """Tests the ImportLock class."""
+
+    def setUp(self):
+        cache.clear()
+        self.queue = mock.Mock()
+
+    def test_single_holder(self):
+        """Tests that only one import holds the lease at a time."""
+        first, second = ImportLock(), ImportLock()
+
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        self.assertTrue(ImportLock.is_running())
+
+        first.release()
+        self.assertFalse(ImportLock.is_running())
+        self.assertTrue(second.acquire())
+
+    @disable_logging
+    def test_release_keeps_other_lease(self):
+        """Tests that an expired lease does not release its successor."""
+        expired = ImportLock()
+        expired.acquire()
+        cache.set(LOCK_KEY, 'successor')
+
+        expired.release()
+        self.assertEqual(cache.get(LOCK_KEY), 'successor')
+
+    def test_trigger_coalesces_queued(self):
+        """Tests that an import is only queued once until it starts."""
+        lock = ImportLock()
+        self.assertEqual(lock.trigger(self.queue), ImportLock.QUEUED)
+        self.assertEqual(lock.trigger(self.queue), ImportLock.ALREADY_QUEUED)
+        self.queue.assert_called_once_with()
+
+        lock.acquire()
+        lock.release()
+        self.assertEqual(lock.trigger(self.queue), ImportLock.QUEUED)
+
+    @disable_logging
+    def test_trigger_while_running(self):
+        """Tests that triggers during a run request one follow-up run."""
+        running = ImportLock()
+        running.acquire()
+
+        for _ in range(3):
+            self.assertEqual(ImportLock().trigger(self.queue),
+                             ImportLock.FOLLOW_UP)
+        self.queue.assert_not_called()
+
+        self.assertTrue(running.release())
+        self.assertFalse(ImportLock.follow_up_requested())
+
+    @disable_logging
+    def test_trigger_during_release(self):
+        """Tests that a trigger racing the release is not lost."""
+        running = ImportLock()
+        running.acquire()
+        delete = cache.delete
+        outcomes = []
+
+        def racing_delete(key, *args, **kwargs):
+            if key == LOCK_KEY:
+                # Triggered while the lease is still held.
+                outcomes.append(ImportLock().trigger(self.queue))
+            return delete(key, *args, **kwargs)
+
+        with mock.patch.object(cache, 'delete', racing_delete):
+            self.assertTrue(running.release())
+        self.assertEqual(outcomes, [ImportLock.FOLLOW_UP])
+        self.assertFalse(ImportLock.follow_up_requested())
+
+    def test_delta_not_coalesced(self):
+        """Tests that a delta neither requests a follow-up nor dequeues."""
+        lock = ImportLock()
+        lock.trigger(self.queue)
+        delta = ImportLock()
+        self.assertTrue(delta.acquire(coalesce=False))
+        self.assertEqual(lock.trigger(self.queue), ImportLock.FOLLOW_UP)
+
+        self.assertFalse(ImportLock().acquire(coalesce=False))
+        self.assertTrue(delta.release())
+        self.assertEqual(lock.trigger(self.queue), ImportLock.ALREADY_QUEUED)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ImportTaskLockTests(TestCase):
+    """Tests the lock around async_djo_import_enrollment_data."""
+
+    def setUp(self):
+        cache.clear()
+
+    @disable_logging
+    def test_concurrent_task_skipped(self):
+        """Tests that a task started during an import only requests a rerun."""
+        running = ImportLock()
+        running.acquire()
+        with mock.patch.object(tasks, 'djo_import_enrollment_data') as run:
+            tasks.async_djo_import_enrollment_data()
+
+        run.assert_not_called()
+        self.assertTrue(ImportLock.follow_up_requested())
+
+    @disable_logging
+    def test_follow_up_queued(self):
+        """Tests that a follow-up requested during the run is queued."""
+        def run(retrying):
+            ImportLock().trigger(delay)
+
+        with mock.patch.object(tasks, 'djo_import_enrollment_data', run), \
+                mock.patch.object(tasks.async_djo_import_enrollment_data,
+                                  'delay') as delay:
+            tasks.async_djo_import_enrollment_data()
+
+        delay.assert_called_once_with()
+        self.assertFalse(ImportLock.is_running())
+
+    @disable_logging
+    def test_retry_resumes(self):
+        """Tests that only a retry of the task resumes a failed import."""
+        task = tasks.async_djo_import_enrollment_data
+        with mock.patch.object(tasks, 'djo_import_enrollment_data') as run:
+            task.apply()
+            task.apply(retries=1)
+
+        self.assertEqual(run.call_args_list, [mock.call(retrying=False),
+                                              mock.call(retrying=True)])
+
+    @disable_logging
+    def test_missing_export_not_retried(self):
+        """Tests that a missing export fails the import for good."""
+        task = tasks.async_djo_import_enrollment_data
+        with mock.patch.object(tasks, 'djo_import_enrollment_data',
+                               side_effect=FileNotFoundError) as run, \
+                mock.patch.object(tasks, 'forget_export_stats') as forget:
+            result = task.apply()
+
+        self.assertEqual(result.state, 'FAILURE')
+        self.assertEqual(run.call_count, 1)
+        forget.assert_called_once_with()
+
+    @disable_logging
+    def test_connection_error_retried(self):
+        """Tests that a dropped connection is retried."""
+        task = tasks.async_djo_import_enrollment_data
+        with mock.patch.object(tasks, 'djo_import_enrollment_data',
+                               side_effect=ConnectionResetError), \
+                mock.patch.object(tasks, 'forget_export_stats') as forget, \
+                mock.patch.object(task, 'retry',
+                                  side_effect=Retry) as retry:
+            result = task.apply()
+
+        self.assertEqual(result.state, 'RETRY')
+        retry.assert_called_once()
+        forget.assert_not_called()
+
+    @disable_logging
+    def test_missing_delta_not_retried(self):
+        """Tests that a missing delta export is not retried."""
+        task = tasks.async_djo_import_delta
+        with mock.patch.object(tasks, 'djo_import_delta',
+                               side_effect=FileNotFoundError), \
+                mock.patch.object(task, 'retry') as retry:
+            result = task.apply()
+
+        self.assertEqual(result.state, 'FAILURE')
+        retry.assert_not_called()
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ImportCommandLockTests(TestCase):
+    """Tests the lock around the import command."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_command_refused_while_running(self):
+        running = ImportLock()
+        running.acquire()
+        with mock.patch.object(DJOImport, 'GetFromSFTP') as get_from_sftp, \
+                self.assertRaises(CommandError):
+            call_command('import', 'host', 'user', 'pass', 'AAAA')
+        get_from_sftp.assert_not_called()
+        self.assertFalse(ImportLock.follow_up_requested())
+
+    def test_command_holds_lock(self):
+        def import_all():
+            self.assertTrue(ImportLock.is_running())
+            ImportLock().trigger(delay)
+
+        with mock.patch.object(DJOImport, 'GetFromSFTP') as get_from_sftp, \
+                mock.patch.object(tasks.async_djo_import_enrollment_data,
+                                  'delay') as delay:
+            get_from_sftp.return_value.import_all.side_effect = import_all
+            call_command('import', 'host', 'user', 'pass', 'AAAA',
+                         stdout=StringIO())
+
+        delay.assert_called_once_with()
+        self.assertFalse(ImportLock.is_running())
+
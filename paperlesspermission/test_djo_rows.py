@@ -0,0 +1,158 @@
+"""Test module for djo_rows.py
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+import multiprocessing
+
+from django.test import TestCase
+from paperlesspermission.models import Faculty, ImportRun
+from paperlesspermission.djo_rows import (ContactRow, EnrollmentRow,
+                                          FacultyRow, HeaderError,
+                                          normalize_phone, read_rows,
+                                          read_rows_parallel, split_lines)
+from paperlesspermission.djo_synthetic import SyntheticRoster
+from paperlesspermission.test_djo import DJOImportTestCase
+from paperlesspermission.utils import disable_logging
+
+
+class ReadRowsTests(TestCase):
+    """Tests the read_rows() function."""
+
+    def test_faculty(self):
+        """Tests that columns are matched by name, not position."""
+        fileobj = BytesIO(
+            b'PREFERREDNAME\tRECORDID\tFIRST_NAME\tLAST_NAME\tEMAIL_ADDR\tX\n'
+            b'Dr. Doe\t1001\tJohn\tDoe\tjdoe@school.test\textra\n')
+        self.assertEqual(list(read_rows('fs_faculty', fileobj)), [
+            FacultyRow('1001', 'John', 'Doe', 'jdoe@school.test', 'Dr. Doe')])
+
+    def test_guardian_contacts(self):
+        """Tests that the three contact blocks are split up."""
+        fileobj = BytesIO(
+            b'STUDENT_NUMBER\tCNT1_ID\tCNT1_FNAME\tCNT1_LNAME\tCNT1_REL\t'
+            b'CNT1_CPHONE\tCNT1_EMAIL\tCNT2_ID\tCNT2_FNAME\tCNT2_LNAME\t'
+            b'CNT2_REL\tCNT2_CPHONE\tCNT2_EMAIL\tCNT3_ID\tCNT3_FNAME\t'
+            b'CNT3_LNAME\tCNT3_REL\tCNT3_CPHONE\tCNT3_EMAIL\n'
+            b'4\t\t\t\t\t\t\t96\tAlford\tLordon\tFather\t843-444-3222\t'
+            b'alorton@gmail.test\n')
+        row, = read_rows('fs_parent', fileobj)
+
+        self.assertEqual(row.student_number, '4')
+        self.assertEqual(row.contacts, (
+            None,
+            ContactRow('96', 'Alford', 'Lordon', 'Father', '843-444-3222',
+                       'alorton@gmail.test'),
+            None))
+
+    def test_short_and_blank_lines(self):
+        """Tests that blank lines are skipped and short rows are padded."""
+        fileobj = BytesIO(b'STUDENT_NUMBER\tSECTIONID\n1\t15110\n\n2\n')
+        self.assertEqual(list(read_rows('fs_enrollment', fileobj)), [
+            EnrollmentRow('1', '15110'), EnrollmentRow('2', '')])
+
+    def test_missing_column(self):
+        """Tests that a changed header fails before any row is read."""
+        fileobj = BytesIO(b'STUDENT_NUMBER\tSECTION_ID\n1\t15110\n')
+        with self.assertRaisesRegex(HeaderError,
+                                    'fs_enrollment.txt .* SECTIONID'):
+            next(read_rows('fs_enrollment', fileobj))
+
+
+class ParallelParseTests(TestCase):
+    """Tests the split_lines() and read_rows_parallel() functions."""
+
+    def setUp(self):
+        roster = SyntheticRoster(students=200, faculty=10, courses=5,
+                                 sections=20, enrollments=1000)
+        self.data = roster.to_bytes('fs_parent')
+
+    def test_split_lines(self):
+        header, chunks = split_lines(BytesIO(self.data), chunk_size=1000)
+        chunks = list(chunks)
+        self.assertGreater(len(chunks), 5)
+        self.assertEqual(header + b''.join(chunks), self.data)
+        for chunk in chunks:
+            self.assertTrue(chunk.endswith(b'\n'))
+
+    def test_split_lines_quoted(self):
+        """Tests that a quoted value spanning lines is not split up."""
+        fileobj = BytesIO(b'A\tB\n1\t"x\ny"\n2\tz\n')
+        header, chunks = split_lines(fileobj, chunk_size=4)
+        self.assertEqual(list(chunks), [b'1\t"x\ny"\n', b'2\tz\n'])
+
+    def test_read_rows_parallel(self):
+        expected = list(read_rows('fs_parent', BytesIO(self.data)))
+        with ThreadPoolExecutor(2) as executor:
+            self.assertEqual(list(read_rows_parallel(
+                'fs_parent', BytesIO(self.data), executor, 2,
+                chunk_size=1000)), expected)
+            # A single chunk is parsed without the executor.
+            self.assertEqual(list(read_rows_parallel(
+                'fs_parent', BytesIO(self.data), None, 2)), expected)
+
+    def test_process_pool(self):
+        expected = list(read_rows('fs_parent', BytesIO(self.data)))
+        with ProcessPoolExecutor(
+                2, mp_context=multiprocessing.get_context('spawn')) as pool:
+            self.assertEqual(list(read_rows_parallel(
+                'fs_parent', BytesIO(self.data), pool, 2, chunk_size=1000)),
+                             expected)
+
+    def test_bad_header(self):
+        with self.assertRaises(HeaderError):
+            next(read_rows_parallel('fs_enrollment',
+                                    BytesIO(b'STUDENT_NUMBER\n1\n'), None, 2))
+
+
+class NormalizePhoneTests(TestCase):
+    """Tests the normalize_phone() function."""
+
+    def test_normalize_phone(self):
+        self.assertEqual(normalize_phone('703-555-1111'), '+17035551111')
+        self.assertEqual(normalize_phone('(703) 555-1111'), '+17035551111')
+        self.assertEqual(normalize_phone('+44 20 7946 0958'), '+442079460958')
+        self.assertEqual(normalize_phone('020 7946 0958', 'GB'),
+                         '+442079460958')
+        self.assertEqual(normalize_phone(' '), '')
+        self.assertIsNone(normalize_phone('n/a'))
+
+    def test_impossible_numbers(self):
+        self.assertIsNone(normalize_phone('555-1234'))
+        self.assertIsNone(normalize_phone('12345'))
+        self.assertIsNone(normalize_phone('703-555-11111'))
+        self.assertIsNone(normalize_phone('020 7946 0958'))
+
+    def test_cached(self):
+        normalize_phone.cache_clear()
+        normalize_phone('703-555-1111')
+        normalize_phone('703-555-1111')
+        self.assertEqual(normalize_phone.cache_info().hits, 1)
+
+
+class CheckHeadersTests(DJOImportTestCase):
+    """Tests that DJOImport checks the headers before importing."""
+
+    @disable_logging
+    def test_import_all_bad_header(self):
+        self.importer.fs_enrollment = BytesIO(b'STUDENT\tSECTIONID\n1\t15110\n')
+
+        with self.assertRaises(HeaderError):
+            self.importer.import_all()
+
+        self.assertFalse(Faculty.objects.exists())
+        self.assertEqual(ImportRun.objects.get().status, ImportRun.FAILED)
@@ -0,0 +1,125 @@
+"""Test module for djo_snapshot.py
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from unittest import mock
+import gzip
+import json
+import os
+
+from paperlesspermission.models import Guardian, ImportRun, Student
+from paperlesspermission.djo_snapshot import RosterSnapshot
+from paperlesspermission.test_djo import DJOImportTestCase
+from paperlesspermission.utils import disable_logging
+
+
+class RosterSnapshotTests(DJOImportTestCase):
+    """Tests the RosterSnapshot class."""
+
+    def setUp(self):
+        super().setUp()
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'snapshot.json.gz')
+
+    @disable_logging
+    def test_from_database(self):
+        self.importer.import_all()
+        snapshot = RosterSnapshot.from_database()
+
+        students = snapshot.table(Student)
+        self.assertEqual(len(students), 6)
+        pk, record = students.get('3')
+        self.assertEqual(pk, Student.objects.get(person_id='3').id)
+        self.assertEqual(record.grade_level, '11')
+        self.assertFalse(record.hidden)
+        self.assertEqual(snapshot.table(Guardian).get('91')[1].cell_number,
+                         '+17035551111')
+        self.assertEqual(students.id_map(), dict(
+            Student.objects.values_list('person_id', 'id')))
+        self.assertEqual(snapshot.run_id, self.importer.import_run.id)
+        self.assertTrue(snapshot.is_current())
+
+        ImportRun.objects.create(status=ImportRun.FAILED)
+        self.assertFalse(snapshot.is_current())
+
+    @disable_logging
+    def test_save_and_load(self):
+        self.importer.import_all()
+        snapshot = RosterSnapshot.from_database()
+        snapshot.save(self.path)
+
+        loaded = RosterSnapshot.load(self.path)
+        self.assertEqual(loaded.run_id, snapshot.run_id)
+        for name, table in snapshot.tables.items():
+            self.assertEqual(loaded.tables[name].as_dict(), table.as_dict())
+        self.assertEqual(loaded.table(Student).get('3'),
+                         snapshot.table(Student).get('3'))
+
+        with gzip.open(self.path, 'wt') as snapshot_file:
+            json.dump({'version': 0}, snapshot_file)
+        self.assertIsNone(RosterSnapshot.load(self.path))
+        with open(self.path, 'wb') as snapshot_file:
+            snapshot_file.write(b'not a snapshot')
+        self.assertIsNone(RosterSnapshot.load(self.path))
+        os.remove(self.path)
+        self.assertIsNone(RosterSnapshot.load(self.path))
+
+    @disable_logging
+    def test_import_from_saved_snapshot(self):
+        """Tests that the next import diffs against the saved snapshot."""
+        self.importer.snapshot_path = self.path
+        self.importer.import_all()
+        self.assertTrue(os.path.exists(self.path))
+
+        self.importer.fs_student = BytesIO(
+            b'RECORDID\tGRADE_LEVEL\tFIRST_NAME\tLAST_NAME\tEMAIL\n'
+            b'1\t10\tAbe\tTesco\t20atesco1@school.test\n'
+            b'2\t10\tTessa\tAdelede\t20tadelede2@school.test\n'
+            b'3\t12\tMatt\tTesco\t19mtesco3@school.test\n'
+            b'4\t11\tAdam\tHun\t19ahun4@school.test\n'
+            b'5\t12\tMary\tWalters\t18mwalters5@school.test\n'
+            b'7\t9\tNew\tStudent\t21nstudent7@school.test\n')
+        with mock.patch.object(RosterSnapshot, 'from_database',
+                               side_effect=AssertionError):
+            self.importer.import_all()
+
+        self.assertEqual(Student.objects.get(person_id='3').grade_level, '12')
+        self.assertTrue(Student.objects.get(person_id='6').hidden)
+        self.assertTrue(Student.objects.filter(person_id='7').exists())
+        # The saved snapshot follows the changes of the second import.
+        self.assertEqual(RosterSnapshot.load(self.path).table(
+            Student).as_dict(), RosterSnapshot.from_database().table(
+                Student).as_dict())
+
+    @disable_logging
+    def test_outdated_snapshot_ignored(self):
+        self.importer.snapshot_path = self.path
+        self.importer.import_all()
+        Student.objects.filter(person_id='3').update(grade_level='9')
+        ImportRun.objects.create(status=ImportRun.FAILED)
+
+        self.importer.import_all()
+        self.assertEqual(Student.objects.get(person_id='3').grade_level, '11')
+
+    @disable_logging
+    def test_staged_import_discards_snapshot(self):
+        self.importer.snapshot_path = self.path
+        self.importer.import_all()
+        self.importer.import_staged()
+        self.assertFalse(os.path.exists(self.path))
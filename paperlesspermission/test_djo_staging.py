@@ -0,0 +1,249 @@
+"""Test module for djo_staging.py
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from io import BytesIO
+from unittest import mock
+from django.db import connection
+from paperlesspermission.models import Faculty, Course, Section, Student, Guardian, ImportFileState, ImportRun, StagedFaculty
+from paperlesspermission.djo import DJOImport, InvalidExportError
+from paperlesspermission.djo_staging import StagingImport
+from paperlesspermission.test_djo import DJOImportTestCase
+from paperlesspermission.utils import disable_logging
+
+
+def roster_state():
+    """Returns the imported roster as comparable sets of natural keys."""
+    return {
+        'faculty': set(Faculty.objects.values_list(
+            'person_id', 'first_name', 'last_name', 'email', 'preferred_name',
+            'cell_number', 'notify_cell', 'hidden')),
+        'courses': set(Course.objects.values_list(
+            'course_number', 'course_name', 'hidden')),
+        'sections': set(Section.objects.values_list(
+            'section_id', 'course__course_number', 'section_number',
+            'teacher__person_id', 'coteacher__person_id', 'school_year',
+            'room', 'period', 'hidden')),
+        'students': set(Student.objects.values_list(
+            'person_id', 'grade_level', 'first_name', 'last_name', 'email',
+            'notify_cell', 'hidden')),
+        'guardians': set(Guardian.objects.values_list(
+            'person_id', 'first_name', 'last_name', 'email', 'cell_number',
+            'notify_cell', 'relationship', 'hidden')),
+        'guardian_links': set(Guardian.students.through.objects.values_list(
+            'guardian__person_id', 'student__person_id')),
+        'enrollment': set(Section.students.through.objects.values_list(
+            'section__section_id', 'student__person_id')),
+    }
+
+
+class StagingImportTests(DJOImportTestCase):
+    """Tests that staged imports match the ORM importer."""
+
+    def reset_importer(self):
+        self.importer = DJOImport(self.fs_classes, self.fs_faculty,
+                                  self.fs_student, self.fs_parent,
+                                  self.fs_enrollment)
+
+    def orm_then_staged(self):
+        """Returns the roster after an ORM import and after a staged import
+        of the same files, the second starting from the first's database."""
+        self.reset_importer()
+        self.importer.import_all()
+        orm_state = roster_state()
+        orm_report = self.importer.report.as_dict()
+
+        self.reset_importer()
+        StagingImport(self.importer).import_all()
+        self.assertEqual(self.importer.report.as_dict(), orm_report)
+        return orm_state, roster_state()
+
+    @disable_logging
+    def test_initial_import(self):
+        """Tests that a staged import into an empty database matches."""
+        StagingImport(self.importer).import_all()
+        staged_state = roster_state()
+
+        Faculty.objects.all().delete()
+        Course.objects.all().delete()
+        Student.objects.all().delete()
+        Guardian.objects.all().delete()
+        self.reset_importer()
+        self.importer.import_all()
+
+        self.assertEqual(staged_state, roster_state())
+        self.assertEqual(len(staged_state['enrollment']), 12)
+        self.assertEqual(len(staged_state['guardian_links']), 10)
+
+    @disable_logging
+    def test_staging_tables_are_emptied(self):
+        """Tests that nothing is left in the staging tables."""
+        StagingImport(self.importer).import_all()
+
+        self.assertFalse(StagedFaculty.objects.exists())
+
+    @disable_logging
+    def test_unchanged_import(self):
+        """Tests that re-importing the same files changes nothing."""
+        orm_state, staged_state = self.orm_then_staged()
+
+        self.assertEqual(orm_state, staged_state)
+
+    @disable_logging
+    def test_changed_import(self):
+        """Tests updates, hidden flags and removed links."""
+        self.importer.import_all()
+
+        self.fs_faculty = BytesIO(
+            b'RECORDID\tFIRST_NAME\tLAST_NAME\tEMAIL_ADDR\tPREFERREDNAME\n'
+            + b'1001\tJohn\tDoe\tjdoe@school.test\tProf. Doe\n'
+            + b'1002\tAlice\tHartman\tahartman@school.test\tMs. Hartman\n'
+            + b'1003\tDoug\tAteman\tdateman@school.test\tMr. Ateman\n'
+        )
+        self.fs_classes = BytesIO(
+            b'RECORDID\tCOURSE_NUMBER\tSECTION_NUMBER\tTERMID\tSCHOOLYEAR\tTEACHER\tROOM\tCOURSE_NAME\tEXPRESSION\tCOTEACHER\n'
+            + b'15121\t0002\t1\t1901\tSemester 1\t1002\t231\tEnglish 1\t3(A1-B1,A3)\t\n'
+            + b'15122\t0002\t2\t1901\tSemester 1\t1003\t233\tEnglish 1\t3(A1-B1,A3)\t\n'
+            + b'15131\t0003\t1\t1901\t2019-2020\t1004\tGym\tPE\t3(A1-B1,A3)\t1001\n'
+        )
+        self.fs_parent = BytesIO(
+            b'STUDENT_NUMBER\tCNT1_ID\tCNT1_FNAME\tCNT1_LNAME\tCNT1_REL\tCNT1_CPHONE\tCNT1_EMAIL\tCNT2_ID\tCNT2_FNAME\tCNT2_LNAME\tCNT2_REL\tCNT2_CPHONE\tCNT2_EMAIL\tCNT3_ID\tCNT3_FNAME\tCNT3_LNAME\tCNT3_REL\tCNT3_CPHONE\tCNT3_EMAIL\n'
+            + b'1\t91\tJupiter\tTesco\tMother\t703-555-1111\tjtesco@gmail.test\t\t\t\t\t\t\t\t\t\t\t\t\n'
+            + b'2\t93\tGarv\tCallis\tFather\t701-555-3333\tgcallis0@email.test\t94\tKarla\tCallis\tMother\t\tkcallis@gmail.test\t95\tDukey\tMacConal\tGrandparent\t201-555-6666\tdmacconnal5@sun.test\n'
+            + b'7\t96\tAlford\tLordon\tFather\t843-444-3222\talorton@gmail.test\t\t\t\t\t\t\t\t\t\t\t\t\n'
+        )
+        self.fs_enrollment = BytesIO(
+            b'STUDENT_NUMBER\tSECTIONID\n'
+            + b'1\t15121\n'
+            + b'2\t15122\n'
+            + b'4\t15131\n'
+            + b'7\t15131\n'
+            + b'4\t99999\n'
+        )
+
+        orm_state, staged_state = self.orm_then_staged()
+
+        self.assertEqual(orm_state, staged_state)
+        self.assertIn(('1004', 'Andy', 'Battern', 'abattern@school.test',
+                       'Mr. Battern', '', False, True), staged_state['faculty'])
+        self.assertIn(('0001', 'Spelling', True), staged_state['courses'])
+
+    @disable_logging
+    def test_import_staged_resets_file_states(self):
+        """Tests that the next import with skip_unchanged compares again."""
+        self.importer.skip_unchanged = True
+        self.importer.import_all()
+        self.importer.import_staged()
+
+        self.assertFalse(ImportFileState.objects.exclude(
+            digest='', row_fingerprints='').exists())
+        run = ImportRun.objects.order_by('-id').first()
+        self.assertEqual(run.status, ImportRun.SUCCEEDED)
+        self.assertEqual(run.get_phases(), [])
+
+        self.importer.import_all()
+        self.assertEqual([phase['outcome'] for phase in self.importer.stats],
+                         ['succeeded'] * 5)
+
+    def test_mysql_upsert(self):
+        """Tests the upsert statement generated for MySQL and MariaDB."""
+        staging = StagingImport(self.importer)
+        with mock.patch.object(connection, 'vendor', 'mysql'), \
+                mock.patch.object(staging, '_execute') as execute:
+            staging._upsert('course', 'course_number',
+                            ['course_number', 'course_name', 'hidden'],
+                            ['s.course_number', 's.course_name', '{false}'],
+                            'FROM {staged_section} s WHERE s.line = 1',
+                            insert_only=('hidden',))
+
+        execute.assert_called_once_with(
+            'INSERT INTO {course} (course_number, course_name, hidden) '
+            'SELECT course_number, course_name, hidden FROM ('
+            'SELECT s.course_number AS course_number, '
+            's.course_name AS course_name, {false} AS hidden '
+            'FROM {staged_section} s WHERE s.line = 1) AS incoming '
+            'ON DUPLICATE KEY UPDATE '
+            '{course}.course_name = incoming.course_name')
+
+    def test_unsupported_database(self):
+        """Tests that the staged importer refuses unsupported databases."""
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                self.assertRaisesMessage(ValueError, 'postgresql'):
+            StagingImport(self.importer).import_all()
+        self.assertFalse(Faculty.objects.exists())
+
+    @disable_logging
+    def test_import_staged_fallback(self):
+        """Tests that unsupported databases use the ORM importer."""
+        with mock.patch.object(StagingImport, 'is_supported',
+                               return_value=False), \
+                mock.patch.object(StagingImport, 'import_all') as staged:
+            self.importer.import_staged()
+
+        staged.assert_not_called()
+        self.assertEqual(Section.students.through.objects.count(), 12)
+
+
+class StagedValidateTests(DJOImportTestCase):
+    """Tests that staged imports apply the validation policies."""
+
+    def setUp(self):
+        super().setUp()
+        # Student 6 left, but is still enrolled and has a guardian. The
+        # coteacher of PE is not in the export.
+        self.fs_student = BytesIO(self.fs_student.getvalue().replace(
+            b'6\t12\tTaylor\tJohnston\t18tjohnston6@school.test\n', b''))
+        self.fs_enrollment = BytesIO(
+            self.fs_enrollment.getvalue() + b'1\t99999\n')
+        self.fs_classes = BytesIO(self.fs_classes.getvalue().replace(
+            b'3(A1-B1,A3)\t1001\n', b'3(A1-B1,A3)\t1099\n'))
+
+    def make_importer(self, validation):
+        return DJOImport(self.fs_classes, self.fs_faculty, self.fs_student,
+                         self.fs_parent, self.fs_enrollment,
+                         validation=validation)
+
+    @disable_logging
+    def test_abort(self):
+        """Tests that the abort policy fails before anything is written."""
+        with self.assertRaises(InvalidExportError):
+            self.make_importer('abort').import_staged()
+
+        self.assertFalse(Faculty.objects.exists())
+        self.assertFalse(Section.objects.exists())
+        self.assertFalse(StagedFaculty.objects.exists())
+        run = ImportRun.objects.get()
+        self.assertEqual(run.status, ImportRun.FAILED)
+        self.assertIn('dangling_coteacher', run.get_problems())
+
+    @disable_logging
+    def test_skip(self):
+        """Tests that the skip policy leaves out what the ORM importer does."""
+        self.importer.import_all()
+        orm = self.make_importer('skip')
+        orm.import_all()
+        orm_state = roster_state()
+
+        self.importer.import_all()
+        staged = self.make_importer('skip')
+        staged.import_staged()
+
+        self.assertEqual(roster_state(), orm_state)
+        self.assertEqual(staged.report.as_dict(), orm.report.as_dict())
+        student = Student.objects.get(person_id='6')
+        self.assertEqual(student.section_set.count(), 0)
+        self.assertEqual(student.guardian_set.count(), 0)
+        self.assertIsNone(Section.objects.get(section_id='15131').coteacher)
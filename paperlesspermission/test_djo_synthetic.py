@@ -0,0 +1,110 @@
+"""Test module for djo_synthetic.py
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from django.test import TestCase
+from paperlesspermission.models import Faculty, Section, Student, Guardian
+from paperlesspermission.djo import DJOImport
+from paperlesspermission.djo_synthetic import (SyntheticRoster,
+                                               benchmark_parsing,
+                                               run_benchmark)
+from paperlesspermission.utils import disable_logging
+
+
+class SyntheticRosterTests(TestCase):
+    """Tests the SyntheticRoster class."""
+
+    def roster(self, seed=0):
+        return SyntheticRoster(students=60, faculty=8, courses=6, sections=15,
+                               enrollments=300, seed=seed)
+
+    def test_shape(self):
+        """Tests that every file has the requested number of rows."""
+        self.assertEqual(self.roster().shape(), {
+            'fs_faculty': 8, 'fs_classes': 15, 'fs_student': 60,
+            'fs_parent': 60, 'fs_enrollment': 300})
+
+    def test_export_layout(self):
+        """Tests that the files use the SQLRunner column layout."""
+        header = self.roster().to_bytes('fs_faculty').split(b'\n')[0]
+        self.assertEqual(
+            header,
+            b'RECORDID\tFIRST_NAME\tLAST_NAME\tEMAIL_ADDR\tPREFERREDNAME')
+
+    def test_seed(self):
+        """Tests that a seed always generates the same roster."""
+        self.assertEqual(self.roster().to_bytes('fs_parent'),
+                         self.roster().to_bytes('fs_parent'))
+        self.assertNotEqual(self.roster().to_bytes('fs_parent'),
+                            self.roster(seed=1).to_bytes('fs_parent'))
+
+    @disable_logging
+    def test_import(self):
+        """Tests that the roster imports without problems."""
+        importer = DJOImport(**self.roster().files())
+        importer.import_all()
+
+        self.assertFalse(importer.report)
+        self.assertEqual(Faculty.objects.count(), 8)
+        self.assertEqual(Section.objects.count(), 15)
+        self.assertEqual(Student.objects.count(), 60)
+        self.assertTrue(Guardian.objects.exists())
+        self.assertEqual(Section.students.through.objects.count(), 300)
+
+    @disable_logging
+    def test_churn(self):
+        """Tests that churn replaces students and imports cleanly."""
+        roster = self.roster()
+        churned = roster.churn(0.05)
+
+        before = {row['RECORDID'] for row in roster.rows['fs_student']}
+        after = {row['RECORDID'] for row in churned.rows['fs_student']}
+        self.assertEqual(len(after), 60)
+        self.assertEqual(len(before - after), 3)
+
+        DJOImport(**roster.files()).import_all()
+        importer = DJOImport(**churned.files())
+        importer.import_all()
+        self.assertFalse(importer.report)
+        self.assertEqual(Student.objects.filter(hidden=True).count(), 3)
+
+
+class RunBenchmarkTests(TestCase):
+    """Tests the run_benchmark() function."""
+
+    @disable_logging
+    def test_run_benchmark(self):
+        roster = SyntheticRoster(students=20, faculty=4, courses=3,
+                                 sections=6, enrollments=80)
+        results = run_benchmark(roster, skip_unchanged=True)
+
+        self.assertEqual(list(results['scenarios']),
+                         ['cold', 'incremental', 'unchanged'])
+        cold = results['scenarios']['cold']
+        self.assertGreater(cold['queries'], 0)
+        self.assertEqual(len(cold['phases']), 5)
+        unchanged = results['scenarios']['unchanged']
+        self.assertEqual({phase['outcome'] for phase in unchanged['phases']},
+                         {'skipped'})
+
+    def test_benchmark_parsing(self):
+        roster = SyntheticRoster(students=50, faculty=4, courses=3,
+                                 sections=6, enrollments=200)
+        results = benchmark_parsing(roster, workers=(1, 2), chunk_size=1000)
+
+        self.assertEqual([result['workers'] for result in results], [1, 2])
+        self.assertEqual({result['rows'] for result in results}, {250})
+        self.assertEqual(results[0]['speedup'], 1.0)
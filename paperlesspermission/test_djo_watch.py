@@ -0,0 +1,110 @@
+"""Test module for djo_watch.py
+
+Copyright 2020 Mark Stenglein, The Paperless Permission Authors
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from unittest import mock
+import os
+
+from django.core.cache import cache
+from django.test import override_settings
+from paperlesspermission import tasks
+from paperlesspermission.djo_sources import DirectorySource
+from paperlesspermission.djo_watch import exports_changed, forget_export_stats
+from paperlesspermission.models import ExportFileStat
+from paperlesspermission.test_djo_lock import LOCMEM_CACHE
+from paperlesspermission.test_djo_sources import SourceTestCase
+from paperlesspermission.utils import disable_logging
+
+
+class ExportsChangedTests(SourceTestCase):
+    """Tests the exports_changed() function."""
+
+    def setUp(self):
+        super().setUp()
+        self.write_directory(compress=('fs_enrollment',))
+        self.source = DirectorySource(self.directory)
+
+    def touch(self, filename, mtime):
+        path = os.path.join(self.directory, filename)
+        os.utime(path, (mtime, mtime))
+
+    @disable_logging
+    def test_exports_changed(self):
+        self.assertTrue(exports_changed(self.source))
+        self.assertFalse(exports_changed(self.source))
+
+        self.touch('fs_student.txt', 1588752000)
+        self.assertTrue(exports_changed(self.source))
+        self.assertFalse(exports_changed(self.source))
+
+        self.touch('fs_enrollment.txt.gz', 1588752000)
+        self.assertTrue(exports_changed(self.source))
+
+    @disable_logging
+    def test_removed_file(self):
+        exports_changed(self.source)
+        os.remove(os.path.join(self.directory, 'fs_parent.txt'))
+        self.assertTrue(exports_changed(self.source))
+        self.assertFalse(exports_changed(self.source))
+        self.assertIsNone(
+            ExportFileStat.objects.get(filename='fs_parent.txt').as_stat())
+
+    @disable_logging
+    def test_forget_export_stats(self):
+        self.touch('fs_student.txt', 1588752000)
+        exports_changed(self.source)
+        self.assertEqual(
+            ExportFileStat.objects.get(filename='fs_student.txt').mtime,
+            1588752000)
+
+        forget_export_stats()
+        self.assertTrue(exports_changed(self.source))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class WatchTaskTests(SourceTestCase):
+    """Tests the async_watch_djo_exports task."""
+
+    def setUp(self):
+        super().setUp()
+        self.write_directory()
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    @disable_logging
+    def test_triggers_on_change(self):
+        with override_settings(DJO_IMPORT_SOURCE='file://' + self.directory), \
+                mock.patch.object(tasks.async_djo_import_enrollment_data,
+                                  'delay') as delay:
+            tasks.async_watch_djo_exports()
+            self.assertEqual(delay.call_count, 1)
+            cache.clear()
+            tasks.async_watch_djo_exports()
+            self.assertEqual(delay.call_count, 1)
+
+    @disable_logging
+    def test_triggers_after_failed_import(self):
+        """Tests that an export an import failed on is imported again."""
+        with override_settings(DJO_IMPORT_SOURCE='file://' + self.directory), \
+                mock.patch.object(tasks.async_djo_import_enrollment_data,
+                                  'delay') as delay:
+            tasks.async_watch_djo_exports()
+            with mock.patch.object(tasks, 'djo_import_enrollment_data',
+                                   side_effect=ValueError):
+                tasks.async_djo_import_enrollment_data.apply()
+            tasks.async_watch_djo_exports()
+
+        self.assertEqual(delay.call_count, 2)
@@ -15,9 +15,12 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import sys
 from io import BytesIO, StringIO
+from tempfile import SpooledTemporaryFile
+from unittest import skipUnless
 from django.test import TestCase
-from paperlesspermission.utils import bytes_io_to_string_io, bytes_io_to_tsv_dict_reader, disable_logging
+from paperlesspermission.utils import bytes_io_to_string_io, bytes_io_to_tsv_dict_reader, chunked, disable_logging, file_digest, iter_text_lines, peak_memory, record_fingerprint, reset_peak_memory
 
 
 class BytesIOToStringIOTestCase(TestCase):
@@ -48,3 +51,72 @@ class BytesIOToTSVDictReader(TestCase):
             expected = self.result[i]
             self.assertDictEqual(row, expected)
             i += 1
+
+    @disable_logging
+    def test_spooled_file_tsv_dict_reader(self):
+        with SpooledTemporaryFile(max_size=16) as spooled:
+            spooled.write(self.b_value)
+            self.assertEqual(list(bytes_io_to_tsv_dict_reader(spooled)),
+                             self.result)
+
+
+class IterTextLinesTestCase(TestCase):
+    def test_iter_text_lines(self):
+        lines = iter_text_lines(BytesIO(b'one\ntwo\r\nthree'), block_size=4)
+        self.assertEqual(list(lines), ['one\n', 'two\r\n', 'three'])
+
+    def test_iter_text_lines_split_character(self):
+        # The two bytes of 'é' end up in different blocks.
+        lines = iter_text_lines(BytesIO('ab\u00e9\nc\n'.encode()), block_size=3)
+        self.assertEqual(list(lines), ['ab\u00e9\n', 'c\n'])
+
+    def test_iter_text_lines_rewinds(self):
+        fileobj = BytesIO(b'one\ntwo\n')
+        fileobj.read()
+        self.assertEqual(list(iter_text_lines(fileobj)), ['one\n', 'two\n'])
+
+
+class ChunkedTestCase(TestCase):
+    def test_chunked(self):
+        self.assertEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_chunked_empty(self):
+        self.assertEqual(list(chunked([], 2)), [])
+
+
+class FileDigestTestCase(TestCase):
+    def test_file_digest(self):
+        fileobj = BytesIO(b'ID\tNAME\n1\tApple\n')
+        fileobj.read(3)
+        self.assertEqual(
+            file_digest(fileobj),
+            file_digest(BytesIO(b'ID\tNAME\n1\tApple\n')))
+        self.assertEqual(fileobj.tell(), 0)
+
+    def test_file_digest_changes(self):
+        self.assertNotEqual(file_digest(BytesIO(b'1\tApple\n')),
+                            file_digest(BytesIO(b'1\tApples\n')))
+
+
+class RecordFingerprintTestCase(TestCase):
+    def test_record_fingerprint_key_order(self):
+        self.assertEqual(record_fingerprint({'a': 1, 'b': 'x'}),
+                         record_fingerprint({'b': 'x', 'a': 1}))
+
+    def test_record_fingerprint_changes(self):
+        self.assertNotEqual(record_fingerprint({'a': 1, 'b': 'x'}),
+                            record_fingerprint({'a': 1, 'b': 'y'}))
+
+
+class PeakMemoryTestCase(TestCase):
+    def test_peak_memory(self):
+        self.assertGreater(peak_memory(), 0)
+
+    @skipUnless(sys.platform.startswith('linux'), "Needs /proc/self/clear_refs")
+    def test_reset_peak_memory(self):
+        allocation = b'x' * (64 * 1024 * 1024)
+        before = peak_memory()
+        del allocation
+        if not reset_peak_memory():
+            self.skipTest("/proc/self/clear_refs is not writable")
+        self.assertLess(peak_memory(), before)
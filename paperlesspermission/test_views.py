@@ -18,13 +18,16 @@ limitations under the License.
 import logging
 from time import sleep
 from datetime import date, time
+from unittest import mock
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
 
 import paperlesspermission.views as views
 import paperlesspermission.models as models
+from paperlesspermission.djo_lock import ImportLock
 
 class ViewTest(TestCase):
     """Defines functions and data available to all view test cases."""
@@ -282,8 +285,20 @@ class IndexViewTests(ViewTest):
         """Test index redirect for super user"""
         self.check_view_redirect(reverse('index'), '/trip', self.super_user)
 
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
 class DJOImportAllViewTests(ViewTest):
     """Test cases for djo import all view."""
+    def setUp(self):
+        """Clear the import lock and keep imports from being queued."""
+        super(DJOImportAllViewTests, self).setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        patcher = mock.patch.object(views.async_djo_import_enrollment_data,
+                                    'delay')
+        self.delay = patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_djo_import_all_view_exists(self):
         """Ensure that the djo_import_all view exists."""
         self.assertTrue(hasattr(views, 'djo_import_all'))
@@ -314,6 +329,7 @@ class DJOImportAllViewTests(ViewTest):
 
         # Check that the call returns success (HTTP 204 No Content)
         self.assertEqual(response.status_code, 204)
+        self.delay.assert_called_once_with()
 
     def test_djo_import_all_staff_allowed_super(self):
         """Ensure super users are able to run djo_import_all."""
@@ -323,6 +339,60 @@ class DJOImportAllViewTests(ViewTest):
         # Check that the call returns success (HTTP 204 No Content)
         self.assertEqual(response.status_code, 204)
 
+    def test_djo_import_all_coalesced(self):
+        """Ensure triggers during a running import are not queued again."""
+        run = models.ImportRun.objects.create()
+        lock = ImportLock()
+        lock.acquire()
+        self.client.force_login(self.admin_user)
+
+        response = self.client.get(reverse('import all'))
+        self.client.get(reverse('import all'))
+
+        self.delay.assert_not_called()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['status'], ImportLock.FOLLOW_UP)
+        self.assertEqual(response.json()['run']['id'], run.id)
+        self.assertTrue(lock.release())
+
+class DJOImportRunsViewTests(ViewTest):
+    """Test cases for the djo import runs view."""
+    def test_djo_import_runs_view_mapped_correctly(self):
+        """Ensure that the URL mapping is correct."""
+        self.assertEqual(reverse('import runs'), '/import/runs/')
+
+    def test_djo_import_runs_view_unauthenticated(self):
+        """Ensure import runs cannot be viewed while unauthenticated."""
+        self.check_view_redirect(reverse('import runs'),
+                                 '/login?next=/import/runs/')
+
+    def test_djo_import_runs_not_staff(self):
+        """Ensure import runs cannot be viewed by teachers."""
+        self.client.force_login(self.teacher_user)
+        response = self.client.get(reverse('import runs'))
+
+        self.assertEqual(response.status_code, 403)
+
+    def test_djo_import_runs_staff_allowed(self):
+        """Ensure import runs are returned newest first."""
+        models.ImportRun.objects.create(status=models.ImportRun.FAILED)
+        models.ImportRun.objects.create(status=models.ImportRun.SUCCEEDED)
+
+        self.client.force_login(self.admin_user)
+        response = self.client.get(reverse('import runs'), {'limit': 1})
+
+        self.assertEqual(response.status_code, 200)
+        runs = response.json()['runs']
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0]['status'], 'Succeeded')
+
+    def test_djo_import_runs_bad_limit(self):
+        """Ensure a malformed limit is rejected."""
+        self.client.force_login(self.admin_user)
+        response = self.client.get(reverse('import runs'), {'limit': 'all'})
+
+        self.assertEqual(response.status_code, 400)
+
 class SlipViewTests(ViewTest):
     """Test cases for the slip view."""
     def test_slip_view_exists(self):
@@ -36,6 +36,7 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('import/', views.djo_import_all, name='import all'),
+    path('import/runs/', views.djo_import_runs, name='import runs'),
     path('admin/doc/', include('django.contrib.admindocs.urls')),
     path('admin/', admin.site.urls),
     path('login/', auth_views.LoginView.as_view(
@@ -17,15 +17,127 @@ limitations under the License.
 
 from io import BytesIO, StringIO
 from csv import DictReader
+from hashlib import blake2b, sha256
+import codecs
 import logging
+import resource
+
+# Number of bytes read from a file at a time when streaming it.
+READ_BLOCK_SIZE = 64 * 1024
 
 
 def bytes_io_to_string_io(bytes_io):
     return StringIO(bytes_io.getvalue().decode())
 
 
+def iter_text_lines(binary_file, encoding='utf-8', block_size=READ_BLOCK_SIZE):
+    """Yields the decoded lines of a binary file object.
+
+    The file is rewound, then read and decoded one block at a time, so only a
+    single block is held in memory at once. This works with any readable
+    binary file, e.g. a `BytesIO` or a `tempfile.SpooledTemporaryFile`.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    binary_file.seek(0)
+    while True:
+        block = binary_file.read(block_size)
+        lines = (pending + decoder.decode(block, final=not block)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        if not block:
+            break
+    if pending:
+        yield pending
+
+
 def bytes_io_to_tsv_dict_reader(bytes_io):
-    return DictReader(bytes_io_to_string_io(bytes_io), delimiter='\t')
+    """Returns a `csv.DictReader` streaming rows from a binary TSV file."""
+    return DictReader(iter_text_lines(bytes_io), delimiter='\t')
+
+
+def file_digest(fileobj):
+    """Returns the SHA-256 hex digest of a binary file object.
+
+    The file is read in blocks and rewound afterwards.
+    """
+    digest = sha256()
+    fileobj.seek(0)
+    for block in iter(lambda: fileobj.read(READ_BLOCK_SIZE), b''):
+        digest.update(block)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def record_fingerprint(values):
+    """Returns a short fingerprint of a dict of field values."""
+    data = '\x1f'.join('{0}={1}'.format(key, values[key])
+                        for key in sorted(values))
+    return blake2b(data.encode(), digest_size=8).hexdigest()
+
+
+def chunked(items, size):
+    """Yields successive lists of at most `size` items from `items`."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def peak_memory():
+    """Returns the peak resident memory of this process in KiB.
+
+    On Linux this is the peak since the last `reset_peak_memory`. Elsewhere
+    it is the peak since the process started.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_memory():
+    """Starts measuring the peak returned by `peak_memory` anew.
+
+    In a long-lived worker the peak of the whole process would only show the
+    largest import it ever ran. Only Linux can reset the peak.
+
+    Returns:
+        bool: Whether the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+    return True
+
+
+class QueryCounter():
+    """Counts the queries run on a database connection.
+
+    Use with `connection.execute_wrapper(counter)`. Unlike
+    `connection.queries` this also works with `DEBUG` off.
+
+    Attributes:
+        count (int): Number of queries executed so far
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
 
 
 def disable_logging(f):
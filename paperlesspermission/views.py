@@ -19,7 +19,7 @@ import logging
 import datetime
 
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponse, HttpResponseServerError, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseServerError, HttpResponseBadRequest, JsonResponse
 from django.template import loader
 from django.shortcuts import render, redirect, get_object_or_404
 from django.views.decorators.csrf import csrf_protect
@@ -29,8 +29,9 @@ from django.forms.models import model_to_dict
 from django.utils import timezone
 from django.db import transaction, DatabaseError
 
+from .djo_lock import ImportLock
 from .forms import PermissionSlipFormStudent, PermissionSlipFormParent, TripDetailForm
-from .models import PermissionSlipLink, PermissionSlip, FieldTrip
+from .models import PermissionSlipLink, PermissionSlip, FieldTrip, ImportRun
 from .tasks import async_djo_import_enrollment_data, async_generate_permission_slips, async_initial_trip_notifications, async_resend_permission_slip
 
 LOGGER = logging.getLogger(__name__)
@@ -45,11 +46,42 @@ def index(request):
 
 @login_required
 def djo_import_all(request):
+    """Queues an import, or reports on the import already queued or running.
+
+    Returns 204 if a new import was queued. Otherwise the trigger is merged
+    into the queued or running import and 202 is returned along with the
+    status of the running `ImportRun`, if any.
+    """
     if not request.user.is_staff:
         raise PermissionDenied
 
-    async_djo_import_enrollment_data.delay()
-    return HttpResponse(status=204)
+    outcome = ImportLock().trigger(async_djo_import_enrollment_data.delay)
+    if outcome == ImportLock.QUEUED:
+        return HttpResponse(status=204)
+
+    run = ImportRun.objects.filter(status=ImportRun.RUNNING).first()
+    return JsonResponse({
+        'status': outcome,
+        'run': run.as_dict() if run is not None else None,
+    }, status=202)
+
+
+@login_required
+def djo_import_runs(request):
+    """Returns the most recent import runs as JSON, newest first.
+
+    The number of runs defaults to 20 and can be set with `?limit=`.
+    """
+    if not request.user.is_staff:
+        raise PermissionDenied
+
+    try:
+        limit = int(request.GET.get('limit', 20))
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    runs = ImportRun.objects.all()[:max(limit, 0)]
+    return JsonResponse({'runs': [run.as_dict() for run in runs]})
 
 
 @csrf_protect